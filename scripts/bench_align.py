@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Benchmark of the stages of the alignment pipeline.
+
+Usage:
+    $ PYTHONPATH=src python scripts/bench_align.py
+    $ PYTHONPATH=src python scripts/bench_align.py --save bench/baseline.json
+    $ PYTHONPATH=src python scripts/bench_align.py --compare bench/baseline.json
+
+The corpus is generated, so that results of different commits can be
+compared. Each stage is timed separately (the minimum of --repeat runs),
+with the inputs of a stage prepared (and not timed) by the previous
+stages.
+"""
+
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess as sp
+import typing as typ
+import pathlib as pl
+
+from straitjacket import align
+
+DEFAULT_SCALE  = 2000
+DEFAULT_REPEAT = 5
+
+
+def _dict_literal(scale: int) -> str:
+    entries = "".join(f"    'key_{i:x}{'_' * (i % 7)}': {i},\n" for i in range(scale))
+    return "DATA = {\n" + entries + "}\n"
+
+
+def _enum_class(scale: int) -> str:
+    members = "".join(f"    MEMBER_{'X' * (i % 5)}{i} = {i}  # comment {i}\n" for i in range(scale))
+    return "import enum\n\n\nclass Kind(enum.Enum):\n" + members
+
+
+def _call_table(scale: int) -> str:
+    rows = "".join(
+        f"    (fn_{i % 13}(a, b={i}), \"name_{i}\", {i * 1.5}, [x{'y' * (i % 3)}, {i}], None),\n"
+        for i in range(scale)
+    )
+    return "TABLE = [\n" + rows + "]\n"
+
+
+def _docstring_module(scale: int) -> str:
+    funcs = []
+    for i in range(scale // 10):
+        funcs.append(
+            f"def func_{i}(arg: int, other: str = 'x') -> int:\n"
+            f'    """Docstring of func_{i}.\n\n'
+            f"    With a = b and c: d, which 'must' not be aligned.\n"
+            f"    >>> func_{i}(1)\n"
+            f"    {i}\n"
+            f'    """\n'
+            f"    value = arg + {i}\n"
+            f"    res = {{'a': value, 'bc': other}}\n"
+            f"    return value\n\n\n"
+        )
+    return "".join(funcs)
+
+
+def _fmt_off_module(scale: int) -> str:
+    blocks = []
+    for i in range(scale // 10):
+        toggle = "off" if i % 2 == 0 else "on"
+        blocks.append(
+            f"# fmt: {toggle}\n"
+            f"a_{i} = {i}\n"
+            f"bbb_{i} = f(a_{i}, b={i})\n"
+            f"cc_{i}: int = {{'x': {i}, 'yy': {i}}}\n"
+            f"dddd_{i} = [{i}, {i}]\n\n"
+        )
+    return "".join(blocks) + "# fmt: on\n"
+
+
+def _mixed_module(scale: int) -> str:
+    """Functions with docstrings, dicts, calls, tables and fmt: off regions."""
+    units = []
+    for i in range(scale // 25):
+        units.append(
+            f"def func_{i}(arg: int, other: str = 'x') -> int:\n"
+            f'    """Docstring of func_{i}.\n\n'
+            f"    With a = b and c: d.\n"
+            f'    """\n'
+            f"    value = arg + {i}\n"
+            f"    res = {{'a': value, 'bc': other, \"d-e\": [1, 2]}}\n"
+            f"    return fn(value, b={i})\n\n\n"
+            f"# fmt: off\n"
+            f"x_{i} = {i}\n"
+            f"yyy_{i} = {i}\n"
+            f"# fmt: on\n"
+            f"TABLE_{i} = [\n"
+            f"    (fn_{i}(a, b=1), 'name', 1.5, None),\n"
+            f"    (fn_{i}x(aa, b=22), 'other_name', 12.5, True),\n"
+            f"]\n"
+            f"KEY_{i} = 'value'  # comment\n"
+            f"OTHER_KEY_{i} = 'value'\n\n\n"
+        )
+    # a large dict literal, so that some cell groups grow with the input
+    entries = "".join(f"    'key_{i}': {i},\n" for i in range(len(units) * 4))
+    return "".join(units) + "DATA = {\n" + entries + "}\n"
+
+
+CORPUS: typ.Dict[str, typ.Callable[[int], str]] = {
+    'dict_literal'    : _dict_literal,
+    'enum_class'      : _enum_class,
+    'call_table'      : _call_table,
+    'docstring_module': _docstring_module,
+    'fmt_off_module'  : _fmt_off_module,
+    'mixed_module'    : _mixed_module,
+}
+
+
+def _min_duration(
+    fn: typ.Callable[[typ.Any], typ.Any], setup: typ.Callable[[], typ.Any], repeat: int
+) -> float:
+    durations = []
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        tzero = time.perf_counter()
+        fn(arg)
+        durations.append(time.perf_counter() - tzero)
+    return min(durations)
+
+
+def _normalized_table(src: str) -> align.TokenTable:
+    table = align.TokenTable(src)
+    _normalize(table)
+    return table
+
+
+def _contexts_list(src: str) -> typ.List[align.AlignmentContext]:
+    return list(align._iter_alignment_contexts(_normalized_table(src)))
+
+
+def _realign_args(src: str) -> typ.Tuple[align.TokenTable, align.CellGroups]:
+    table    = _normalized_table(src)
+    contexts = align._iter_alignment_contexts(table)
+    return (table, align._find_cell_groups(contexts))
+
+
+# The functions for each stage
+
+
+def _tokenize(src: str) -> None:
+    for _ in align._tokenize_for_alignment(src):
+        pass
+
+
+def _normalize(table: align.TokenTable) -> None:
+    for row_index in align._iter_formattable_row_indexes(table):
+        align._normalize_row_strings(table, row_index)
+
+
+def _contexts(table: align.TokenTable) -> None:
+    for _ in align._iter_alignment_contexts(table):
+        pass
+
+
+def _realign(args: typ.Tuple[align.TokenTable, align.CellGroups]) -> None:
+    align._realigned_contents(*args)
+
+
+StageResults = typ.Dict[str, float]
+
+
+def bench_stages(src: str, repeat: int) -> StageResults:
+    """Durations (in seconds) of each stage of align_formatted_str."""
+    contexts = _contexts_list(src)
+    stages   = {
+        'tokenize'   : (_tokenize                , lambda: src),
+        'token_table': (align.TokenTable         , lambda: src),
+        'normalize'  : (_normalize               , lambda: align.TokenTable(src)),
+        'contexts'   : (_contexts                , lambda: _normalized_table(src)),
+        'cell_groups': (align._find_cell_groups  , lambda: contexts),
+        'realign'    : (_realign                 , lambda: _realign_args(src)),
+        'end_to_end' : (align.align_formatted_str, lambda: src),
+    }
+    return {stage: _min_duration(fn, setup, repeat) for stage, (fn, setup) in stages.items()}
+
+
+def _git_commit() -> typ.Optional[str]:
+    try:
+        proc = sp.run(["git", "rev-parse", "--short", "HEAD"], stdout=sp.PIPE, stderr=sp.DEVNULL)
+    except OSError:
+        return None
+    if proc.returncode == 0:
+        return proc.stdout.decode("utf-8").strip()
+    else:
+        return None
+
+
+BenchResults = typ.Dict[str, typ.Any]
+
+
+def run(scale: int = DEFAULT_SCALE, repeat: int = DEFAULT_REPEAT) -> BenchResults:
+    corpus_results = {}
+    for name, make_src in CORPUS.items():
+        src        = make_src(scale)
+        num_rows   = src.count("\n")
+        num_tokens = sum(1 for _ in align._tokenize_for_alignment(src))
+        stages     = bench_stages(src, repeat)
+        corpus_results[name] = {
+            'rows'  : num_rows,
+            'tokens': num_tokens,
+            'stages': {
+                stage: {
+                    'seconds'       : duration,
+                    'tokens_per_sec': num_tokens / duration if duration else None,
+                    'rows_per_sec'  : num_rows   / duration if duration else None,
+                }
+                for stage, duration in stages.items()
+            },
+        }
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'scale' : scale,
+        'repeat': repeat,
+        'corpus': corpus_results,
+    }
+
+
+Ratios = typ.Dict[typ.Tuple[str, str], float]
+
+
+def compare(results: BenchResults, baseline: BenchResults) -> Ratios:
+    """Ratio of the duration of each stage to that of the baseline (< 1.0 is faster)."""
+    ratios: Ratios = {}
+
+    for name, corpus_result in results['corpus'].items():
+        baseline_stages = baseline['corpus'].get(name, {}).get('stages', {})
+        for stage, stage_result in corpus_result['stages'].items():
+            baseline_result = baseline_stages.get(stage)
+            if baseline_result and baseline_result['seconds'] > 0:
+                ratios[name, stage] = stage_result['seconds'] / baseline_result['seconds']
+    return ratios
+
+
+def _print_results(results: BenchResults, ratios: typ.Optional[Ratios]) -> None:
+    print(f"commit: {results['commit']}  python: {results['python']}  scale: {results['scale']}")
+    for name, corpus_result in results['corpus'].items():
+        print(f"\n{name} ({corpus_result['rows']} rows, {corpus_result['tokens']} tokens)")
+        for stage, stage_result in corpus_result['stages'].items():
+            line = (
+                f"    {stage:<12} {stage_result['seconds'] * 1000:9.2f} ms"
+                f" {stage_result['tokens_per_sec'] or 0:12.0f} tokens/s"
+                f" {stage_result['rows_per_sec'] or 0:10.0f} rows/s"
+            )
+            if ratios and (name, stage) in ratios:
+                line += f"  x{ratios[name, stage]:.2f}"
+            print(line)
+
+
+def _parse_args(args: typ.Optional[typ.Sequence[str]]) -> typ.Any:
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--scale"  , type=int, default=DEFAULT_SCALE , help="Rows per input.")
+    arg_parser.add_argument("--repeat" , type=int, default=DEFAULT_REPEAT, help="Runs per stage.")
+    arg_parser.add_argument("--save"   , metavar="PATH", help="Write the results as json to PATH.")
+    arg_parser.add_argument("--compare", metavar="PATH", help="Compare with the results in PATH.")
+    arg_parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=None,
+        help="With --compare, exit with status 1 if any stage is slower by more than this factor.",
+    )
+    return arg_parser.parse_args(args)
+
+
+def main(args: typ.Optional[typ.Sequence[str]] = None) -> int:
+    opts    = _parse_args(args)
+    results = run(opts.scale, opts.repeat)
+
+    ratios: typ.Optional[Ratios] = None
+
+    if opts.compare:
+        baseline = json.loads(pl.Path(opts.compare).read_text(encoding="utf-8"))
+        ratios   = compare(results, baseline)
+
+    _print_results(results, ratios)
+
+    if opts.save:
+        save_path = pl.Path(opts.save)
+        save_path.parent.mkdir(parents=True, exist_ok=True)
+        save_path.write_text(json.dumps(results, indent=2) + "\n", encoding="utf-8")
+
+    if ratios and opts.max_ratio:
+        slow_stages = [key for key, ratio in ratios.items() if ratio > opts.max_ratio]
+        for name, stage in slow_stages:
+            print(
+                f"slower than baseline: {name} {stage} x{ratios[name, stage]:.2f}", file=sys.stderr
+            )
+        return 1 if slow_stages else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -45,8 +45,9 @@ setuptools.setup(
     extras_require={"d": ["black[d]==21.12b0"]},
     entry_points="""
         [console_scripts]
-        sjfmt=straitjacket.sjfmt:main
+        sjfmt=straitjacket.__main__:main
         sjfmtd=straitjacket.sjfmtd:main
+        sjfmtc=straitjacket.client:main
     """,
     python_requires=">=3.6",
     zip_safe=True,
@@ -4,6 +4,38 @@
 # Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
 # SPDX-License-Identifier: MIT
 
+import sys
+import types
+import typing as typ
+import importlib
+
 __version__ = "v202206.1026"
 
-from . import sjfmt  # noqa
+# Submodules are not imported eagerly, so that using straitjacket.align
+# doesn't import black.
+SUBMODULES = (
+    'aio',
+    'align',
+    'cache',
+    'client',
+    'edits',
+    'prefork',
+    'runner',
+    'sjfmt',
+    'sjfmtd',
+    'sources',
+    'stats',
+)
+
+
+# A module level __getattr__ (PEP 562) requires python 3.7, so the class
+# of the module is replaced instead.
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name: str) -> typ.Any:
+        if name in SUBMODULES:
+            return importlib.import_module(f"{__name__}.{name}")
+        else:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+sys.modules[__name__].__class__ = _LazyModule
@@ -7,8 +7,28 @@
 
 import sys
 
-from . import sjfmt
+
+def main() -> None:
+    # The --version, --align-only and --server paths don't use black, so
+    # we don't pay for importing it.
+    if sys.argv[1:] == ["--version"]:
+        from straitjacket import __version__
+
+        print(f"sjfmt, version {__version__}")
+    elif "--align-only" in sys.argv[1:]:
+        from straitjacket import align
+
+        align.main()
+    elif "--server" in sys.argv[1:]:
+        from straitjacket import client
+
+        client.main()
+    else:
+        from straitjacket import sjfmt
+
+        sjfmt.main()
+
 
 if __name__ == '__main__':
-    sjfmt.main()
+    main()
     sys.exit(0)
@@ -0,0 +1,165 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Asyncio API for straitjacket.
+
+Formatting is done in an executor, so the event loop is never blocked.
+By default this is the default executor of the event loop (a thread
+pool), pass a concurrent.futures.ProcessPoolExecutor to format on
+multiple cores.
+
+Cancellation and timeouts only prevent the formatting of inputs which
+have not been started yet. Once started, the formatting of an input
+runs to completion in the executor, but the result is discarded. Files
+are only written back if they were formatted in time.
+"""
+
+import os
+import asyncio
+import functools
+import typing as typ
+import pathlib as pl
+import concurrent.futures as cf
+
+import black
+
+from straitjacket import sjfmt
+from straitjacket import runner
+
+FileResult = runner.FileResult
+
+PathLike = typ.Union[str, pl.Path]
+
+
+def _format_str(src_contents: str, mode: black.mode.Mode) -> black.FileContent:
+    return sjfmt.Engine(mode).format_str(src_contents)
+
+
+async def format_str_async(
+    src_contents: str,
+    *,
+    mode    : typ.Optional[black.mode.Mode] = None,
+    executor: typ.Optional[cf.Executor    ] = None,
+    timeout : typ.Optional[float          ] = None,
+) -> black.FileContent:
+    """Async version of sjfmt.format_str.
+
+    Raises asyncio.TimeoutError if the result is not available after
+    timeout seconds.
+    """
+    loop   = asyncio.get_event_loop()
+    mode   = mode or black.mode.Mode()
+    future = loop.run_in_executor(executor, _format_str, src_contents, mode)
+    return await asyncio.wait_for(future, timeout)
+
+
+def _format_file_no_write(
+    path: str, fast: bool, mode: black.mode.Mode, write_back: black.WriteBack
+) -> typ.Tuple[FileResult, typ.Optional[runner.FormattedFile]]:
+    # The file is not written by the executor, otherwise it would still
+    # be written after a timeout. Instead the result is returned, to be
+    # written back by _format_file if it is available in time.
+    if write_back != black.WriteBack.YES:
+        return (runner.format_file(path, fast, mode, write_back), None)
+
+    try:
+        formatted = runner.format_file_contents(pl.Path(path), fast, mode)
+    except Exception as ex:
+        return (FileResult(path, False, str(ex), None), None)
+
+    return (FileResult(path, formatted is not None, None, None), formatted)
+
+
+def _num_workers(executor: typ.Optional[cf.Executor]) -> int:
+    # The number of workers is not public, but both ThreadPoolExecutor
+    # and ProcessPoolExecutor have _max_workers. Formatting is cpu
+    # bound, so for the default executor of the event loop, more threads
+    # than cpus would not help.
+    num_workers = getattr(executor, '_max_workers', None)
+    if isinstance(num_workers, int) and num_workers > 0:
+        return num_workers
+    else:
+        return os.cpu_count() or 1
+
+
+async def _format_file(
+    path      : str,
+    fast      : bool,
+    mode      : black.mode.Mode,
+    write_back: black.WriteBack,
+    executor  : typ.Optional[cf.Executor],
+    timeout   : typ.Optional[float],
+    semaphore : asyncio.Semaphore,
+) -> FileResult:
+    if path.endswith(".ipynb"):
+        # Notebooks are formatted by black, which would require to
+        # monkey patch black.format_str.
+        return FileResult(path, False, "Jupyter notebooks are not supported", None)
+
+    loop      = asyncio.get_event_loop()
+    format_fn = functools.partial(_format_file_no_write, path, fast, mode, write_back)
+    # Only as many files as there are workers are submitted at a time,
+    # otherwise the time a file waits in the queue of the executor would
+    # count against its timeout. A worker is only available again once
+    # the file is done, even if the result is discarded after a timeout.
+    await semaphore.acquire()
+    future = loop.run_in_executor(executor, format_fn)
+    future.add_done_callback(lambda _: semaphore.release())
+    try:
+        file_result, formatted = await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        return FileResult(path, False, f"timeout after {timeout} seconds", None)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+
+    if formatted is None:
+        return file_result
+
+    try:
+        runner.write_file(pl.Path(path), formatted)
+    except Exception as ex:
+        return FileResult(path, False, str(ex), None)
+    return file_result
+
+
+async def format_files_async(
+    paths: typ.Iterable[PathLike],
+    *,
+    fast      : bool = False,
+    mode      : typ.Optional[black.mode.Mode] = None,
+    write_back: black.WriteBack = black.WriteBack.YES,
+    executor  : typ.Optional[cf.Executor] = None,
+    timeout   : typ.Optional[float      ] = None,
+) -> typ.AsyncIterator[FileResult]:
+    """Format files, the results are yielded in the order they are completed.
+
+    Files are read and formatted by the executor. A file is only
+    written back (with write_back=WriteBack.YES) if it was formatted
+    before its timeout. Errors (including a timeout for an individual
+    file) are reported via FileResult.error.
+    The timeout of a file starts when it is submitted to the executor,
+    which is done when a worker is available.
+    If the iteration is stopped early (and the generator is closed
+    with aclose) or the consuming task is cancelled, files which have
+    not been started are skipped.
+    """
+    mode      = mode or black.mode.Mode()
+    semaphore = asyncio.Semaphore(_num_workers(executor))
+    tasks     = [
+        asyncio.ensure_future(
+            _format_file(str(path), fast, mode, write_back, executor, timeout, semaphore)
+        )
+        for path in paths
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Waiting for the cancelled tasks makes sure that the pending
+        # futures of the executor are cancelled as well.
+        await asyncio.gather(*tasks, return_exceptions=True)
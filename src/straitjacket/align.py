@@ -0,0 +1,1726 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+
+import re
+import sys
+import enum
+import array
+import bisect
+import typing as typ
+import pathlib as pl
+
+from straitjacket import stats
+from straitjacket import sources
+
+
+FileContent = str
+
+
+# fmt: off
+ALIGN_BEFORE_TOKENS = {
+    "<<=", ">>=", "**=", "//=",
+    "+=", "-=", "*=", "/=", "%=", "|=", "&=", "@=",
+    "==", "!=", "<=", ">=",
+    "//", "<<", ">>", "^=", "~=",
+    "in", "is",
+    "},", "],", "),",
+    "->",
+    ",", ":", "=",
+    "+", "-", "*", "/",
+    "%", "|", "&", "^", "~",
+    "!", "<", ">",
+    "}", "]", ")",
+}
+# fmt: on
+
+
+# NOTE (mb 2018-09-12): An alternative implementation
+#   might use lookback and count backslashes.
+
+TRIPPLE_QUOTE_END_PATTERN = r"""
+(
+    (?<=^)
+    | (?<=[^\\])
+    | (?<=[^\\]\\\\)
+    | (?<=[^\\]\\\\\\\\)
+    | (?<=[^\\]\\\\\\\\\\\\)
+)
+'''
+"""
+
+
+TRIPPLE_DOUBLE_QUOTE_END_PATTERN = r"""
+(
+    (?<=^)
+    | (?<=\\\\)
+    | (?<=[^\\])
+    | (?<=[^\\]\\\\)
+    | (?<=[^\\]\\\\\\\\)
+    | (?<=[^\\]\\\\\\\\\\\\)
+)
+\"\"\"
+"""
+
+
+DOUBLE_QUOTE_END_PATTERN = r"""
+(
+    (?<=^)
+    | (?<=\\\\)
+    | (?<=[^\\])
+    | (?<=[^\\]\\\\)
+    | (?<=[^\\]\\\\\\\\)
+    | (?<=[^\\]\\\\\\\\\\\\)
+)
+"
+"""
+
+
+QUOTE_END_PATTERN = r"""
+(
+    (?<=^)
+    | (?<=\\\\)
+    | (?<=[^\\])
+    | (?<=[^\\]\\\\)
+    | (?<=[^\\]\\\\\\\\)
+    | (?<=[^\\]\\\\\\\\\\\\)
+)
+'
+"""
+
+
+COMMENT_END_PATTERN = r"$"
+
+
+NO_ALIGN_BLOCK_END_MATCHERS = {
+    "'''": re.compile(TRIPPLE_QUOTE_END_PATTERN, flags=re.VERBOSE),
+    '"""': re.compile(TRIPPLE_DOUBLE_QUOTE_END_PATTERN, flags=re.VERBOSE),
+    '"'  : re.compile(DOUBLE_QUOTE_END_PATTERN, flags=re.VERBOSE),
+    "'"  : re.compile(QUOTE_END_PATTERN, flags=re.VERBOSE),
+    "#"  : re.compile(COMMENT_END_PATTERN, flags=re.MULTILINE),
+}
+
+
+TOKEN_SEP_PATTERN = r"""
+(
+    '''
+    |\"\"\"
+    |\"
+    |'
+    |\#
+
+    |<<= |>>= |\*\*= |//=
+    |\+= |\-= |\*= |/= |%= |\|= |&= |@=
+    |== |!= |<= |>=
+    |// |<< |>> |\^= |~=
+    |(?<!\w)in(?!\w) |(?<!\w)is(?!\w)
+    |\}, |\], |\),
+    |\->
+    |, |: |=(?=[ ])
+    |\+ |\- |\* |/
+    |% |\| |& |\^ |~
+    |! |< |>
+    |\{ |\[ |\(
+    |\} |\] |\)
+
+    |$
+)
+"""
+
+
+TOKEN_SEP_RE = re.compile(TOKEN_SEP_PATTERN, flags=re.MULTILINE | re.VERBOSE)
+
+SYMBOL_STRING_RE = re.compile(r"\"[a-zA-Z0-9_\-]+\"")
+
+NON_SYMBOL_STRING_RE = re.compile(r"[^a-zA-Z0-9_\-]")
+
+FMT_ON_OFF_RE = re.compile(r"#\s*fmt\s*:\s*(on|off)")
+
+INDENT_RE = re.compile(r"[ \t]*")
+
+
+class TokenType(enum.Enum):
+
+    INDENT     = 0
+    SEPARATOR  = 1
+    CODE       = 2
+    NEWLINE    = 3
+    BLOCK      = 4
+    COMMENT    = 5
+    WHITESPACE = 6
+
+
+TokenVal = str
+
+
+class Token(typ.NamedTuple):
+
+    typ: TokenType
+    val: TokenVal
+
+    def __repr__(self) -> str:
+        """Token representation with alignment.
+
+        >>> repr(Token(TokenType.CODE, 'tokenval'))
+        "Token(TokenType.CODE      , 'tokenval')"
+        """
+        return f"Token({self.typ:<20}, {repr(self.val)})"
+
+
+TokenRow = typ.List[Token]
+
+
+TokenOffset = int
+
+
+class TokenSpan(typ.NamedTuple):
+
+    typ  : TokenType
+    start: TokenOffset
+    end  : TokenOffset
+
+
+def _iter_token_spans(
+    src_contents: str, pos: TokenOffset = 0, is_final: bool = True, is_row_start: bool = False
+) -> typ.Iterator[TokenSpan]:
+    """Tokenize src_contents, starting at pos.
+
+    The pos must be 0 or the beginning of a row (directly after a
+    newline). If is_row_start is set, pos 0 is also treated as the
+    beginning of a row (src_contents continues previous rows). If
+    is_final is False, src_contents may end in the middle of a comment,
+    string or docstring, in which case tokenization stops at the
+    beginning of that token.
+    """
+    # We scan with a cursor over the original string rather than
+    # re-slicing the rest after every token. Each search starts at
+    # `pos`, so tokenizing is linear in the size of the input and
+    # nothing is copied (token values are only sliced by the consumer,
+    # if at all).
+    src_len : int = len(src_contents)
+    prev_pos: int = -1
+
+    is_row_start = is_row_start or pos > 0
+
+    assert pos == 0 or src_contents[pos - 1] == "\n"
+
+    while pos < src_len:
+        assert pos != prev_pos, "No progress at: " + repr(src_contents[pos : pos + 40])
+        prev_pos = pos
+
+        if is_row_start:
+            is_row_start = False
+            # parse any indent
+            indent_match = INDENT_RE.match(src_contents, pos)
+            assert indent_match is not None
+            indent_end = indent_match.end()
+            if indent_end > pos:
+                yield TokenSpan(TokenType.INDENT, pos, indent_end)
+                pos = indent_end
+                continue
+
+        curr_token_sep = TOKEN_SEP_RE.search(src_contents, pos)
+        assert curr_token_sep is not None
+        curr_token_start, curr_token_end = curr_token_sep.span()
+        is_eof = curr_token_start == src_len
+        # newline match has zero width
+        is_newline = curr_token_start == curr_token_end
+
+        if is_eof:
+            if len(src_contents[pos:].strip()) == 0:
+                yield TokenSpan(TokenType.WHITESPACE, pos, src_len)
+            else:
+                yield TokenSpan(TokenType.CODE, pos, src_len)
+            return
+        elif is_newline:
+            # adjust for zero width match
+            curr_token_end = curr_token_start + 1
+
+            # Get everything (if anything) up to (and excluding) the newline
+            if curr_token_start > pos:
+                yield TokenSpan(TokenType.CODE, pos, curr_token_start)
+
+            # The newline itself (note that black promises to
+            # have normalized CRLF etc. to plain LF)
+            assert src_contents[curr_token_start] == "\n"
+            yield TokenSpan(TokenType.NEWLINE, curr_token_start, curr_token_end)
+
+            pos          = curr_token_end
+            is_row_start = True
+        elif curr_token_start > pos:
+            prev_token_val = src_contents[pos:curr_token_start]
+            assert prev_token_val != "\n"
+            assert prev_token_val not in ALIGN_BEFORE_TOKENS, repr(prev_token_val)
+            if len(prev_token_val.strip()) == 0:
+                yield TokenSpan(TokenType.WHITESPACE, pos, curr_token_start)
+            else:
+                yield TokenSpan(TokenType.CODE, pos, curr_token_start)
+            pos = curr_token_start
+        else:
+            token_val = curr_token_sep.group(0)
+            if token_val in NO_ALIGN_BLOCK_END_MATCHERS:
+                # comment, string or docstring
+                assert curr_token_end > pos
+                end_matcher     = NO_ALIGN_BLOCK_END_MATCHERS[token_val]
+                block_end_match = end_matcher.search(src_contents, curr_token_end)
+                if block_end_match is None and not is_final:
+                    return
+
+                assert block_end_match, src_contents[curr_token_end : curr_token_end + 40]
+                block_end_index = block_end_match.end()
+                if token_val == "#":
+                    yield TokenSpan(TokenType.COMMENT, pos, block_end_index)
+                else:
+                    yield TokenSpan(TokenType.BLOCK, pos, block_end_index)
+                pos = block_end_index
+            else:
+                yield TokenSpan(TokenType.SEPARATOR, pos, curr_token_end)
+                pos = curr_token_end
+
+            # NOTE (mb 2018-09-09): The way we tokenize, we always consume
+            #   all content belonging to strings and comments. This means that
+            #   the rest (after consuming all content of a string or comment),
+            #   should continue to be valid python. This means we can do some
+            #   basic sanity checks. For example, no valid python token begins
+            #   with a questionmark (though this is actually introduced because
+            #   one of the test cases conveniently has a questionmark as the
+            #   first character after an edge case of string parsing).
+            assert not src_contents.startswith("?", pos), repr(src_contents[pos : pos + 40])
+
+
+def _tokenize_for_alignment(src_contents: str) -> typ.Iterator[Token]:
+    for tok_typ, start, end in _iter_token_spans(src_contents):
+        yield Token(tok_typ, src_contents[start:end])
+
+
+Indent      = str
+RowIndex    = int
+ColIndex    = int
+OffsetWidth = int
+TokenIndex  = int
+
+
+# TokenType by TokenType.value, for array backed token types
+TOKEN_TYPES = sorted(TokenType, key=lambda tok_typ: tok_typ.value)
+
+
+class TokenTable:
+    """Rows of tokens, stored as offsets into the formatted source.
+
+    Tokens are not copied into strings of their own. Instead the
+    (type, start, end) of each token is stored in array backed
+    columns. Rows are materialized on demand and only tokens which
+    are modified (normalized strings, padded cells) are kept as
+    values, everything else is written out as slices of the source.
+
+    Rows can be appended (see extend) and rows which were written out
+    can be dropped (see drop_rows). Row indexes are stable, so rows in
+    the table are always in the range first_row_idx : len(table).
+    """
+
+    def __init__(self, src_contents: str = "") -> None:
+        # The source is kept as the chunks which were passed to extend
+        # (each consisting of complete rows), so that appending doesn't
+        # copy what came before. Token offsets are relative to the
+        # start of the first chunk.
+        self.chunks       : typ.List[str] = []
+        self.chunk_offsets: typ.List[TokenOffset] = []
+        self.src_len      : int = 0
+
+        # Index of the first row which has not been dropped
+        self.first_row_idx: RowIndex = 0
+        # Index of the row which corresponds to row_starts[0]
+        self.base_row_idx: RowIndex = 0
+
+        self.typs  : array.array = array.array('B')
+        self.starts: array.array = array.array('I')
+        self.ends  : array.array = array.array('I')
+        # Index of the first token of each row. The last entry is a
+        # sentinel, so the tokens of a row are always in the range
+        # row_starts[row_idx] : row_starts[row_idx + 1].
+        self.row_starts: array.array = array.array('I', [0, 0])
+
+        # Per row index of the last token which is not whitespace,
+        # a comment or the newline (-1 if there is no such token).
+        self.last_content_cols: array.array = array.array('i', [-1])
+
+        # Tokens which were modified, by row and column
+        self.overrides: typ.Dict[RowIndex, typ.Dict[ColIndex, Token]] = {}
+        # Total change in length of the modified tokens of each row
+        # and the last column that was modified.
+        self.row_paddings   : typ.Dict[RowIndex, OffsetWidth] = {}
+        self.row_padded_cols: typ.Dict[RowIndex, ColIndex] = {}
+
+        if src_contents:
+            self.extend(src_contents)
+
+    def extend(self, src_contents: str, is_final: bool = True) -> int:
+        """Tokenize src_contents and append to the last row.
+
+        If is_final is False, only complete rows (up to and including
+        their newline) are appended and the number of characters
+        which were consumed is returned. The rest must be passed again
+        (with more content) in the next call.
+        """
+        assert self.row_len(len(self) - 1) == 0, "Last row already complete"
+
+        prev_src_len = self.src_len
+
+        # remove sentinels of the (empty) last row
+        self.row_starts.pop()
+        self.last_content_cols.pop()
+
+        typs_append       = self.typs.append
+        starts_append     = self.starts.append
+        ends_append       = self.ends.append
+        row_starts_append = self.row_starts.append
+        last_cols_append  = self.last_content_cols.append
+
+        newline_typ_val  = TokenType.NEWLINE.value
+        non_content_typs = {TokenType.NEWLINE, TokenType.COMMENT, TokenType.WHITESPACE}
+        first_tok_idx    = len(self.typs)
+        last_content_col = -1
+        row_end          = 0
+
+        token_spans = _iter_token_spans(src_contents, 0, is_final, is_row_start=prev_src_len > 0)
+        for tok_idx, (tok_typ, start, end) in enumerate(token_spans, first_tok_idx):
+            typs_append(tok_typ.value)
+            starts_append(prev_src_len + start)
+            ends_append(prev_src_len + end)
+            if tok_typ not in non_content_typs:
+                last_content_col = tok_idx - first_tok_idx
+            if tok_typ.value == newline_typ_val:
+                first_tok_idx = tok_idx + 1
+                row_starts_append(first_tok_idx)
+                last_cols_append(last_content_col)
+                last_content_col = -1
+                row_end          = end
+
+        if is_final:
+            row_end = len(src_contents)
+        else:
+            # discard tokens of the incomplete last row
+            del self.typs[first_tok_idx:]
+            del self.starts[first_tok_idx:]
+            del self.ends[first_tok_idx:]
+            last_content_col = -1
+
+        if row_end > 0:
+            self.chunks.append(src_contents[:row_end])
+            self.chunk_offsets.append(prev_src_len)
+            self.src_len += row_end
+        self.row_starts.append(len(self.typs))
+        self.last_content_cols.append(last_content_col)
+        return row_end
+
+    def _chunk(self, pos: TokenOffset) -> typ.Tuple[str, TokenOffset]:
+        """The chunk which contains pos and the offset of the chunk."""
+        chunk_idx = bisect.bisect_right(self.chunk_offsets, pos) - 1
+        return (self.chunks[chunk_idx], self.chunk_offsets[chunk_idx])
+
+    def _src(self, start: TokenOffset, end: TokenOffset) -> str:
+        """Source in the range start : end (which may span chunks)."""
+        if start >= end:
+            return ""
+
+        chunk_idx = bisect.bisect_right(self.chunk_offsets, start) - 1
+        parts     = []
+        while start < end:
+            chunk        = self.chunks[chunk_idx]
+            chunk_offset = self.chunk_offsets[chunk_idx]
+            parts.append(chunk[start - chunk_offset : end - chunk_offset])
+            start = chunk_offset + len(chunk)
+            chunk_idx += 1
+        return "".join(parts)
+
+    def __len__(self) -> int:
+        """Number of rows, including those which were dropped."""
+        return self.base_row_idx + len(self.row_starts) - 1
+
+    def __iter__(self) -> typ.Iterator[TokenRow]:
+        for row_idx in range(self.first_row_idx, len(self)):
+            yield self.row(row_idx)
+
+    def row(self, row_idx: RowIndex) -> TokenRow:
+        first_tok_idx = self.row_starts[row_idx - self.base_row_idx]
+        end_tok_idx   = self.row_starts[row_idx - self.base_row_idx + 1]
+        if first_tok_idx == end_tok_idx:
+            return []
+
+        # a row is always contained in a single chunk
+        chunk, offset = self._chunk(self.starts[first_tok_idx])
+
+        typs   = self.typs[first_tok_idx:end_tok_idx]
+        starts = self.starts[first_tok_idx:end_tok_idx]
+        ends   = self.ends[first_tok_idx:end_tok_idx]
+
+        row = [
+            Token(TOKEN_TYPES[tok_typ], chunk[start - offset : end - offset])
+            for tok_typ, start, end in zip(typs, starts, ends)
+        ]
+        row_overrides = self.overrides.get(row_idx)
+        if row_overrides:
+            for col_idx, token in row_overrides.items():
+                row[col_idx] = token
+        return row
+
+    def has_token_typ(self, row_idx: RowIndex, tok_typ: TokenType) -> bool:
+        first_tok_idx = self.row_starts[row_idx - self.base_row_idx]
+        end_tok_idx   = self.row_starts[row_idx - self.base_row_idx + 1]
+        return tok_typ.value in self.typs[first_tok_idx:end_tok_idx]
+
+    def row_len(self, row_idx: RowIndex) -> int:
+        table_row_idx = row_idx - self.base_row_idx
+        return int(self.row_starts[table_row_idx + 1] - self.row_starts[table_row_idx])
+
+    def last_content_col(self, row_idx: RowIndex) -> ColIndex:
+        return int(self.last_content_cols[row_idx - self.base_row_idx])
+
+    def token(self, row_idx: RowIndex, col_idx: ColIndex) -> Token:
+        row_overrides = self.overrides.get(row_idx)
+        if row_overrides and col_idx in row_overrides:
+            return row_overrides[col_idx]
+
+        tok_idx       = self.row_starts[row_idx - self.base_row_idx] + col_idx
+        start         = self.starts[tok_idx]
+        chunk, offset = self._chunk(start)
+        tok_val       = chunk[start - offset : self.ends[tok_idx] - offset]
+        return Token(TOKEN_TYPES[self.typs[tok_idx]], tok_val)
+
+    def col_offset(self, row_idx: RowIndex, col_idx: ColIndex) -> OffsetWidth:
+        """Length of the row up to (and excluding) the token at col_idx.
+
+        Only tokens before col_idx may have been modified, which holds
+        as long as cells are realigned in order of their column.
+        """
+        first_tok_idx = self.row_starts[row_idx - self.base_row_idx]
+        offset        = int(self.starts[first_tok_idx + col_idx] - self.starts[first_tok_idx])
+        if row_idx in self.row_paddings:
+            assert self.row_padded_cols[row_idx] < col_idx
+            offset += self.row_paddings[row_idx]
+        return offset
+
+    def set_token(self, row_idx: RowIndex, col_idx: ColIndex, token: Token) -> None:
+        assert self.first_row_idx <= row_idx
+        assert col_idx < self.row_len(row_idx)
+        padding = len(token.val) - len(self.token(row_idx, col_idx).val)
+        if padding:
+            self.row_paddings[row_idx] = self.row_paddings.get(row_idx, 0) + padding
+            self.row_padded_cols[row_idx] = max(col_idx, self.row_padded_cols.get(row_idx, 0))
+        self.overrides.setdefault(row_idx, {})[col_idx] = token
+
+    def _row_pos(self, row_idx: RowIndex) -> TokenOffset:
+        tok_idx = self.row_starts[row_idx - self.base_row_idx]
+        if tok_idx < len(self.starts):
+            return typ.cast(TokenOffset, self.starts[tok_idx])
+        else:
+            return self.src_len
+
+    def contents(self, end_row_idx: typ.Optional[RowIndex] = None) -> FileContent:
+        """Contents of the rows first_row_idx : end_row_idx (all by default)."""
+        if end_row_idx is None:
+            end_row_idx = len(self)
+
+        pos     = self._row_pos(self.first_row_idx)
+        end_pos = self._row_pos(end_row_idx)
+
+        parts = []
+        for row_idx in sorted(self.overrides):
+            if row_idx >= end_row_idx:
+                break
+
+            first_tok_idx = self.row_starts[row_idx - self.base_row_idx]
+            row_overrides = self.overrides[row_idx]
+            for col_idx in sorted(row_overrides):
+                tok_idx = first_tok_idx + col_idx
+                parts.append(self._src(pos, self.starts[tok_idx]))
+                parts.append(row_overrides[col_idx].val)
+                pos = self.ends[tok_idx]
+        parts.append(self._src(pos, end_pos))
+        return "".join(parts)
+
+    def drop_rows(self, end_row_idx: RowIndex) -> None:
+        """Release rows before end_row_idx (after they were written out)."""
+        assert self.first_row_idx <= end_row_idx < len(self)
+        for row_idx in range(self.first_row_idx, end_row_idx):
+            self.overrides.pop(row_idx, None)
+            self.row_paddings.pop(row_idx, None)
+            self.row_padded_cols.pop(row_idx, None)
+        self.first_row_idx = end_row_idx
+
+        # The arrays are only compacted once at least half of their
+        # tokens were dropped, so the cost of compaction is amortized
+        # over the dropped rows.
+        drop_row_count = end_row_idx - self.base_row_idx
+        drop_tok_count = self.row_starts[drop_row_count]
+        if drop_tok_count == 0 or drop_tok_count * 2 < len(self.typs):
+            return
+
+        # chunks are only released as a whole, the offsets are
+        # relative to the first chunk which is kept
+        drop_chunk_count = bisect.bisect_right(self.chunk_offsets, self._row_pos(end_row_idx)) - 1
+        drop_pos         = self.chunk_offsets[drop_chunk_count]
+
+        del self.typs[:drop_tok_count]
+        self.starts = array.array('I', [start - drop_pos for start in self.starts[drop_tok_count:]])
+        self.ends   = array.array('I', [end - drop_pos for end in self.ends[drop_tok_count:]])
+
+        row_starts      = self.row_starts[drop_row_count:]
+        self.row_starts = array.array('I', [tok_idx - drop_tok_count for tok_idx in row_starts])
+        del self.last_content_cols[:drop_row_count]
+
+        del self.chunks[:drop_chunk_count]
+        self.chunk_offsets = [offset - drop_pos for offset in self.chunk_offsets[drop_chunk_count:]]
+        self.src_len -= drop_pos
+        self.base_row_idx = end_row_idx
+
+
+# Identifies the layout of a row up to (and including) a column.
+LayoutId = int
+
+# The layout of a row before its first column
+EMPTY_LAYOUT: LayoutId = 0
+
+
+class RowLayoutToken(typ.NamedTuple):
+    """Disambiguate between lines with different layout/structure.
+
+    We only want to align lines which have the same structure of
+    indent and separators. Any difference in the number of elements
+    or type of separators causes alignment to be disabled.
+
+    Rather than comparing the sequence of all layout tokens of a
+    row, each layout token references the layout of the preceding
+    columns. These are interned (see LayoutInternTable), so two rows
+    have the same layout up to a column iff they have the same
+    LayoutId for that column.
+    """
+
+    prev_layout: LayoutId
+    typ        : TokenType
+    # val is only set if it should cause a different prefix
+    # eg. if a separator is a comma vs a period.
+    val: TokenVal
+
+
+LayoutInternTable = typ.Dict[RowLayoutToken, LayoutId]
+
+
+def _intern_layout(layouts: LayoutInternTable, layout_token: RowLayoutToken) -> LayoutId:
+    layout = layouts.get(layout_token)
+    if layout is None:
+        layout = len(layouts) + 1
+        layouts[layout_token] = layout
+    return layout
+
+
+# Tokens which have values which are relevant to to the layout of
+# a cell group.
+LAYOUT_VAL_TOKENS = {TokenType.SEPARATOR, TokenType.INDENT}
+
+
+class AlignmentContextKey(typ.NamedTuple):
+    """Does not change between multiple lines that can be aligned."""
+
+    col_idx: ColIndex
+    row_idx: RowIndex
+    tok_typ: TokenType
+    tok_val: TokenVal
+    layout : LayoutId
+
+
+AlignmentContext = typ.Dict[AlignmentContextKey, OffsetWidth]
+
+
+class AlignmentCellKey(typ.NamedTuple):
+    col_index     : ColIndex
+    last_row_index: RowIndex
+    token_val     : TokenVal
+    layout        : LayoutId
+
+
+class AlignmentCell(typ.NamedTuple):
+    row_idx     : RowIndex
+    offset_width: OffsetWidth
+
+
+CellGroups = typ.Dict[AlignmentCellKey, typ.List[AlignmentCell]]
+
+
+def _is_dict_key_symbol_access(col_index: int, tok_cell: Token, row: TokenRow) -> bool:
+    """Determine if the current token is a separator for __getitem__, __setitem__."""
+
+    if col_index - 1 < 0:
+        return False
+    elif tok_cell.val not in ": ] ],":
+        return False
+
+    prev_tok = row[col_index - 1]
+    if prev_tok.typ != TokenType.BLOCK:
+        return False
+    elif SYMBOL_STRING_RE.match(prev_tok.val) is None:
+        return False
+    elif tok_cell.typ != TokenType.SEPARATOR:
+        return False
+    elif tok_cell.val in ("]", "],"):
+        if col_index - 2 < 0:
+            return False
+
+        prevprev_tok = row[col_index - 2]
+        if prevprev_tok == Token(TokenType.SEPARATOR, "["):
+            return True
+
+    elif tok_cell.val == ":":
+        return True
+
+    return False
+
+
+ATTR_ACCESORS = ('getattr', 'setattr', 'delattr')
+
+
+def _is_attr_symbol_access(col_index: int, tok_cell: Token, row: TokenRow) -> bool:
+    if not (tok_cell.typ == TokenType.CODE and tok_cell.val in ATTR_ACCESORS):
+        return False
+
+    return (
+        col_index + 5 < len(row)
+        and row[col_index + 1].typ == TokenType.SEPARATOR
+        and row[col_index + 1].val == "("
+        and row[col_index + 2].typ == TokenType.CODE
+        and row[col_index + 3].typ == TokenType.SEPARATOR
+        and row[col_index + 3].val == ","
+        and row[col_index + 4].typ == TokenType.WHITESPACE
+        and row[col_index + 4].val == " "
+        and row[col_index + 5].typ == TokenType.BLOCK
+        and bool(SYMBOL_STRING_RE.match(row[col_index + 5].val))
+    )
+
+
+def _is_single_quoted_non_symbol(tok_cell: Token) -> bool:
+    return (
+        tok_cell.typ == TokenType.BLOCK
+        and len(tok_cell.val) > 2
+        and tok_cell.val[:3] != "'''"
+        and tok_cell.val[0] == "'"
+        and tok_cell.val[-1] == "'"
+        and '"' not in tok_cell.val[1:-1]
+        and bool(NON_SYMBOL_STRING_RE.search(tok_cell.val[1:-1]))
+    )
+
+
+def _normalize_strings(row: TokenRow) -> None:
+    """Apply string quoting rules.
+
+    - Enforces quoting of "text" in double quotes
+    - Enforces quoting of 'symbols' in single quotes
+
+    Text/Data/Paths are considered to be anything which contains
+    whitespace, punctuation or non ascii characters.
+
+    Internal/Symbol/Atom strings are strings which are code as opposed
+    to data. They have no meaning outside of the context of the
+    program. Symbol strings must be valid python identifiers
+
+    They are:
+        - dictionary keys
+        - attribute names
+        - implicit enums
+    They are not:
+        - urls
+        - user readable text
+        - translation strings
+        - format strings
+
+    This function performs conversion only for a subset of cases,
+    since it cannot detect all. For symbols these cases are, strings
+    used as dictionary keys and for attribute access via getattr,
+    setattr, delattr.
+    """
+
+    if len(row) == 1 and row[0].typ == TokenType.NEWLINE:
+        return
+
+    # single quotes.
+    for col_index, tok_cell in enumerate(row):
+        if _is_dict_key_symbol_access(col_index, tok_cell, row):
+            normalized_token_val = row[col_index - 1].val.replace('"', "'")
+            row[col_index - 1] = Token(TokenType.BLOCK, normalized_token_val)
+
+        if _is_attr_symbol_access(col_index, tok_cell, row):
+            normalized_token_val = "'" + row[col_index + 5].val[1:-1] + "'"
+            row[col_index + 5] = Token(TokenType.BLOCK, normalized_token_val)
+
+    # double quotes.
+    for col_index, tok_cell in enumerate(row):
+        if _is_single_quoted_non_symbol(tok_cell):
+            normalized_token_val = '"' + tok_cell.val[1:-1] + '"'
+            row[col_index] = Token(TokenType.BLOCK, normalized_token_val)
+
+
+def _update_fmt_enabled(table: TokenTable, row_index: RowIndex, is_fmt_enabled: bool) -> bool:
+    if not table.has_token_typ(row_index, TokenType.COMMENT):
+        return is_fmt_enabled
+
+    for tok in table.row(row_index):
+        if tok.typ != TokenType.COMMENT:
+            continue
+
+        fmt_on_off_match = FMT_ON_OFF_RE.match(tok.val)
+        if fmt_on_off_match is None:
+            continue
+
+        if fmt_on_off_match.group(1) == 'on':
+            is_fmt_enabled = True
+        if fmt_on_off_match.group(1) == 'off':
+            is_fmt_enabled = False
+
+    return is_fmt_enabled
+
+
+def _iter_formattable_row_indexes(table: TokenTable) -> typ.Iterator[RowIndex]:
+    is_fmt_enabled = True
+    for row_index in range(table.first_row_idx, len(table)):
+        is_fmt_enabled = _update_fmt_enabled(table, row_index, is_fmt_enabled)
+        if is_fmt_enabled:
+            yield row_index
+
+
+def _iter_formattable_rows(table: TokenTable) -> typ.Iterator[typ.Tuple[RowIndex, TokenRow]]:
+    for row_index in _iter_formattable_row_indexes(table):
+        yield row_index, table.row(row_index)
+
+
+def _normalize_row_strings(table: TokenTable, row_index: RowIndex) -> None:
+    # only strings are normalized
+    if not table.has_token_typ(row_index, TokenType.BLOCK):
+        return
+
+    row            = table.row(row_index)
+    normalized_row = list(row)
+    _normalize_strings(normalized_row)
+    for col_index, token in enumerate(normalized_row):
+        if token is not row[col_index]:
+            table.set_token(row_index, col_index, token)
+
+
+def _row_alignment_context(
+    row_index: RowIndex, row: TokenRow, layouts: LayoutInternTable
+) -> AlignmentContext:
+    ctx: AlignmentContext = {}
+
+    is_multiline_row = any(token.typ != TokenType.NEWLINE and "\n" in token.val for token in row)
+    if is_multiline_row:
+        return ctx
+
+    layout: LayoutId = EMPTY_LAYOUT
+
+    for col_index, token in enumerate(row):
+        layout_token_val: TokenVal = ""
+
+        if token.typ in LAYOUT_VAL_TOKENS:
+            if token.typ == TokenType.INDENT:
+                layout_token_val = token.val
+            elif token.val in ALIGN_BEFORE_TOKENS:
+                layout_token_val = token.val
+            elif col_index > 0:
+                # Layout tokens such as ([{ don't cause alignment, to
+                # their preceding token, so line offset up to the
+                # column of those tokens can a be different. We only
+                # want to continue with alignment if the tokens are
+                # all at the same line offset.
+                layout_token_val = token.val + f"::{len(row[col_index - 1].val)}"
+
+        layout = _intern_layout(layouts, RowLayoutToken(layout, token.typ, layout_token_val))
+
+        if token.val in ALIGN_BEFORE_TOKENS:
+            assert token.typ == TokenType.SEPARATOR
+            prev_token = row[col_index - 1]
+            if prev_token.typ != TokenType.SEPARATOR:
+                offset_width = len(prev_token.val)
+                ctx_key      = AlignmentContextKey(col_index, row_index, token.typ, token.val, layout)
+                ctx[ctx_key] = offset_width
+
+    return ctx
+
+
+def _iter_alignment_contexts(table: TokenTable) -> typ.Iterator[AlignmentContext]:
+    layouts: LayoutInternTable = {}
+    for row_index, row in _iter_formattable_rows(table):
+        ctx = _row_alignment_context(row_index, row, layouts)
+        if ctx:
+            yield ctx
+
+
+# Identifies cells which can be aligned with the cell in the previous row.
+CellGroupKey = typ.Tuple[ColIndex, TokenVal, LayoutId]
+
+
+class CellGroupBuilder:
+    """Accumulate cell groups from the alignment contexts of each row.
+
+    Rows must be added in order. A group is extended in place by
+    appending the cell of each consecutive row. The open_groups only
+    reference the most recent group for each key, so each cell costs
+    O(1) and a run of N aligned rows costs O(N) rather than O(N^2).
+    """
+
+    def __init__(self) -> None:
+        self.open_groups: typ.Dict[CellGroupKey, typ.List[AlignmentCell]] = {}
+        self.groups     : typ.List[typ.Tuple[CellGroupKey, typ.List[AlignmentCell]]] = []
+
+    def add(self, ctx: AlignmentContext) -> bool:
+        """Add the cells of a row.
+
+        Returns True if any of the cells continued a group of the
+        previous row. If not, no group can span across this row.
+        """
+        is_continued = False
+        for ctx_key, offset_width in ctx.items():
+            col_index, row_index, _, token_val, layout = ctx_key
+            group_key = (col_index, token_val, layout)
+            curr_cell = AlignmentCell(row_index, offset_width)
+
+            cells = self.open_groups.get(group_key)
+            if cells and cells[-1].row_idx == row_index - 1:
+                cells.append(curr_cell)
+                is_continued = True
+            else:
+                cells = [curr_cell]
+                self.open_groups[group_key] = cells
+                self.groups.append((group_key, cells))
+        return is_continued
+
+    def pop_groups(self, end_row_idx: typ.Optional[RowIndex] = None) -> CellGroups:
+        """Remove and return the groups which end before end_row_idx.
+
+        These groups must be complete, ie. end_row_idx must be a row
+        for which add returned False (or None, after the last row).
+        """
+        cell_groups: CellGroups = {}
+        remaining_groups = []
+        for group_key, cells in self.groups:
+            last_row_idx = cells[-1].row_idx
+            if end_row_idx is None or last_row_idx < end_row_idx:
+                col_index, token_val, layout = group_key
+                cell_key = AlignmentCellKey(col_index, last_row_idx, token_val, layout)
+                cell_groups[cell_key] = cells
+            else:
+                remaining_groups.append((group_key, cells))
+
+        self.groups      = remaining_groups
+        self.open_groups = dict(remaining_groups)
+        return cell_groups
+
+
+def _find_cell_groups(alignment_contexts: typ.Iterable[AlignmentContext]) -> CellGroups:
+    builder = CellGroupBuilder()
+    for ctx in alignment_contexts:
+        builder.add(ctx)
+    return builder.pop_groups()
+
+
+def _is_last_sep_token(ctx_key: AlignmentCellKey, table: TokenTable, row_idx: RowIndex) -> bool:
+    return ctx_key.col_index >= table.last_content_col(row_idx)
+
+
+def _realign_cell_groups(
+    table: TokenTable, cell_groups: CellGroups, is_independent: bool = False
+) -> bool:
+    """Pad the cells of each cell group to the same width.
+
+    A cell group with prefixes of different length is not aligned. It
+    also stops the alignment of all cell groups which sort after it,
+    unless is_independent is set, in which case each cell group is
+    aligned independently of all others.
+
+    Returns True if there was a cell group with prefixes of different
+    length.
+    """
+    has_mixed_prefixes = False
+    for ctx_key, cells in sorted(cell_groups.items()):
+        if len(cells) <= 1:
+            continue
+
+        col_idx = ctx_key.col_index - 1
+
+        max_offset_width = max(cell.offset_width for cell in cells)
+
+        cell_tokens = [
+            (cell, table.token(cell.row_idx, col_idx))
+            for cell in cells
+            if col_idx < table.row_len(cell.row_idx)
+        ]
+
+        is_numeric_cell_group = True
+        all_prefix_lens       = set()
+        for cell, token in cell_tokens:
+            maybe_number = token.val.strip().replace('_', "")
+            if not maybe_number.isdigit():
+                is_numeric_cell_group = False
+
+            all_prefix_lens.add(table.col_offset(cell.row_idx, col_idx))
+
+        if len(all_prefix_lens) > 1:
+            # don't align cell groups with prefixes of different length
+            has_mixed_prefixes = True
+            if is_independent:
+                continue
+            else:
+                break
+
+        for cell, token in cell_tokens:
+            extra_offset = max_offset_width - cell.offset_width
+            if extra_offset == 0:
+                continue
+
+            if is_numeric_cell_group:
+                padded_token_val = " " * extra_offset + token.val
+            elif _is_last_sep_token(ctx_key, table, cell.row_idx):
+                # don't align if this is the last token of the row
+                continue
+            else:
+                padded_token_val = token.val + " " * extra_offset
+
+            padded_token = Token(TokenType.CODE, padded_token_val)
+            table.set_token(cell.row_idx, col_idx, padded_token)
+
+    return has_mixed_prefixes
+
+
+def _realigned_contents(table: TokenTable, cell_groups: CellGroups) -> str:
+    _realign_cell_groups(table, cell_groups)
+    return table.contents()
+
+
+def _align_formatted_str(
+    src_contents: str, recorder: stats.Recorder
+) -> typ.Tuple[FileContent, bool]:
+    with recorder.timer('tokenize'):
+        table = TokenTable(src_contents)
+
+    with recorder.timer('normalize'):
+        for row_index in _iter_formattable_row_indexes(table):
+            _normalize_row_strings(table, row_index)
+
+    with recorder.timer('contexts'):
+        alignment_contexts    : typ.Iterable[AlignmentContext] = _iter_alignment_contexts(table)
+        if recorder.is_enabled:
+            # Only materialized to time the stages separately, otherwise
+            # the contexts are consumed lazily.
+            alignment_contexts = list(alignment_contexts)
+
+    with recorder.timer('cell_groups'):
+        cell_groups = _find_cell_groups(alignment_contexts)
+
+    with recorder.timer('realign'):
+        has_mixed_prefixes = _realign_cell_groups(table, cell_groups)
+        dst_contents       = table.contents()
+
+    if recorder.is_enabled:
+        aligned_groups = [cells for cells in cell_groups.values() if len(cells) > 1]
+        recorder.count('rows', len(table))
+        recorder.count('tokens', len(table.typs))
+        recorder.count('cell_groups', len(aligned_groups))
+        recorder.count('aligned_cells', sum(map(len, aligned_groups)))
+    return (dst_contents, has_mixed_prefixes)
+
+
+def align_formatted_str(
+    src_contents: str, recorder: typ.Optional[stats.Recorder] = None
+) -> FileContent:
+    """Align code which has been formatted by black.
+
+    The timings of each stage and counts are collected by the
+    recorder (if any).
+    """
+    if recorder is None:
+        recorder = stats.NULL_RECORDER
+    dst_contents, _ = _align_formatted_str(src_contents, recorder)
+    return dst_contents
+
+
+# Minimum number of characters to tokenize at once by align_formatted_iter
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def align_formatted_iter(lines: typ.Iterable[str]) -> typ.Iterator[FileContent]:
+    """Align formatted code which is read incrementally.
+
+    Chunks of aligned rows are yielded as soon as no open cell group
+    can reach them. Since cell groups only span consecutive rows,
+    memory usage is bounded by the longest cell group (or multiline
+    string) rather than by the size of the input.
+
+    The result can differ from align_formatted_str: each cell group is
+    aligned independently, while align_formatted_str stops aligning
+    at the first cell group with prefixes of different length (which
+    may be anywhere in the file). For files without such a cell group,
+    the result is the same.
+    """
+    table   = TokenTable()
+    builder = CellGroupBuilder()
+    layouts: LayoutInternTable = {}
+
+    is_fmt_enabled = True
+    next_row_idx   = 0
+
+    def _process_rows(end_row_idx: RowIndex) -> typ.Iterator[FileContent]:
+        nonlocal is_fmt_enabled, next_row_idx
+
+        for row_index in range(next_row_idx, end_row_idx):
+            ctx: AlignmentContext = {}
+
+            is_fmt_enabled = _update_fmt_enabled(table, row_index, is_fmt_enabled)
+            if is_fmt_enabled:
+                _normalize_row_strings(table, row_index)
+                ctx = _row_alignment_context(row_index, table.row(row_index), layouts)
+
+            if not builder.add(ctx) and row_index > table.first_row_idx:
+                # All rows before row_index are final
+                _realign_cell_groups(table, builder.pop_groups(row_index), is_independent=True)
+                yield table.contents(row_index)
+                table.drop_rows(row_index)
+
+        next_row_idx = end_row_idx
+
+    chunks        : typ.List[str] = []
+    chunks_len    : int = 0
+    min_chunks_len: int = STREAM_CHUNK_SIZE
+
+    for line in lines:
+        chunks.append(line)
+        chunks_len += len(line)
+        if chunks_len < min_chunks_len:
+            continue
+
+        chunk    = "".join(chunks)
+        consumed = table.extend(chunk, is_final=False)
+        rest     = chunk[consumed:]
+
+        chunks     = [rest] if rest else []
+        chunks_len = len(rest)
+        # If rest is an incomplete multiline string, wait for at least
+        # as much content again before the next attempt.
+        min_chunks_len = max(STREAM_CHUNK_SIZE, len(rest) * 2)
+
+        # The last row is incomplete and not processed until more
+        # content is available.
+        yield from _process_rows(len(table) - 1)
+
+    table.extend("".join(chunks), is_final=True)
+    yield from _process_rows(len(table))
+
+    _realign_cell_groups(table, builder.pop_groups(), is_independent=True)
+    yield table.contents()
+
+
+# First and last row of a range (1 based and inclusive, as for --line-ranges)
+LineRange = typ.Tuple[int, int]
+
+# Start and end offset of a contiguous region of rows
+Region = typ.Tuple[TokenOffset, TokenOffset]
+
+BLOCK_START_RE = re.compile(r"'''|\"\"\"|\"|'|\#")
+
+
+class BlockScan(typ.NamedTuple):
+    """Offsets of comments and strings, without tokenizing anything else."""
+
+    starts     : typ.List[TokenOffset]
+    ends       : typ.List[TokenOffset]
+    fmt_toggles: typ.List[typ.Tuple[TokenOffset, bool]]
+
+    def is_in_block(self, pos: TokenOffset) -> bool:
+        block_idx = bisect.bisect_left(self.starts, pos) - 1
+        return block_idx >= 0 and self.ends[block_idx] > pos
+
+    def is_fmt_enabled(self, pos: TokenOffset) -> bool:
+        is_enabled = True
+        for toggle_pos, is_toggle_enabled in self.fmt_toggles:
+            if toggle_pos >= pos:
+                break
+            is_enabled = is_toggle_enabled
+        return is_enabled
+
+
+def _scan_blocks(src_contents: str) -> BlockScan:
+    # Comments and strings are found the same way as by
+    # _iter_token_spans, but everything in between is skipped with a
+    # single search. This is enough to know where a row may start and
+    # whether "# fmt: off" is in effect.
+    scan = BlockScan([], [], [])
+    pos  = 0
+    while True:
+        block_start_match = BLOCK_START_RE.search(src_contents, pos)
+        if block_start_match is None:
+            return scan
+
+        start, block_start_end = block_start_match.span()
+        token_val       = block_start_match.group(0)
+        block_end_match = NO_ALIGN_BLOCK_END_MATCHERS[token_val].search(
+            src_contents, block_start_end
+        )
+        end = len(src_contents) if block_end_match is None else block_end_match.end()
+
+        scan.starts.append(start)
+        scan.ends.append(end)
+        if token_val == "#":
+            fmt_on_off_match = FMT_ON_OFF_RE.match(src_contents, start, end)
+            if fmt_on_off_match:
+                scan.fmt_toggles.append((start, fmt_on_off_match.group(1) == 'on'))
+        pos = end
+
+
+def _row_offsets(src_contents: str) -> typ.List[TokenOffset]:
+    offsets = [0]
+    pos     = src_contents.find("\n")
+    while pos >= 0:
+        offsets.append(pos + 1)
+        pos = src_contents.find("\n", pos + 1)
+    return offsets
+
+
+def _is_region_boundary(
+    src_contents: str, scan: BlockScan, offsets: typ.List[TokenOffset], line_idx: int
+) -> bool:
+    # Cell groups only span consecutive rows which have cells, so
+    # an empty row (outside of a string) separates independent regions.
+    pos = offsets[line_idx]
+    return src_contents.startswith("\n", pos) and not scan.is_in_block(pos)
+
+
+def _iter_regions(
+    src_contents: str, scan: BlockScan, line_ranges: typ.Iterable[LineRange]
+) -> typ.Iterator[typ.Tuple[Region, typ.List[Region]]]:
+    """Regions which can be aligned independently of the rest of src_contents.
+
+    Each region is yielded together with the ranges (as offsets) it
+    contains.
+    """
+    offsets   = _row_offsets(src_contents)
+    num_lines = len(offsets)
+
+    regions: typ.List[typ.Tuple[int, int, typ.List[Region]]] = []
+    for first, last in sorted(line_ranges):
+        if not 1 <= first <= last:
+            raise ValueError(f"Invalid line range: {first}-{last}")
+        if first > num_lines:
+            continue
+
+        first_line_idx = first - 1
+        last_line_idx  = min(last, num_lines) - 1
+        range_end      = offsets[last] if last < num_lines else len(src_contents)
+        range_region   = (offsets[first_line_idx], range_end)
+
+        start_line_idx = first_line_idx
+        while start_line_idx > 0:
+            if _is_region_boundary(src_contents, scan, offsets, start_line_idx):
+                break
+            start_line_idx -= 1
+
+        end_line_idx = last_line_idx
+        while end_line_idx < num_lines - 1:
+            if _is_region_boundary(src_contents, scan, offsets, end_line_idx):
+                break
+            end_line_idx += 1
+
+        if regions and start_line_idx <= regions[-1][1]:
+            prev_start_line_idx, prev_end_line_idx, prev_ranges = regions.pop()
+            start_line_idx = prev_start_line_idx
+            end_line_idx   = max(end_line_idx, prev_end_line_idx)
+            range_regions  = prev_ranges + [range_region]
+        else:
+            range_regions = [range_region]
+        regions.append((start_line_idx, end_line_idx, range_regions))
+
+    for start_line_idx, end_line_idx, range_regions in regions:
+        if end_line_idx + 1 < num_lines:
+            end = offsets[end_line_idx + 1]
+        else:
+            end = len(src_contents)
+        yield ((offsets[start_line_idx], end), range_regions)
+
+
+def _align_region(
+    region_contents: str, is_fmt_enabled: bool, range_regions: typ.List[Region]
+) -> typ.Tuple[FileContent, bool]:
+    table   = TokenTable(region_contents)
+    builder = CellGroupBuilder()
+    layouts: LayoutInternTable = {}
+
+    range_row_idxs = set()
+    for row_index in range(len(table)):
+        row_start = table._row_pos(row_index)
+        row_end   = table._row_pos(row_index + 1)
+        if any(
+            row_start < range_end and range_start < row_end
+            for range_start, range_end in range_regions
+        ):
+            range_row_idxs.add(row_index)
+
+    for row_index in range(len(table)):
+        ctx: AlignmentContext = {}
+
+        is_fmt_enabled = _update_fmt_enabled(table, row_index, is_fmt_enabled)
+        if is_fmt_enabled:
+            # strings outside of the ranges are left untouched
+            if row_index in range_row_idxs:
+                _normalize_row_strings(table, row_index)
+            ctx = _row_alignment_context(row_index, table.row(row_index), layouts)
+        builder.add(ctx)
+
+    cell_groups = {
+        cell_key: cells
+        for cell_key, cells in builder.pop_groups().items()
+        if any(cell.row_idx in range_row_idxs for cell in cells)
+    }
+    has_mixed_prefixes = _realign_cell_groups(table, cell_groups, is_independent=True)
+    return (table.contents(), has_mixed_prefixes)
+
+
+def align_formatted_ranges(src_contents: str, line_ranges: typ.Iterable[LineRange]) -> FileContent:
+    """Align only the cell groups which intersect with line_ranges.
+
+    All other rows are left untouched. Only the regions around the
+    line_ranges (up to the next empty row) are tokenized. As with
+    align_formatted_iter, each cell group is aligned independently,
+    so the result can differ from align_formatted_str.
+
+    >>> src = "a = 1\\nbb = 2\\n\\nc = 3\\ndd = 4\\n"
+    >>> print(align_formatted_ranges(src, [(4, 4)]), end="")
+    a = 1
+    bb = 2
+    <BLANKLINE>
+    c  = 3
+    dd = 4
+    """
+    scan  = _scan_blocks(src_contents)
+    parts = []
+    pos   = 0
+    for (start, end), range_regions in _iter_regions(src_contents, scan, line_ranges):
+        region_ranges = [
+            (range_start - start, range_end - start) for range_start, range_end in range_regions
+        ]
+        region_contents, _ = _align_region(
+            src_contents[start:end], scan.is_fmt_enabled(start), region_ranges
+        )
+        parts.append(src_contents[pos:start])
+        parts.append(region_contents)
+        pos = end
+    parts.append(src_contents[pos:])
+    return "".join(parts)
+
+
+def _split_rows(src_contents: str) -> typ.List[str]:
+    offsets = _row_offsets(src_contents)
+    ends    = offsets[1:] + [len(src_contents)]
+    return [src_contents[start:end] for start, end in zip(offsets, ends)]
+
+
+# Changes to rows with these can affect the tokenization or the
+# "fmt: off" state of all following rows.
+NON_LOCAL_CHANGE_MARKERS = ('"""', "'''", "fmt:", "\\\n")
+
+# Above this number of changed rows, the document is aligned completely,
+# instead of diffing the rows with the previous version.
+MAX_DIFF_ROWS = 500
+
+
+class DocumentAligner:
+    """Align successive versions of a document (eg. an editor buffer).
+
+    The rows of the previous version and their aligned result are
+    kept. Only the regions (see _iter_regions) with rows which were
+    changed are aligned again, the aligned rows of all other regions
+    are reused. The result is the same as for align_formatted_str.
+
+    Regions can only be aligned separately if the document has no
+    cell group with prefixes of different length, since such a cell
+    group stops the alignment of the rest of the document. Otherwise
+    the whole document is aligned again.
+    """
+
+    src_rows          : typ.List[str]
+    dst_rows          : typ.List[str]
+    has_mixed_prefixes: bool
+
+    def __init__(self) -> None:
+        self.src_rows           = []
+        self.dst_rows           = []
+        self.has_mixed_prefixes = False
+
+    def _changed_ranges(
+        self, src_rows: typ.List[str]
+    ) -> typ.Tuple[typ.List[LineRange], typ.List[typ.Optional[int]]]:
+        """Ranges of changed rows and the previous index of each unchanged row.
+
+        Raises ValueError if the changes are not local or if there are
+        too many of them.
+        """
+        import difflib
+
+        prev_rows = self.src_rows
+
+        # Diffing all rows is superlinear, but usually only a few rows
+        # in the middle of a document are changed. The unchanged prefix
+        # and suffix are trimmed in linear time and only the rows in
+        # between are diffed.
+        max_common = min(len(prev_rows), len(src_rows))
+        prefix_len = 0
+        while prefix_len < max_common and prev_rows[prefix_len] == src_rows[prefix_len]:
+            prefix_len += 1
+
+        suffix_len = 0
+        max_suffix = max_common - prefix_len
+        while suffix_len < max_suffix and prev_rows[-1 - suffix_len] == src_rows[-1 - suffix_len]:
+            suffix_len += 1
+
+        prev_end = len(prev_rows) - suffix_len
+        end      = len(src_rows) - suffix_len
+        if max(prev_end, end) - prefix_len > MAX_DIFF_ROWS:
+            raise ValueError("Too many changes")
+
+        prev_idxs: typ.List[typ.Optional[int]] = [None] * len(src_rows)
+        prev_idxs[:prefix_len] = range(prefix_len)
+        prev_idxs[end:] = range(prev_end, len(prev_rows))
+
+        matcher = difflib.SequenceMatcher(
+            None, prev_rows[prefix_len:prev_end], src_rows[prefix_len:end], autojunk=False
+        )
+        ranges = []
+        for tag, prev_start, prev_stop, start, stop in matcher.get_opcodes():
+            prev_start += prefix_len
+            prev_stop  += prefix_len
+            start      += prefix_len
+            stop       += prefix_len
+            if tag == 'equal':
+                prev_idxs[start:stop] = range(prev_start, prev_stop)
+                continue
+
+            changed_rows = prev_rows[prev_start:prev_stop] + src_rows[start:stop]
+            for row in changed_rows:
+                if any(marker in row for marker in NON_LOCAL_CHANGE_MARKERS):
+                    raise ValueError("Non local change")
+
+            # The rows before and after are included, since an (added or
+            # removed) empty row splits or joins the regions around it.
+            ranges.append((max(start, 1), min(stop + 1, len(src_rows))))
+        return (ranges, prev_idxs)
+
+    def _aligned_rows(self, src_contents: str, src_rows: typ.List[str]) -> typ.List[str]:
+        """Aligned rows, reusing the rows of unchanged regions.
+
+        Raises ValueError if the changed regions can't be aligned
+        separately.
+        """
+        if not (self.src_rows and src_rows):
+            raise ValueError("No previous version")
+        if self.has_mixed_prefixes:
+            raise ValueError("Mixed prefix lengths")
+
+        line_ranges, prev_idxs = self._changed_ranges(src_rows)
+
+        scan      = _scan_blocks(src_contents)
+        offsets   = _row_offsets(src_contents)
+        dst_rows  = []
+        row_index = 0
+        for (start, end), _ in _iter_regions(src_contents, scan, line_ranges):
+            start_row_index = bisect.bisect_left(offsets, start)
+            if end < len(src_contents):
+                end_row_index = bisect.bisect_left(offsets, end)
+            else:
+                end_row_index = len(src_rows)
+
+            for unchanged_row_index in range(row_index, start_row_index):
+                dst_rows.append(self.dst_rows[typ.cast(int, prev_idxs[unchanged_row_index])])
+
+            region_contents = src_contents[start:end]
+            region_ranges   = [(0, len(region_contents))]
+            region_contents, has_mixed_prefixes = _align_region(
+                region_contents, scan.is_fmt_enabled(start), region_ranges
+            )
+            if has_mixed_prefixes:
+                raise ValueError("Mixed prefix lengths")
+
+            dst_rows.extend(_split_rows(region_contents)[: end_row_index - start_row_index])
+            row_index = end_row_index
+
+        for unchanged_row_index in range(row_index, len(src_rows)):
+            dst_rows.append(self.dst_rows[typ.cast(int, prev_idxs[unchanged_row_index])])
+        return dst_rows
+
+    def align(self, src_contents: str) -> FileContent:
+        src_rows = _split_rows(src_contents)
+        try:
+            dst_rows = self._aligned_rows(src_contents, src_rows)
+        except ValueError:
+            dst_contents, self.has_mixed_prefixes = _align_formatted_str(
+                src_contents, stats.NULL_RECORDER
+            )
+            dst_rows = _split_rows(dst_contents)
+
+        self.src_rows = src_rows
+        self.dst_rows = dst_rows
+        return "".join(dst_rows)
+
+
+def _assert_equivalent(src_contents: str, dst_contents: str) -> None:
+    # This is a cheaper version of black.assert_equivalent. Since
+    # alignment only changes whitespace and quotes, the ast (which has
+    # no positions in its dump) must be exactly the same.
+    import ast
+
+    src_ast_dump = ast.dump(ast.parse(src_contents))
+    dst_ast_dump = ast.dump(ast.parse(dst_contents))
+    if src_ast_dump != dst_ast_dump:
+        raise AssertionError(
+            "INTERNAL ERROR: Alignment produced code that is not equivalent to the source."
+        )
+
+
+def align_only(
+    path_or_str: typ.Union[pl.Path, str],
+    line_ranges: typ.Optional[typ.Sequence[LineRange]] = None,
+) -> FileContent:
+    """Align code which has already been formatted by black.
+
+    The argument is either the path to a file or the source code
+    itself. Only the alignment pass is performed, black is not even
+    imported. The result is checked to parse to the same ast as the
+    source. If line_ranges are given, only the cell groups which
+    intersect with them are aligned.
+    """
+    if isinstance(path_or_str, pl.Path):
+        src_contents, _, _ = sources.read_source(path_or_str)
+    else:
+        src_contents = path_or_str
+
+    if line_ranges is None:
+        dst_contents = align_formatted_str(src_contents)
+    else:
+        dst_contents = align_formatted_ranges(src_contents, line_ranges)
+    if dst_contents != src_contents:
+        _assert_equivalent(src_contents, dst_contents)
+    return dst_contents
+
+
+def _align_only_file(
+    path: pl.Path, is_check: bool, line_ranges: typ.Optional[typ.Sequence[LineRange]] = None
+) -> bool:
+    src_contents, encoding, newline = sources.read_source(path)
+
+    dst_contents = align_only(src_contents, line_ranges)
+    if dst_contents == src_contents:
+        return False
+
+    if not is_check:
+        sources.write_source(path, dst_contents, encoding, newline)
+    return True
+
+
+def _parse_line_range(arg: str) -> LineRange:
+    first, sep, last = arg.partition("-")
+    if not (sep and first.isdigit() and last.isdigit() and 1 <= int(first) <= int(last)):
+        raise ValueError(f"Invalid line range: {arg}")
+    return (int(first), int(last))
+
+
+def _git(*args: str) -> str:
+    import subprocess as sp
+
+    result = sp.run(["git", *args], stdout=sp.PIPE, stderr=sp.PIPE)
+    if result.returncode != 0:
+        raise OSError(result.stderr.decode("utf-8", errors="replace").strip())
+    return result.stdout.decode("utf-8")
+
+
+def _git_changed_paths(ref: str) -> typ.List[str]:
+    """Paths of python files which changed relative to ref (or are untracked)."""
+    changed   = _git("diff", "--name-only", "--relative", "--diff-filter=d", ref)
+    untracked = _git("ls-files", "--others", "--exclude-standard")
+    paths     = changed.splitlines() + untracked.splitlines()
+    return [path for path in paths if path.endswith((".py", ".pyi"))]
+
+
+HUNK_HEADER_RE = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", flags=re.MULTILINE)
+
+
+def _git_changed_ranges(path: pl.Path, ref: str) -> typ.Optional[typ.List[LineRange]]:
+    """Ranges of lines which changed relative to ref (None if path is untracked)."""
+    if not _git("ls-files", "--", str(path)).strip():
+        return None
+
+    line_ranges = []
+    diff_output = _git("diff", "--no-color", "--no-ext-diff", "-U0", ref, "--", str(path))
+    for hunk_match in HUNK_HEADER_RE.finditer(diff_output):
+        first = int(hunk_match.group(1))
+        count = int(hunk_match.group(2) or "1")
+        if count == 0:
+            # lines were removed after first, which makes the rows
+            # before and after the removed lines adjacent
+            line_ranges.append((max(first, 1), first + 1))
+        else:
+            line_ranges.append((first, first + count - 1))
+    return line_ranges
+
+
+def _arg_parser() -> typ.Any:
+    # argparse rather than click, to keep the startup time low. Options
+    # of black which only affect the black formatting pass are accepted
+    # and ignored, so that --align-only can simply be added to an
+    # existing sjfmt command.
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="sjfmt --align-only",
+        description="Align code which has already been formatted by black.",
+    )
+    parser.add_argument('--align-only', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help="Don't write the files back, just return the status.",
+    )
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't emit non-error messages.")
+    parser.add_argument('-l', '--line-length', help=argparse.SUPPRESS)
+    parser.add_argument('-t', '--target-version', action='append', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '-S', '--skip-string-normalization', action='store_true', help=argparse.SUPPRESS
+    )
+    parser.add_argument('--pyi', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--fast', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--safe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--line-ranges',
+        action='append',
+        metavar="START-END",
+        help=(
+            "Only align the cell groups which intersect with these lines"
+            " (1 based and inclusive, can be given multiple times)."
+        ),
+    )
+    parser.add_argument(
+        '--git-changed',
+        nargs="?",
+        const="HEAD",
+        metavar="REF",
+        help=(
+            "Only align the cell groups which intersect with lines that"
+            " changed relative to REF (by default HEAD), according to git diff."
+            " Without SRC, all changed files are aligned."
+        ),
+    )
+    sources.add_arguments(parser)
+    parser.add_argument('src', nargs="*", help="Files or directories to align, - for stdin.")
+    return parser
+
+
+def _parse_args(
+    parser: typ.Any, args: typ.Optional[typ.Sequence[str]]
+) -> typ.Tuple[typ.Any, typ.Optional[typ.List[LineRange]]]:
+    """Parse and validate args, return (opts, line_ranges).
+
+    Without SRC, opts.src are the files changed according to git.
+    """
+    opts = parser.parse_args(args)
+
+    line_ranges: typ.Optional[typ.List[LineRange]] = None
+
+    if opts.line_ranges:
+        if opts.git_changed:
+            parser.error("--line-ranges and --git-changed cannot be used together")
+        if len(opts.src) != 1 or pl.Path(opts.src[0]).is_dir():
+            parser.error("--line-ranges requires a single file")
+        try:
+            line_ranges = [_parse_line_range(arg) for arg in opts.line_ranges]
+        except ValueError as ex:
+            parser.error(str(ex))
+
+    if opts.git_changed and opts.src == ['-']:
+        parser.error("--git-changed cannot be used with stdin")
+
+    if not opts.src:
+        if not opts.git_changed:
+            parser.error("the following arguments are required: src")
+        try:
+            opts.src = _git_changed_paths(opts.git_changed)
+        except OSError as ex:
+            print(f"error: git diff failed: {ex}", file=sys.stderr)
+            sys.exit(123)
+
+    return (opts, line_ranges)
+
+
+def _align_only_stdin(check: bool, line_ranges: typ.Optional[typ.List[LineRange]]) -> None:
+    src_contents = sys.stdin.read()
+    try:
+        dst_contents = align_only(src_contents, line_ranges)
+    except (SyntaxError, AssertionError) as ex:
+        print(f"error: cannot format -: {ex}", file=sys.stderr)
+        sys.exit(123)
+
+    if not check:
+        sys.stdout.write(dst_contents)
+    sys.exit(int(check and dst_contents != src_contents))
+
+
+def _align_only_paths(
+    paths: typ.Iterable[pl.Path], opts: typ.Any, line_ranges: typ.Optional[typ.List[LineRange]]
+) -> typ.Tuple[int, int]:
+    """Align the files at paths, return (changed_count, error_count)."""
+    changed_count = 0
+    error_count   = 0
+
+    for path in paths:
+        try:
+            if opts.git_changed:
+                line_ranges = _git_changed_ranges(path, opts.git_changed)
+                if line_ranges == []:
+                    continue
+            is_changed = _align_only_file(path, opts.check, line_ranges)
+        except (OSError, UnicodeDecodeError, SyntaxError, AssertionError) as ex:
+            error_count += 1
+            print(f"error: cannot format {path}: {ex}", file=sys.stderr)
+            continue
+
+        if is_changed:
+            changed_count += 1
+            if not opts.quiet:
+                verb = "would reformat" if opts.check else "reformatted"
+                print(f"{verb} {path}", file=sys.stderr)
+
+    return (changed_count, error_count)
+
+
+def main(args: typ.Optional[typ.Sequence[str]] = None) -> None:
+    """Command line interface for sjfmt --align-only."""
+    parser            = _arg_parser()
+    opts, line_ranges = _parse_args(parser, args)
+
+    if opts.src == ['-']:
+        _align_only_stdin(opts.check, line_ranges)
+
+    try:
+        src_filter = sources.source_filter(
+            opts.src,
+            include=opts.include,
+            exclude=opts.exclude,
+            extend_exclude=opts.extend_exclude,
+            force_exclude=opts.force_exclude,
+            config=opts.config,
+        )
+    except (OSError, ValueError) as ex:
+        parser.error(str(ex))
+
+    paths                      = sources.iter_paths(opts.src, src_filter)
+    changed_count, error_count = _align_only_paths(paths, opts, line_ranges)
+
+    if error_count:
+        sys.exit(123)
+    elif opts.check and changed_count:
+        sys.exit(1)
+    else:
+        sys.exit(0)
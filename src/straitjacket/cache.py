@@ -0,0 +1,192 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Persistent cache of formatting results.
+
+Entries are keyed by a hash of the input and everything that can
+affect the output (black/sjfmt version, effective mode), so they never
+have to be invalidated, only evicted. Eviction is least recently
+used, based on the mtime of the entries, which is updated on access.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+import typing as typ
+import pathlib as pl
+
+CacheKey = str
+
+# Eviction requires a scan of the cache directory. To not do this for
+# every new entry, the cache is shrunk to EVICTION_RATIO * max_size
+# whenever it exceeds max_size.
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+EVICTION_RATIO   = 0.8
+
+CacheEntry = typ.Tuple[float, int, pl.Path]
+
+
+def default_cache_dir() -> pl.Path:
+    env_cache_dir = os.environ.get('SJFMT_CACHE_DIR')
+    if env_cache_dir:
+        return pl.Path(env_cache_dir)
+
+    import platformdirs
+
+    return pl.Path(platformdirs.user_cache_dir("straitjacket"))
+
+
+def default_max_size() -> int:
+    env_max_size = os.environ.get('SJFMT_CACHE_MAX_SIZE')
+    if env_max_size:
+        return int(env_max_size)
+    else:
+        return DEFAULT_MAX_SIZE
+
+
+def cache_key(src_contents: str, *key_parts: str) -> CacheKey:
+    """Hash of src_contents and key_parts (eg. version and mode)."""
+    digest = hashlib.sha256()
+    for part in key_parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(src_contents.encode("utf-8", "surrogatepass"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Size bounded on-disk cache, safe to share between processes.
+
+    Entries are written atomically and a concurrently evicted entry
+    is simply a cache miss. Instances can be shared between threads.
+    """
+
+    cache_dir  : pl.Path
+    max_size   : int
+    _total_size: typ.Optional[int]
+    _lock      : threading.Lock
+
+    def __init__(self, cache_dir: pl.Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self.cache_dir   = cache_dir
+        self.max_size    = max_size
+        self._total_size = None
+        self._lock       = threading.Lock()
+
+    def _entry_path(self, key: CacheKey) -> pl.Path:
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key: CacheKey) -> typ.Optional[str]:
+        path = self._entry_path(key)
+        try:
+            data = path.read_bytes()
+            # update mtime for lru eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return data.decode("utf-8", "surrogatepass")
+
+    def put(self, key: CacheKey, contents: str) -> None:
+        data = contents.encode("utf-8", "surrogatepass")
+        if len(data) > self.max_size * EVICTION_RATIO:
+            return
+
+        path = self._entry_path(key)
+        try:
+            # an existing entry for the same key is replaced
+            old_size = path.stat().st_size
+        except OSError:
+            old_size = 0
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as fobj:
+                fobj.write(data)
+            os.replace(fobj.name, path)
+        except OSError:
+            # A read-only or full disk is not a reason to fail
+            # formatting, the cache is just disabled.
+            return
+
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = sum(size for _, size, _ in self._iter_entries())
+            else:
+                self._total_size += len(data) - old_size
+
+            if self._total_size > self.max_size:
+                self._evict(int(self.max_size * EVICTION_RATIO))
+
+    def _iter_entries(self) -> typ.Iterator[CacheEntry]:
+        if not self.cache_dir.exists():
+            return
+
+        for path in self.cache_dir.glob("??/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield (stat.st_mtime, stat.st_size, path)
+
+    def evict(self, target_size: typ.Optional[int] = None) -> int:
+        """Remove least recently used entries until target_size is reached.
+
+        Returns the number of removed entries.
+        """
+        if target_size is None:
+            target_size = int(self.max_size * EVICTION_RATIO)
+
+        with self._lock:
+            return self._evict(target_size)
+
+    def _evict(self, target_size: int) -> int:
+        entries    = sorted(self._iter_entries())
+        total_size = sum(size for _, size, _ in entries)
+
+        removed_count = 0
+        for _, size, path in entries:
+            if total_size <= target_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total_size -= size
+            removed_count += 1
+
+        self._total_size = total_size
+        return removed_count
+
+
+# The output of black is cached separately from the final (aligned)
+# result. When only the alignment changes between releases of sjfmt, the
+# (expensive) black pass can be skipped and only the alignment is done
+# again.
+CACHE_TIERS = ('black', 'results')
+
+_caches: typ.Dict[str, ResultCache] = {}
+
+
+def get_cache(tier: str) -> typ.Optional[ResultCache]:
+    """Cache for one of CACHE_TIERS (None if disabled via SJFMT_CACHE_MAX_SIZE=0).
+
+    The SJFMT_CACHE_MAX_SIZE is split evenly between the tiers.
+    """
+    assert tier in CACHE_TIERS
+
+    max_size = default_max_size() // len(CACHE_TIERS)
+    if max_size <= 0:
+        return None
+
+    cache_dir  = default_cache_dir() / tier
+    tier_cache = _caches.get(tier)
+    is_stale   = (
+        tier_cache is None or tier_cache.cache_dir != cache_dir or tier_cache.max_size != max_size
+    )
+    if is_stale:
+        tier_cache = _caches[tier] = ResultCache(cache_dir, max_size)
+    return tier_cache
@@ -0,0 +1,470 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Client for sjfmtd, via tcp or a unix domain socket.
+
+This only uses the standard library, so that it is cheap to import,
+which is what makes `sjfmt --server` faster than sjfmt for single files.
+"""
+
+import os
+import sys
+import json
+import socket
+import typing as typ
+import pathlib as pl
+import http.client
+
+from straitjacket import edits
+from straitjacket import sources
+
+DEFAULT_HOST    = "localhost"
+DEFAULT_PORT    = 45484
+DEFAULT_TIMEOUT = 30.0
+
+# Files are sent to /batch in requests of at most this many bytes
+# (unless a single file is larger), which is below the default limit for
+# request bodies of aiohttp (and of sjfmtd).
+DEFAULT_MAX_BATCH_SIZE = 1024 * 1024
+
+# Request headers of blackd
+LINE_LENGTH_HEADER               = "X-Line-Length"
+PYTHON_VARIANT_HEADER            = "X-Python-Variant"
+SKIP_STRING_NORMALIZATION_HEADER = "X-Skip-String-Normalization"
+SKIP_MAGIC_TRAILING_COMMA        = "X-Skip-Magic-Trailing-Comma"
+FAST_OR_SAFE_HEADER              = "X-Fast-Or-Safe"
+
+# Request header of sjfmtd
+EDITS_HEADER = "X-Edits"
+
+DOCUMENT_ID_HEADER = "X-Document-Id"
+
+Headers     = typ.Dict[str, str]
+BatchResult = typ.Dict[str, typ.Any]
+
+
+class ClientError(Exception):
+    """Error response of sjfmtd, eg. for invalid input."""
+
+    status: int
+    text  : str
+
+    def __init__(self, status: int, text: str) -> None:
+        self.status = status
+        self.text   = text
+        super().__init__(f"sjfmtd error {status}: {text}")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = DEFAULT_TIMEOUT) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def mode_headers(
+    line_length              : typ.Optional[int] = None,
+    is_pyi                   : bool = False,
+    target_versions          : typ.Sequence[str] = (),
+    skip_string_normalization: bool = False,
+    skip_magic_trailing_comma: bool = False,
+    is_fast                  : bool = False,
+) -> Headers:
+    """Request headers for the options of black/sjfmt.
+
+    >>> mode_headers(line_length=100, target_versions=["py36", "py37"])
+    {'X-Line-Length': '100', 'X-Python-Variant': 'py36,py37'}
+    """
+    headers: Headers = {}
+    if line_length is not None:
+        headers[LINE_LENGTH_HEADER] = str(line_length)
+    if is_pyi:
+        headers[PYTHON_VARIANT_HEADER] = "pyi"
+    elif target_versions:
+        headers[PYTHON_VARIANT_HEADER] = ",".join(target_versions)
+    if skip_string_normalization:
+        headers[SKIP_STRING_NORMALIZATION_HEADER] = "1"
+    if skip_magic_trailing_comma:
+        headers[SKIP_MAGIC_TRAILING_COMMA] = "1"
+    if is_fast:
+        headers[FAST_OR_SAFE_HEADER] = "fast"
+    return headers
+
+
+class Client:
+    """Connection to sjfmtd, which is kept alive between requests."""
+
+    def __init__(
+        self,
+        socket_path   : typ.Optional[str] = None,
+        host          : str = DEFAULT_HOST,
+        port          : int = DEFAULT_PORT,
+        timeout       : float = DEFAULT_TIMEOUT,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+    ) -> None:
+        self.socket_path    = socket_path
+        self.host           = host
+        self.port           = port
+        self.timeout        = timeout
+        self.max_batch_size = max_batch_size
+        self._conn: typ.Optional[http.client.HTTPConnection] = None
+
+    def __enter__(self) -> 'Client':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def connect(self) -> None:
+        """Connect to sjfmtd, raises OSError if it is not available."""
+        conn = self._connection()
+        if conn.sock is None:
+            conn.connect()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self._conn is None:
+            if self.socket_path:
+                self._conn = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+            else:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return self._conn
+
+    def _request(
+        self, method: str, path: str, body: bytes, headers: Headers
+    ) -> http.client.HTTPResponse:
+        # A connection which was kept alive may have been closed by the
+        # server in the meantime, in which case the request is retried
+        # once with a new connection.
+        for retry in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                return conn.getresponse()
+            except (
+                http.client.RemoteDisconnected,
+                http.client.ImproperConnectionState,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                self.close()
+                if retry:
+                    raise
+        raise AssertionError("unreachable")
+
+    def format_str(
+        self, src_contents: str, document_id: typ.Optional[str] = None, **options
+    ) -> str:
+        """Format src_contents with sjfmtd.
+
+        The options are the same as for mode_headers. Successive
+        versions of the same document (eg. an editor buffer) with the
+        same document_id, are formatted incrementally.
+        Raises ClientError for invalid input and OSError if
+        sjfmtd is not available.
+        """
+        headers = mode_headers(**options)
+        headers['Content-Type'] = "text/plain; charset=utf-8"
+        if document_id:
+            headers[DOCUMENT_ID_HEADER] = document_id
+
+        response = self._request('POST', "/", src_contents.encode("utf-8"), headers)
+        text     = response.read().decode("utf-8")
+        if response.status == 200:
+            return text
+        elif response.status == 204:
+            return src_contents
+        else:
+            raise ClientError(response.status, text)
+
+    def format_edits(
+        self, src_contents: str, document_id: typ.Optional[str] = None, **options
+    ) -> typ.List[edits.Edit]:
+        """Format src_contents, returning only the edits to apply.
+
+        The edits can be applied with edits.apply_edits. An empty list
+        means that src_contents is already formatted.
+        """
+        headers = mode_headers(**options)
+        headers['Content-Type'] = "text/plain; charset=utf-8"
+        headers[EDITS_HEADER] = "1"
+        if document_id:
+            headers[DOCUMENT_ID_HEADER] = document_id
+
+        response = self._request('POST', "/", src_contents.encode("utf-8"), headers)
+        text     = response.read().decode("utf-8")
+        if response.status == 200:
+            return [edits.Edit(**edit) for edit in json.loads(text)['edits']]
+        elif response.status == 204:
+            return []
+        else:
+            raise ClientError(response.status, text)
+
+    def format_batch(
+        self, files: typ.Iterable[typ.Tuple[str, str]], **options
+    ) -> typ.Iterator[BatchResult]:
+        """Format (path, src_contents) pairs with /batch requests.
+
+        Results are yielded in the order they are completed by sjfmtd,
+        as dicts with the fields index, path, status and text. Paths
+        ending in .pyi are formatted as stubs. Many files are split into
+        requests of at most max_batch_size bytes.
+        """
+        headers     = mode_headers(**options)
+        pyi_headers = mode_headers(**dict(options, is_pyi=True))
+
+        file_reqs: typ.List[bytes] = []
+
+        empty_size  = len(b'{"files": []}')
+        batch_size  = empty_size
+        batch_start = 0
+        for index, (path, src) in enumerate(files):
+            file_req = {
+                'path'   : path,
+                'source' : src,
+                'headers': pyi_headers if path.endswith(".pyi") else headers,
+            }
+            file_req_data = json.dumps(file_req).encode("utf-8")
+            file_req_size = len(file_req_data) + len(b", ")
+            if file_reqs and batch_size + file_req_size > self.max_batch_size:
+                yield from self._format_batch(batch_start, file_reqs)
+                file_reqs   = []
+                batch_size  = empty_size
+                batch_start = index
+
+            file_reqs.append(file_req_data)
+            batch_size += file_req_size
+
+        if file_reqs:
+            yield from self._format_batch(batch_start, file_reqs)
+
+    def _format_batch(
+        self, batch_start: int, file_reqs: typ.List[bytes]
+    ) -> typ.Iterator[BatchResult]:
+        batch_body = b'{"files": [' + b", ".join(file_reqs) + b"]}"
+        response   = self._request('POST', "/batch", batch_body, {'Content-Type': "application/json"})
+        if response.status != 200:
+            raise ClientError(response.status, response.read().decode("utf-8"))
+
+        for line in iter(response.readline, b""):
+            result = json.loads(line)
+            # index in files, rather than in this request
+            result['index'] += batch_start
+            yield result
+
+
+def _parse_args(args: typ.Optional[typ.Sequence[str]]) -> typ.Any:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="sjfmt --server",
+        description=(
+            "Format files with a running sjfmtd. If it is not "
+            "available, the files are formatted in-process."
+        ),
+    )
+    parser.add_argument('--server', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument(
+        '--socket',
+        default=os.environ.get('SJFMTD_SOCKET'),
+        help="Unix domain socket of sjfmtd. [default: $SJFMTD_SOCKET]",
+    )
+    parser.add_argument(
+        '--host',
+        default=os.environ.get('SJFMTD_HOST', DEFAULT_HOST),
+        help=f"Host of sjfmtd. [default: $SJFMTD_HOST or {DEFAULT_HOST}]",
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=int(os.environ.get('SJFMTD_PORT', DEFAULT_PORT)),
+        help=f"Port of sjfmtd. [default: $SJFMTD_PORT or {DEFAULT_PORT}]",
+    )
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help="Don't write the files back, just return the status.",
+    )
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't emit non-error messages.")
+    parser.add_argument(
+        '-l', '--line-length', type=int, help="How many characters per line to allow."
+    )
+    parser.add_argument(
+        '-t', '--target-version', action='append', help="Python versions, eg. py36."
+    )
+    parser.add_argument(
+        '-S',
+        '--skip-string-normalization',
+        action='store_true',
+        help="Don't normalize string quotes or prefixes.",
+    )
+    parser.add_argument('--pyi', action='store_true', help="Format all input files like stubs.")
+    parser.add_argument('--fast', action='store_true', help="Skip the AST safety checks.")
+    parser.add_argument('--safe', action='store_true', help=argparse.SUPPRESS)
+    sources.add_arguments(parser)
+    parser.add_argument('src', nargs="+", help="Files or directories to format, - for stdin.")
+    return parser.parse_args(args)
+
+
+def _fallback_args(opts: typ.Any) -> typ.List[str]:
+    """Arguments for in-process formatting with sjfmt."""
+    args         : typ.List[str] = []
+    if opts.check:
+        args.append("--check")
+    if opts.quiet:
+        args.append("--quiet")
+    if opts.line_length:
+        args.extend(["--line-length", str(opts.line_length)])
+    for target_version in opts.target_version or ():
+        args.extend(["--target-version", target_version])
+    if opts.skip_string_normalization:
+        args.append("--skip-string-normalization")
+    if opts.pyi:
+        args.append("--pyi")
+    if opts.fast:
+        args.append("--fast")
+    for option in sources.CONFIG_KEYS + ('config',):
+        value = getattr(opts, option)
+        if value is not None:
+            args.extend(["--" + option.replace("_", "-"), value])
+    args.extend(opts.src)
+    return args
+
+
+def _format_stdin(sjfmtd_client: Client, opts: typ.Any, options: typ.Dict[str, typ.Any]) -> int:
+    src_contents = sys.stdin.read()
+    try:
+        dst_contents = sjfmtd_client.format_str(src_contents, **options)
+    except ClientError as ex:
+        print(f"error: cannot format -: {ex.text}", file=sys.stderr)
+        return 123
+
+    if not opts.check:
+        sys.stdout.write(dst_contents)
+    return int(opts.check and dst_contents != src_contents)
+
+
+# The path, encoding and newline of each file, by the path as passed to format_batch
+BatchPaths = typ.Dict[str, typ.Tuple[pl.Path, str, str]]
+
+
+def _read_batch(
+    paths: typ.Iterable[pl.Path],
+) -> typ.Tuple[typ.List[typ.Tuple[str, str]], BatchPaths, int]:
+    """Read the files at paths, return (files, batch_paths, error_count)."""
+    files      : typ.List[typ.Tuple[str, str]] = []
+    batch_paths: BatchPaths = {}
+    error_count = 0
+
+    for path in paths:
+        try:
+            src_contents, encoding, newline = sources.read_source(path)
+        except (OSError, UnicodeDecodeError, SyntaxError) as ex:
+            error_count += 1
+            print(f"error: cannot format {path}: {ex}", file=sys.stderr)
+            continue
+
+        batch_paths[str(path)] = (path, encoding, newline)
+        files.append((str(path), src_contents))
+
+    return (files, batch_paths, error_count)
+
+
+def _write_results(
+    results: typ.Iterable[BatchResult], batch_paths: BatchPaths, opts: typ.Any
+) -> typ.Tuple[int, int]:
+    """Write back and report the results, return (changed_count, error_count)."""
+    changed_count = 0
+    error_count   = 0
+
+    for result in results:
+        path, encoding, newline = batch_paths[result['path']]
+        if result['status'] == 204:
+            continue
+        elif result['status'] != 200:
+            error_count += 1
+            print(f"error: cannot format {path}: {result['text']}", file=sys.stderr)
+            continue
+
+        changed_count += 1
+        if not opts.check:
+            sources.write_source(path, result['text'], encoding, newline)
+        if not opts.quiet:
+            verb = "would reformat" if opts.check else "reformatted"
+            print(f"{verb} {path}", file=sys.stderr)
+
+    return (changed_count, error_count)
+
+
+def _format_files(sjfmtd_client: Client, opts: typ.Any, options: typ.Dict[str, typ.Any]) -> int:
+    try:
+        src_filter = sources.source_filter(
+            opts.src,
+            include=opts.include,
+            exclude=opts.exclude,
+            extend_exclude=opts.extend_exclude,
+            force_exclude=opts.force_exclude,
+            config=opts.config,
+        )
+    except (OSError, ValueError) as ex:
+        print(f"error: {ex}", file=sys.stderr)
+        return 2
+
+    files, batch_paths, error_count = _read_batch(sources.iter_paths(opts.src, src_filter))
+
+    changed_count = 0
+    if files:
+        results                          = sjfmtd_client.format_batch(files, **options)
+        changed_count, write_error_count = _write_results(results, batch_paths, opts)
+        error_count += write_error_count
+
+    if error_count:
+        return 123
+    elif opts.check and changed_count:
+        return 1
+    else:
+        return 0
+
+
+def main(args: typ.Optional[typ.Sequence[str]] = None) -> None:
+    """Command line interface for sjfmt --server."""
+    opts    = _parse_args(args)
+    options = {
+        'line_length'              : opts.line_length,
+        'is_pyi'                   : opts.pyi,
+        'target_versions'          : opts.target_version or (),
+        'skip_string_normalization': opts.skip_string_normalization,
+        'is_fast'                  : opts.fast,
+    }
+
+    sjfmtd_client = Client(socket_path=opts.socket, host=opts.host, port=opts.port)
+    try:
+        sjfmtd_client.connect()
+    except OSError:
+        # Only now do we pay for importing black.
+        from straitjacket import sjfmt
+
+        sjfmt.main(args=_fallback_args(opts))
+        return
+
+    with sjfmtd_client:
+        if opts.src == ['-']:
+            exit_code = _format_stdin(sjfmtd_client, opts, options)
+        else:
+            exit_code = _format_files(sjfmtd_client, opts, options)
+    sys.exit(exit_code)
@@ -0,0 +1,117 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Row based edits between a source and its formatted version.
+
+This only uses the standard library, so that it can be used by the
+client of sjfmtd.
+"""
+
+import difflib
+import typing as typ
+
+
+class Edit(typ.NamedTuple):
+    """Replace the rows [start:end] of the source with text.
+
+    Rows are zero based, start == end is an insertion before start.
+    """
+
+    start: int
+    end  : int
+    text : str
+
+
+# Above this number of changed rows, the rows are not diffed (which is
+# superlinear), they are replaced with a single edit instead.
+MAX_DIFF_ROWS = 200
+
+# (src_start, src_end, dst_start, dst_end) of changed rows
+RowChange = typ.Tuple[int, int, int, int]
+
+
+def _split_rows(contents: str) -> typ.List[str]:
+    """Split after each "\\n" only.
+
+    Unlike str.splitlines, this doesn't split at "\\x0c", "\\u2028"
+    etc., so that rows are the same as the lines of an editor.
+
+    >>> _split_rows("a\\x0cb\\nc")
+    ['a\\x0cb\\n', 'c']
+    """
+    rows = [row + "\n" for row in contents.split("\n")]
+    last = rows.pop()[:-1]
+    if last:
+        rows.append(last)
+    return rows
+
+
+def _iter_row_changes(src_rows: typ.List[str], dst_rows: typ.List[str]) -> typ.Iterator[RowChange]:
+    if len(src_rows) == len(dst_rows):
+        # This is the common case, since the alignment only changes
+        # whitespace inside of rows. Rows are compared one by one and
+        # neighbouring changed rows are merged.
+        start: typ.Optional[int] = None
+        for idx, (src_row, dst_row) in enumerate(zip(src_rows, dst_rows)):
+            if src_row != dst_row:
+                if start is None:
+                    start = idx
+            elif start is not None:
+                yield (start, idx, start, idx)
+                start = None
+        if start is not None:
+            yield (start, len(src_rows), start, len(dst_rows))
+    elif max(len(src_rows), len(dst_rows)) <= MAX_DIFF_ROWS:
+        matcher = difflib.SequenceMatcher(None, src_rows, dst_rows, autojunk=False)
+        for tag, src_start, src_end, dst_start, dst_end in matcher.get_opcodes():
+            if tag != 'equal':
+                yield (src_start, src_end, dst_start, dst_end)
+    else:
+        yield (0, len(src_rows), 0, len(dst_rows))
+
+
+def compute_edits(src_contents: str, dst_contents: str) -> typ.List[Edit]:
+    """Edits which transform src_contents into dst_contents.
+
+    >>> compute_edits("x=1\\nfoo=2\\nbar()\\n", "x   = 1\\nfoo = 2\\nbar()\\n")
+    [Edit(start=0, end=2, text='x   = 1\\nfoo = 2\\n')]
+    >>> compute_edits("a\\nb\\nc\\n", "a\\nb\\nb2\\nc\\n")
+    [Edit(start=2, end=2, text='b2\\n')]
+    """
+    src_rows = _split_rows(src_contents)
+    dst_rows = _split_rows(dst_contents)
+
+    # The unchanged prefix and suffix are trimmed in linear time, only
+    # the rows in between are compared.
+    max_common = min(len(src_rows), len(dst_rows))
+    prefix_len = 0
+    while prefix_len < max_common and src_rows[prefix_len] == dst_rows[prefix_len]:
+        prefix_len += 1
+
+    suffix_len = 0
+    max_suffix = max_common - prefix_len
+    while suffix_len < max_suffix and src_rows[-1 - suffix_len] == dst_rows[-1 - suffix_len]:
+        suffix_len += 1
+
+    src_rows = src_rows[prefix_len : len(src_rows) - suffix_len]
+    dst_rows = dst_rows[prefix_len : len(dst_rows) - suffix_len]
+    return [
+        Edit(prefix_len + src_start, prefix_len + src_end, "".join(dst_rows[dst_start:dst_end]))
+        for src_start, src_end, dst_start, dst_end in _iter_row_changes(src_rows, dst_rows)
+    ]
+
+
+def apply_edits(src_contents: str, edits: typ.Iterable[Edit]) -> str:
+    """Apply edits (as returned by compute_edits) to src_contents.
+
+    >>> apply_edits("a\\nb\\nc\\n", [Edit(1, 2, "B\\n"), Edit(3, 3, "d\\n")])
+    'a\\nB\\nc\\nd\\n'
+    >>> apply_edits("a\\x0cb\\nc\\n", [Edit(1, 2, "C\\n")])
+    'a\\x0cb\\nC\\n'
+    """
+    rows = _split_rows(src_contents)
+    for edit in sorted(edits, key=lambda edit: edit.start, reverse=True):
+        rows[edit.start : edit.end] = [edit.text]
+    return "".join(rows)
@@ -0,0 +1,209 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Pre-fork supervisor for server processes which share listening sockets.
+
+The supervisor creates the sockets and forks the server processes,
+which inherit them and all accept connections on them. Crashed
+processes are restarted. On SIGHUP a new generation of processes is
+started and the previous one is sent SIGTERM, so that it can finish
+the requests it has already accepted.
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import logging
+import typing as typ
+
+log = logging.getLogger("straitjacket.prefork")
+
+Sockets = typ.List[socket.socket]
+ServeFn = typ.Callable[[Sockets], None]
+
+POLL_INTERVAL = 0.1
+
+# A process which exits shortly after it was started (eg. because of a
+# bad configuration) is restarted with a delay, so the supervisor
+# doesn't spin forking processes.
+MIN_LIFETIME  = 1.0
+RESTART_DELAY = 1.0
+
+# Processes of a previous generation (after a SIGHUP) or all processes
+# (after a SIGTERM) are killed if they don't exit within this time. It
+# is longer than the shutdown_timeout of aiohttp, so that requests which
+# are in progress can complete.
+DRAIN_TIMEOUT = 90.0
+
+
+def listen_sockets(
+    host       : typ.Optional[str] = None,
+    port       : typ.Optional[int] = None,
+    socket_path: typ.Optional[str] = None,
+    backlog    : int = 128,
+) -> Sockets:
+    socks: Sockets = []
+    if host is not None and port is not None:
+        for family, socktype, proto, _, addr in socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+        ):
+            sock = socket.socket(family, socktype, proto)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock.bind(addr)
+            sock.listen(backlog)
+            socks.append(sock)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(socket_path)
+        sock.listen(backlog)
+        socks.append(sock)
+
+    for sock in socks:
+        sock.set_inheritable(True)
+    return socks
+
+
+class WorkerProcess(typ.NamedTuple):
+    pid       : int
+    generation: int
+    started   : float
+
+
+class Supervisor:
+    """Run num_processes processes which each call serve(socks)."""
+
+    def __init__(self, serve: ServeFn, socks: Sockets, num_processes: int) -> None:
+        self.serve         = serve
+        self.socks         = socks
+        self.num_processes = num_processes
+
+        self.generation = 0
+        self.workers: typ.Dict[int, WorkerProcess] = {}
+
+        self._is_stopping  = False
+        self._is_reloading = False
+        self._drain_times  : typ.Dict[int, float] = {}
+        self._restart_after: float = 0.0
+
+    def _spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                # the supervisor handles reloads, not the server processes
+                signal.signal(signal.SIGHUP , signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT , signal.default_int_handler)
+                self.serve(self.socks)
+            except KeyboardInterrupt:
+                pass
+            except SystemExit as ex:
+                exit_code = ex.code if isinstance(ex.code, int) else 1
+            except BaseException:
+                log.exception("Server process failed")
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+        else:
+            self.workers[pid] = WorkerProcess(pid, self.generation, time.time())
+            log.info(f"Started server process {pid} (generation {self.generation})")
+
+    def _on_stop(self, signum: int, frame: typ.Any) -> None:
+        self._is_stopping = True
+
+    def _on_reload(self, signum: int, frame: typ.Any) -> None:
+        self._is_reloading = True
+
+    def _reap(self) -> None:
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+            self._drain_times.pop(pid, None)
+            if worker is None:
+                continue
+
+            is_current = worker.generation == self.generation
+            if is_current and not self._is_stopping:
+                log.warning(f"Server process {pid} exited unexpectedly (status {status})")
+                if time.time() - worker.started < MIN_LIFETIME:
+                    self._restart_after = time.time() + RESTART_DELAY
+
+    def _reload(self) -> None:
+        self._is_reloading = False
+        self.generation += 1
+        log.info(f"Reloading, starting generation {self.generation}")
+
+        prev_pids = list(self.workers)
+        for _ in range(self.num_processes):
+            self._spawn()
+
+        for pid in prev_pids:
+            self._drain(pid)
+
+    def _drain(self, pid: int) -> None:
+        if pid in self._drain_times:
+            return
+        self._drain_times[pid] = time.time() + DRAIN_TIMEOUT
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def _kill_overdue(self) -> None:
+        now = time.time()
+        for pid, drain_time in list(self._drain_times.items()):
+            if now > drain_time:
+                log.warning(f"Server process {pid} did not exit in time, killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self._drain_times[pid] = now + DRAIN_TIMEOUT
+
+    def _num_current(self) -> int:
+        return sum(worker.generation == self.generation for worker in self.workers.values())
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT , self._on_stop)
+        signal.signal(signal.SIGHUP , self._on_reload)
+
+        for _ in range(self.num_processes):
+            self._spawn()
+
+        while True:
+            self._reap()
+
+            if self._is_stopping:
+                for pid in list(self.workers):
+                    self._drain(pid)
+                if not self.workers:
+                    break
+            elif self._is_reloading:
+                self._reload()
+            elif time.time() >= self._restart_after:
+                for _ in range(self.num_processes - self._num_current()):
+                    self._spawn()
+
+            self._kill_overdue()
+            time.sleep(POLL_INTERVAL)
+
+        for sock in self.socks:
+            sock.close()
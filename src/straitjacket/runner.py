@@ -0,0 +1,354 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Parallel formatting of many files.
+
+This replaces black.reformat_many. Files are grouped into chunks of
+similar size, which are submitted to a process pool largest first.
+Workers read, format and write the files themselves, only the status
+of each file (and its diff for --diff) is sent back to the parent.
+"""
+
+import io
+import os
+import sys
+import dataclasses
+import typing as typ
+import pathlib as pl
+import datetime as dt
+import concurrent.futures as cf
+import multiprocessing as mp
+
+import black
+import black.cache
+
+from straitjacket import sjfmt
+from straitjacket import stats
+
+# Forked workers don't have to import black again. Fork is only used
+# on Linux, elsewhere it is not the default start method, since it is
+# unsafe with some system libraries (eg. on macOS).
+IS_FORK_METHOD_PREFERRED = sys.platform.startswith('linux')
+
+# Each worker gets about this many chunks, so that the last chunks to
+# complete are small and all workers finish at about the same time.
+# Chunks are also limited in the number of files, so that progress is
+# reported regularly.
+CHUNKS_PER_WORKER   = 4
+MAX_FILES_PER_CHUNK = 64
+
+
+class FileResult(typ.NamedTuple):
+    path        : str
+    is_changed  : bool
+    error       : typ.Optional[str]
+    diff_content: typ.Optional[str]
+    file_stats  : typ.Optional[stats.FormatStats] = None
+
+
+class FormattedFile(typ.NamedTuple):
+    """Result of formatting a file, before it is written back."""
+
+    src_contents: str
+    dst_contents: str
+    encoding    : str
+    newline     : str
+
+
+Chunk = typ.List[str]
+
+
+def _file_size(path: pl.Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def chunk_sources(
+    sizes: typ.Dict[str, int], workers: int, max_files: int = MAX_FILES_PER_CHUNK
+) -> typ.List[Chunk]:
+    """Group paths into chunks of similar size (in bytes), largest first.
+
+    >>> sizes  = {"a.py": 900, "b.py": 500, "c.py": 300, "d.py": 200}
+    >>> chunks = chunk_sources(sizes, workers=1)
+    >>> chunks
+    [['a.py'], ['b.py'], ['c.py', 'd.py']]
+    """
+    total_size   = sum(sizes.values())
+    target_size  = max(1, total_size // max(1, workers * CHUNKS_PER_WORKER))
+    sorted_paths = sorted(sizes, key=lambda path: (-sizes[path], path))
+
+    chunks    : typ.List[Chunk] = []
+    chunk     : Chunk = []
+    chunk_size: int   = 0
+    for path in sorted_paths:
+        chunk.append(path)
+        chunk_size += sizes[path]
+        if chunk_size >= target_size or len(chunk) >= max_files:
+            chunks.append(chunk)
+            chunk      = []
+            chunk_size = 0
+
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def format_file_contents(
+    src       : pl.Path,
+    fast      : bool,
+    mode      : black.mode.Mode,
+    stats_hook: typ.Optional[stats.StatsHook] = None,
+    use_cache : bool = False,
+) -> typ.Optional[FormattedFile]:
+    """Read and format the file src (None if it is unchanged)."""
+    with src.open(mode="rb") as fobj:
+        src_contents, encoding, newline = black.decode_bytes(fobj.read())
+
+    engine = sjfmt.Engine(mode, fast=fast, use_cache=use_cache, stats_hook=stats_hook)
+    try:
+        dst_contents = engine.format_file_contents(src_contents)
+    except black.NothingChanged:
+        return None
+
+    return FormattedFile(src_contents, dst_contents, encoding, newline)
+
+
+def write_file(src: pl.Path, formatted: FormattedFile) -> None:
+    with src.open(mode="w", encoding=formatted.encoding, newline=formatted.newline) as fobj:
+        fobj.write(formatted.dst_contents)
+
+
+def format_file_in_place(
+    src       : pl.Path,
+    fast      : bool,
+    mode      : black.mode.Mode,
+    write_back: black.WriteBack,
+    stats_hook: typ.Optional[stats.StatsHook] = None,
+    use_cache : bool = False,
+) -> typ.Tuple[bool, typ.Optional[str]]:
+    """Format the file src, return (is_changed, diff_content)."""
+    if src.suffix == ".pyi":
+        mode = dataclasses.replace(mode, is_pyi=True)
+    elif src.suffix == ".ipynb":
+        # Notebooks are formatted by black, with the format_str of sjfmt
+        # (which is patched in the workers).
+        return (black.format_file_in_place(src, fast, mode, write_back), None)
+
+    then      = dt.datetime.utcfromtimestamp(src.stat().st_mtime)
+    formatted = format_file_contents(src, fast, mode, stats_hook, use_cache)
+    if formatted is None:
+        return (False, None)
+
+    if write_back == black.WriteBack.YES:
+        write_file(src, formatted)
+        return (True, None)
+    elif write_back in (black.WriteBack.DIFF, black.WriteBack.COLOR_DIFF):
+        now           = dt.datetime.utcnow()
+        src_name      = f"{src}\t{then} +0000"
+        dst_name      = f"{src}\t{now} +0000"
+        diff_contents = black.diff(formatted.src_contents, formatted.dst_contents, src_name, dst_name)
+        if write_back == black.WriteBack.COLOR_DIFF:
+            diff_contents = black.color_diff(diff_contents)
+        return (True, diff_contents)
+    else:
+        return (True, None)
+
+
+def format_file(
+    path         : str,
+    fast         : bool,
+    mode         : black.mode.Mode,
+    write_back   : black.WriteBack,
+    collect_stats: bool = False,
+    use_cache    : bool = False,
+) -> FileResult:
+    """Format the file at path, errors are returned as part of the FileResult.
+
+    With collect_stats, FileResult.stats are the stats of the file.
+    """
+    file_stats: typ.List[stats.FormatStats] = []
+
+    stats_hook = file_stats.append if collect_stats else None
+    try:
+        is_changed, diff_contents = format_file_in_place(
+            pl.Path(path), fast, mode, write_back, stats_hook, use_cache
+        )
+    except Exception as ex:
+        return FileResult(path, False, str(ex), None)
+
+    if file_stats:
+        return FileResult(path, is_changed, None, diff_contents, file_stats[0]._replace(path=path))
+    else:
+        return FileResult(path, is_changed, None, diff_contents)
+
+
+def _format_chunk(
+    chunk        : Chunk,
+    fast         : bool,
+    mode         : black.mode.Mode,
+    write_back   : black.WriteBack,
+    collect_stats: bool,
+) -> typ.List[FileResult]:
+    # only used by sjfmt, so the persistent cache is used
+    return [
+        format_file(path, fast, mode, write_back, collect_stats, use_cache=True) for path in chunk
+    ]
+
+
+def _init_worker() -> None:
+    # Only required for notebooks, which are formatted by black, and
+    # only if the start method is not 'fork'.
+    black.format_str = sjfmt._cached_format_str
+
+
+def _make_executor(workers: int) -> cf.Executor:
+    mp_context: mp.context.BaseContext
+    if IS_FORK_METHOD_PREFERRED:
+        mp_context = mp.get_context('fork')
+    else:
+        mp_context = mp.get_context()
+
+    try:
+        return cf.ProcessPoolExecutor(
+            max_workers=workers, mp_context=mp_context, initializer=_init_worker
+        )
+    except (ImportError, NotImplementedError, OSError):
+        # Same fallback as black, for systems without multiprocessing
+        # (eg. AWS Lambda or Termux).
+        return cf.ThreadPoolExecutor(max_workers=1)
+
+
+def _write_diff(diff_contents: str) -> None:
+    stdout = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", write_through=True)
+    stdout = black.wrap_stream_for_windows(stdout)
+    stdout.write(diff_contents)
+    stdout.detach()
+
+
+def _filter_cached(
+    sources: typ.Set[pl.Path], mode: black.mode.Mode, report: black.Report
+) -> typ.Tuple[typ.Set[pl.Path], black.cache.Cache]:
+    """Report the sources which are unchanged according to the cache of black.
+
+    Returns the remaining sources and the cache.
+    """
+    cache = black.cache.read_cache(mode)
+    sources, cached = black.cache.filter_cached(cache, sources)
+    for src in sorted(cached):
+        report.done(src, black.Changed.CACHED)
+    return (sources, cache)
+
+
+def _report_result(
+    result    : FileResult,
+    src       : pl.Path,
+    write_back: black.WriteBack,
+    report    : black.Report,
+    stats_hook: typ.Optional[stats.StatsHook],
+) -> bool:
+    """Report the result of formatting src.
+
+    Returns True if src can be stored in the cache of black.
+    """
+    if result.error is not None:
+        report.failed(src, result.error)
+        return False
+
+    if stats_hook and result.file_stats:
+        stats_hook(result.file_stats)
+
+    if result.diff_content:
+        _write_diff(result.diff_content)
+
+    changed = black.Changed.YES if result.is_changed else black.Changed.NO
+    report.done(src, changed)
+    # If the file was written back or was successfully checked as
+    # well-formatted, store this information in the cache.
+    return write_back is black.WriteBack.YES or (
+        write_back is black.WriteBack.CHECK and changed is black.Changed.NO
+    )
+
+
+def _num_workers(workers: typ.Optional[int]) -> int:
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if sys.platform == 'win32':
+        # Work around https://bugs.python.org/issue26903
+        workers = min(workers, 60)
+    return workers
+
+
+def reformat_many(
+    sources   : typ.Set[pl.Path],
+    fast      : bool,
+    write_back: black.WriteBack,
+    mode      : black.mode.Mode,
+    report    : black.Report,
+    workers   : typ.Optional[int            ] = None,
+    stats_hook: typ.Optional[stats.StatsHook] = None,
+) -> None:
+    """Reformat many files with a process pool (same signature as black.reformat_many).
+
+    A single file is formatted in this process. If a stats_hook is
+    given, it is called with the stats of each formatted file.
+    """
+    is_diff = write_back in (black.WriteBack.DIFF, black.WriteBack.COLOR_DIFF)
+
+    cache: black.cache.Cache = {}
+    if not is_diff:
+        sources, cache = _filter_cached(sources, mode, report)
+
+    if not sources:
+        return
+
+    sources_by_name  = {str(src): src for src in sources}
+    sizes            = {name: _file_size(src) for name, src in sources_by_name.items()}
+    sources_to_cache = []
+    collect_stats    = stats_hook is not None
+
+    chunk_results: typ.Iterable[typ.List[FileResult]]
+
+    executor: typ.Optional[cf.Executor] = None
+    futures : typ.List[cf.Future] = []
+    try:
+        if len(sources) == 1:
+            chunk_results = [_format_chunk(list(sizes), fast, mode, write_back, collect_stats)]
+        else:
+            workers  = _num_workers(workers)
+            executor = _make_executor(workers)
+            futures  = [
+                executor.submit(_format_chunk, chunk, fast, mode, write_back, collect_stats)
+                for chunk in chunk_sources(sizes, workers)
+            ]
+            chunk_results = (future.result() for future in cf.as_completed(futures))
+
+        for results in chunk_results:
+            for result in results:
+                src = sources_by_name[result.path]
+                if _report_result(result, src, write_back, report, stats_hook):
+                    sources_to_cache.append(src)
+    except KeyboardInterrupt:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if sources_to_cache:
+            black.cache.write_cache(cache, sources_to_cache, mode)
+
+
+def reformat_one(
+    src       : pl.Path,
+    fast      : bool,
+    write_back: black.WriteBack,
+    mode      : black.mode.Mode,
+    report    : black.Report,
+    stats_hook: typ.Optional[stats.StatsHook] = None,
+) -> None:
+    """Reformat a single file (same signature as black.reformat_one, but no stdin)."""
+    reformat_many({src}, fast, write_back, mode, report, workers=1, stats_hook=stats_hook)
@@ -4,24 +4,624 @@
 # Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
 # SPDX-License-Identifier: MIT
 
+import os
+import sys
+import json
+import codecs
+import asyncio
+import hashlib
+import logging
+import functools
+import collections
+import typing as typ
+import datetime as dt
+import concurrent.futures as cf
+import multiprocessing as mp
+
 import black
 import click
 import blackd
+import multidict
+from aiohttp import web
+from blackd.middlewares import cors
 
 from straitjacket import sjfmt
+from straitjacket import edits
+from straitjacket import prefork
 
+DEFAULT_BIND_HOST  = "localhost"
+DEFAULT_BIND_PORT  = 45484
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
 
-def main(*args, **kwargs) -> None:
+# aiohttp limits the size of a request body to 1 MiB by default, which
+# is too small for a /batch request with the files of a project.
+DEFAULT_MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Request headers which affect the formatted result
+MODE_HEADERS = (
+    blackd.LINE_LENGTH_HEADER,
+    blackd.PYTHON_VARIANT_HEADER,
+    blackd.SKIP_STRING_NORMALIZATION_HEADER,
+    blackd.SKIP_MAGIC_TRAILING_COMMA,
+    blackd.FAST_OR_SAFE_HEADER,
+)
+
+# Instead of the formatted file, respond with a json object {"edits":
+# [{"start", "end", "text"}, ...]}, with the rows of the request body to
+# replace. For large files with only a few changes, this is much less
+# data for a client to transfer/apply.
+EDITS_HEADER = "X-Edits"
+
+# Successive requests for the same document (eg. an editor buffer) with
+# the same id, are aligned incrementally (see sjfmt.Document). The id is
+# chosen by the client and only used as a hint, the result is the same
+# with or without it.
+DOCUMENT_ID_HEADER = "X-Document-Id"
+
+MAX_DOCUMENTS = 256
+
+ALLOW_HEADERS = (*blackd.BLACK_HEADERS, EDITS_HEADER, DOCUMENT_ID_HEADER, "Content-Type")
+
+
+class FormatResult(typ.NamedTuple):
+    status: int
+    text  : str
+
+
+ResponseCacheKey = typ.Tuple[str, ...]
+
+
+def _entry_size(key: ResponseCacheKey, result: FormatResult) -> int:
+    return sum(map(sys.getsizeof, key)) + sys.getsizeof(result.text)
+
+
+class ResponseCache:
+    """In-memory LRU cache of formatting results, bounded by max_size in bytes."""
+
+    max_size: int
+    size    : int
+    hits    : int
+    misses  : int
+
+    def __init__(self, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.size     = 0
+        self.hits     = 0
+        self.misses   = 0
+        self._entries: typ.OrderedDict[ResponseCacheKey, FormatResult] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: ResponseCacheKey) -> typ.Optional[FormatResult]:
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: ResponseCacheKey, result: FormatResult) -> None:
+        entry_size = _entry_size(key, result)
+        if entry_size > self.max_size:
+            return
+
+        prev_result = self._entries.pop(key, None)
+        if prev_result is not None:
+            self.size -= _entry_size(key, prev_result)
+
+        self._entries[key] = result
+        self.size += entry_size
+
+        while self.size > self.max_size:
+            evicted_key, evicted_result = self._entries.popitem(last=False)
+            self.size -= _entry_size(evicted_key, evicted_result)
+
+    def stats(self) -> typ.Dict[str, int]:
+        return {
+            'hits'    : self.hits,
+            'misses'  : self.misses,
+            'entries' : len(self._entries),
+            'size'    : self.size,
+            'max_size': self.max_size,
+        }
+
+
+DocumentKey = typ.Tuple[str, ...]
+
+
+class DocumentCache:
+    """LRU of the documents for DOCUMENT_ID_HEADER, bounded by max_documents."""
+
+    max_documents: int
+
+    def __init__(self, max_documents: int = MAX_DOCUMENTS) -> None:
+        self.max_documents = max_documents
+        self._documents: typ.OrderedDict[DocumentKey, sjfmt.Document] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def get(
+        self, headers: typ.Mapping[str, str], mode: black.mode.Mode, is_fast: bool
+    ) -> sjfmt.Document:
+        mode_key = tuple(headers.get(header, "") for header in MODE_HEADERS)
+        key      = (headers[DOCUMENT_ID_HEADER],) + mode_key
+        document = self._documents.get(key)
+        if document is None:
+            document = sjfmt.Document(mode, fast=is_fast, use_cache=True)
+            self._documents[key] = document
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        else:
+            self._documents.move_to_end(key)
+        return document
+
+
+def _parse_mode(headers: typ.Mapping[str, str]) -> typ.Tuple[black.mode.Mode, bool]:
+    """Parse the request headers of blackd.
+
+    Raises ValueError with the text of the error response.
+    """
+    try:
+        line_length = int(headers.get(blackd.LINE_LENGTH_HEADER, black.DEFAULT_LINE_LENGTH))
+    except ValueError:
+        raise ValueError("Invalid line length header value")
+
+    if blackd.PYTHON_VARIANT_HEADER in headers:
+        value = headers[blackd.PYTHON_VARIANT_HEADER]
+        try:
+            is_pyi, versions = blackd.parse_python_variant_header(value)
+        except blackd.InvalidVariantHeader as ex:
+            raise ValueError(f"Invalid value for {blackd.PYTHON_VARIANT_HEADER}: {ex.args[0]}")
+    else:
+        is_pyi   = False
+        versions = set()
+
+    skip_string_normalization = bool(headers.get(blackd.SKIP_STRING_NORMALIZATION_HEADER, False))
+    skip_magic_trailing_comma = bool(headers.get(blackd.SKIP_MAGIC_TRAILING_COMMA       , False))
+
+    mode = black.mode.Mode(
+        target_versions=versions,
+        is_pyi=is_pyi,
+        line_length=line_length,
+        string_normalization=not skip_string_normalization,
+        magic_trailing_comma=not skip_magic_trailing_comma,
+    )
+    is_fast = headers.get(blackd.FAST_OR_SAFE_HEADER, "safe") == "fast"
+    return (mode, is_fast)
+
+
+# Formatting this in each worker when it is started loads the grammar of
+# black and exercises the alignment (string literal matchers etc.), so
+# the first request to a worker doesn't pay for it.
+WARM_UP_SRC = """
+def f(a,):
+    return {'a':1, 'bcd':2, "e": '''
+    '''}  # comment
+"""
+
+
+def _init_worker() -> None:
+    sjfmt.Engine(use_cache=False).format_str(WARM_UP_SRC)
+
+
+def _worker_pid() -> int:
+    return os.getpid()
+
+
+def make_executor(workers: typ.Optional[int] = None) -> cf.ProcessPoolExecutor:
+    """Process pool with workers which are started and warmed up immediately."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    executor = cf.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    # Workers are started on demand, submitting a job per worker starts
+    # all of them.
+    for _ in range(workers):
+        executor.submit(_worker_pid)
+    return executor
+
+
+def _format_file_contents(src_contents: str, is_fast: bool, mode: black.mode.Mode) -> FormatResult:
     try:
-        # monkey patch
-        black.format_str = sjfmt.format_str
-
-        black.patch_click()
-        blackd.main = click.version_option(version=sjfmt.__version__)(black.main)
-        blackd.main(*args, **kwargs)
-    finally:
-        # monkey unpatch
-        black.format_str = sjfmt.original_format_str
+        engine = sjfmt.Engine(mode, fast=is_fast, use_cache=True)
+        return FormatResult(200, engine.format_file_contents(src_contents))
+    except black.NothingChanged:
+        return FormatResult(204, "")
+    except black.InvalidInput as ex:
+        return FormatResult(400, str(ex))
+
+
+def _black_format_file_contents(src_contents: str, mode: black.mode.Mode) -> FormatResult:
+    if not src_contents.strip():
+        return FormatResult(204, "")
+
+    try:
+        engine = sjfmt.Engine(mode, use_cache=True)
+        return FormatResult(200, engine.black_format_str(src_contents))
+    except black.InvalidInput as ex:
+        return FormatResult(400, str(ex))
+
+
+def _check_result(src_contents: str, dst_contents: str, mode: black.mode.Mode) -> None:
+    sjfmt.Engine(mode, use_cache=True).check_result(src_contents, dst_contents)
+
+
+async def _format_document(
+    executor    : cf.Executor,
+    document    : sjfmt.Document,
+    src_contents: str,
+    is_fast     : bool,
+    mode        : black.mode.Mode,
+) -> FormatResult:
+    # The state of a document is in this process, so only the
+    # (incremental) alignment is done here (in a thread). Formatting
+    # with black and the checks for --safe are done in the executor,
+    # same as for any other request.
+    loop         = asyncio.get_event_loop()
+    black_result = await loop.run_in_executor(
+        executor, functools.partial(_black_format_file_contents, src_contents, mode)
+    )
+    if black_result.status != 200:
+        return black_result
+
+    dst_contents = await loop.run_in_executor(None, document.align, black_result.text)
+    if src_contents == dst_contents:
+        return FormatResult(204, "")
+
+    if not is_fast:
+        await loop.run_in_executor(
+            executor, functools.partial(_check_result, src_contents, dst_contents, mode)
+        )
+    return FormatResult(200, dst_contents)
+
+
+def _cache_key(src_bytes: bytes, charset: str, headers: typ.Mapping[str, str]) -> ResponseCacheKey:
+    src_digest = hashlib.sha256(src_bytes).hexdigest()
+    # normalize aliases such as utf8 -> utf-8
+    charset = codecs.lookup(charset).name
+    return (src_digest, charset) + tuple(headers.get(header, "") for header in MODE_HEADERS)
+
+
+async def _format_cached(
+    executor      : cf.Executor,
+    response_cache: typ.Optional[ResponseCache],
+    cache_key     : ResponseCacheKey,
+    src_contents  : str,
+    is_fast       : bool,
+    mode          : black.mode.Mode,
+    document      : typ.Optional[sjfmt.Document] = None,
+) -> FormatResult:
+    # The result of formatting is cached rather than the response, since
+    # the diff (if requested) has a timestamp.
+    if response_cache is not None:
+        result = response_cache.get(cache_key)
+        if result is not None:
+            return result
+
+    if document is None:
+        loop   = asyncio.get_event_loop()
+        result = await loop.run_in_executor(
+            executor, functools.partial(_format_file_contents, src_contents, is_fast, mode)
+        )
+    else:
+        result = await _format_document(executor, document, src_contents, is_fast, mode)
+    if response_cache is not None:
+        response_cache.put(cache_key, result)
+    return result
+
+
+async def handle(
+    request       : web.Request,
+    executor      : cf.Executor,
+    response_cache: typ.Optional[ResponseCache] = None,
+    documents     : typ.Optional[DocumentCache] = None,
+) -> web.Response:
+    headers = {blackd.BLACK_VERSION_HEADER: blackd.__version__}
+    try:
+        if request.headers.get(blackd.PROTOCOL_VERSION_HEADER, "1") != '1':
+            return web.Response(status=501, text="This server only supports protocol version 1")
+
+        try:
+            mode, is_fast = _parse_mode(request.headers)
+        except ValueError as ex:
+            return web.Response(status=400, text=str(ex))
+
+        req_bytes = await request.content.read()
+        charset   = request.charset or "utf8"
+        req_str   = req_bytes.decode(charset)
+        then      = dt.datetime.utcnow()
+        loop      = asyncio.get_event_loop()
+
+        if documents is not None and DOCUMENT_ID_HEADER in request.headers:
+            document = documents.get(request.headers, mode, is_fast)
+        else:
+            document = None
+
+        cache_key = _cache_key(req_bytes, charset, request.headers)
+        result    = await _format_cached(
+            executor, response_cache, cache_key, req_str, is_fast, mode, document
+        )
+
+        if result.status != 200:
+            return web.Response(status=result.status, headers=headers, text=result.text or None)
+
+        formatted_str = result.text
+
+        if request.headers.get(EDITS_HEADER, False):
+            edits_data = await loop.run_in_executor(
+                executor, functools.partial(_edits_data, req_str, formatted_str)
+            )
+            return web.json_response({'edits': edits_data}, headers=headers)
+
+        # Only output the diff in the HTTP response
+        if request.headers.get(blackd.DIFF_HEADER, False):
+            now           = dt.datetime.utcnow()
+            src_name      = f"In\t{then} +0000"
+            dst_name      = f"Out\t{now} +0000"
+            formatted_str = await loop.run_in_executor(
+                executor,
+                functools.partial(black.diff, req_str, formatted_str, src_name, dst_name),
+            )
+
+        return web.Response(
+            content_type=request.content_type,
+            charset=charset,
+            headers=headers,
+            text=formatted_str,
+        )
+    except Exception as ex:
+        logging.exception("Exception during handling a request")
+        return web.Response(status=500, headers=headers, text=str(ex))
+
+
+EditsData = typ.List[typ.Dict[str, typ.Any]]
+
+
+def _edits_data(src_contents: str, dst_contents: str) -> EditsData:
+    return [edit._asdict() for edit in edits.compute_edits(src_contents, dst_contents)]
+
+
+BatchFileResult = typ.Dict[str, typ.Any]
+
+
+async def _format_batch_file(
+    executor      : cf.Executor,
+    response_cache: typ.Optional[ResponseCache],
+    file_idx      : int,
+    file_req      : typ.Dict[str, typ.Any],
+) -> BatchFileResult:
+    is_valid = (
+        isinstance(file_req, dict)
+        and isinstance(file_req.get('source'), str)
+        and isinstance(file_req.get('headers', {}), dict)
+    )
+    if not is_valid:
+        return {
+            'index' : file_idx,
+            'path'  : None,
+            'status': 400,
+            'text'  : 'Invalid batch file, expected {"path": ..., "source": ..., "headers": {...}}',
+        }
+
+    file_result: BatchFileResult = {'index': file_idx, 'path': file_req.get('path')}
+    try:
+        headers = multidict.CIMultiDict(file_req.get('headers', {}))
+        mode, is_fast = _parse_mode(headers)
+    except ValueError as ex:
+        file_result['status'] = 400
+        file_result['text'  ] = str(ex)
+        return file_result
+
+    src_contents = file_req['source']
+    cache_key    = _cache_key(src_contents.encode("utf-8"), "utf8", headers)
+    try:
+        result = await _format_cached(
+            executor, response_cache, cache_key, src_contents, is_fast, mode
+        )
+        file_result['status'] = result.status
+        if result.status == 200 and headers.get(EDITS_HEADER, False):
+            loop = asyncio.get_event_loop()
+            file_result['edits'] = await loop.run_in_executor(
+                executor, functools.partial(_edits_data, src_contents, result.text)
+            )
+        else:
+            file_result['text'] = result.text
+    except Exception as ex:
+        logging.exception("Exception during handling a batch file")
+        file_result['status'] = 500
+        file_result['text'  ] = str(ex)
+    return file_result
+
+
+async def handle_batch(
+    request       : web.Request,
+    executor      : cf.Executor,
+    response_cache: typ.Optional[ResponseCache] = None,
+) -> web.StreamResponse:
+    """Format many files with one request.
+
+    The request body is a json object {"files": [...]}, each file
+    being an object {"path": ..., "source": ..., "headers": {...}}, with
+    the same headers as for a request to "/". The response is a stream
+    of json objects (one per line) {"index", "path", "status", "text"}
+    in the order in which formatting is completed ("edits" instead of
+    "text" if the EDITS_HEADER was set for a file).
+    """
+    headers = {blackd.BLACK_VERSION_HEADER: blackd.__version__}
+    try:
+        batch_req = await request.json()
+    except ValueError:
+        batch_req = None
+
+    file_reqs = batch_req.get('files') if isinstance(batch_req, dict) else None
+    if not isinstance(file_reqs, list):
+        return web.Response(
+            status=400, headers=headers, text='Invalid batch, expected {"files": [...]}'
+        )
+
+    response              = web.StreamResponse(headers=headers)
+    response.content_type = "application/x-ndjson"
+    await response.prepare(request)
+
+    pending = [
+        _format_batch_file(executor, response_cache, file_idx, file_req)
+        for file_idx, file_req in enumerate(file_reqs)
+    ]
+    for file_result in asyncio.as_completed(pending):
+        line = json.dumps(await file_result) + "\n"
+        await response.write(line.encode("utf-8"))
+
+    await response.write_eof()
+    return response
+
+
+async def handle_stats(
+    request: web.Request, response_cache: typ.Optional[ResponseCache] = None
+) -> web.Response:
+    stats = {'cache': response_cache.stats() if response_cache else None}
+    return web.json_response(stats)
+
+
+def make_app(
+    executor     : typ.Optional[cf.Executor] = None,
+    cache_size   : int = DEFAULT_CACHE_SIZE,
+    workers      : typ.Optional[int] = None,
+    max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+) -> web.Application:
+    app = web.Application(
+        middlewares=[cors(allow_headers=ALLOW_HEADERS)], client_max_size=max_body_size
+    )
+    if executor is None:
+        executor = make_executor(workers)
+
+    response_cache = ResponseCache(cache_size) if cache_size > 0 else None
+    documents      = DocumentCache()
+
+    app.add_routes(
+        [
+            web.post(
+                "/",
+                functools.partial(
+                    handle, executor=executor, response_cache=response_cache, documents=documents
+                ),
+            ),
+            web.post(
+                "/batch",
+                functools.partial(handle_batch, executor=executor, response_cache=response_cache),
+            ),
+            web.get("/stats", functools.partial(handle_stats, response_cache=response_cache)),
+        ]
+    )
+    return app
+
+
+@click.command(context_settings={'help_option_names': ["-h", "--help"]})
+@click.option(
+    "--bind-host",
+    type=str,
+    default=None,
+    help=f"Address to bind the server to. [default: {DEFAULT_BIND_HOST}]",
+)
+@click.option(
+    "--bind-port",
+    type=int,
+    default=None,
+    help=f"Port to listen on. [default: {DEFAULT_BIND_PORT}]",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help=(
+        "Path of a unix domain socket to listen on. Unless --bind-host "
+        "or --bind-port are given as well, only the socket is used."
+    ),
+)
+@click.option(
+    "--cache-size",
+    type=int,
+    default=DEFAULT_CACHE_SIZE,
+    show_default=True,
+    help="Maximum size in bytes of the in-memory response cache (0 to disable).",
+)
+@click.option(
+    "--max-body-size",
+    type=int,
+    default=DEFAULT_MAX_BODY_SIZE,
+    show_default=True,
+    help="Maximum size in bytes of a request body (eg. of a /batch request).",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help=(
+        "Number of worker processes for formatting. [default: number of cpus, "
+        "or 1 per server process with --processes]"
+    ),
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=0,
+    help=(
+        "Run a supervisor with this many server processes, which share "
+        "the listening sockets. The supervisor restarts server processes "
+        "which crash and on SIGHUP, replaces them gracefully."
+    ),
+)
+@click.version_option(version=sjfmt.__version__)
+def _main(
+    bind_host    : typ.Optional[str],
+    bind_port    : typ.Optional[int],
+    socket_path  : typ.Optional[str],
+    cache_size   : int,
+    max_body_size: int,
+    workers      : typ.Optional[int],
+    processes    : int,
+) -> None:
+    logging.basicConfig(level=logging.INFO)
+    ver = sjfmt.__version__
+
+    is_tcp = socket_path is None or bind_host is not None or bind_port is not None
+    if is_tcp:
+        bind_host = DEFAULT_BIND_HOST if bind_host is None else bind_host
+        bind_port = DEFAULT_BIND_PORT if bind_port is None else bind_port
+        black.out(f"sjfmtd version {ver} listening on {bind_host} port {bind_port}")
+    if socket_path:
+        black.out(f"sjfmtd version {ver} listening on {socket_path}")
+
+    if processes > 0:
+        socks = prefork.listen_sockets(bind_host, bind_port, socket_path)
+
+        def _serve(socks: prefork.Sockets) -> None:
+            # The app (and its process pool) is created after the fork,
+            # each server has its own pool.
+            app = make_app(cache_size=cache_size, workers=workers or 1, max_body_size=max_body_size)
+            web.run_app(app, sock=socks, handle_signals=True, print=None)
+
+        prefork.Supervisor(_serve, socks, num_processes=processes).run()
+        return
+
+    app = make_app(cache_size=cache_size, workers=workers, max_body_size=max_body_size)
+    web.run_app(
+        app,
+        host=bind_host,
+        port=bind_port,
+        path=socket_path,
+        handle_signals=True,
+        print=None,
+    )
+
+
+def main(*args, **kwargs) -> None:
+    mp.freeze_support()
+    black.patch_click()
+    _main(*args, **kwargs)
 
 
 if __name__ == '__main__':
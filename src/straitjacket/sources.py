@@ -0,0 +1,257 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Discovery, reading and writing of source files.
+
+This follows the file discovery of black (.gitignore files, default
+excludes, --include/--exclude/--extend-exclude/--force-exclude and
+the [tool.black] section of pyproject.toml), but without importing
+black, so that it can be used by `sjfmt --align-only` and by the
+client for sjfmtd.
+"""
+
+import io
+import re
+import tokenize
+import typing as typ
+import pathlib as pl
+
+# As in black.const, except that notebooks are not included, since they
+# are not supported by straitjacket.
+DEFAULT_EXCLUDES = (
+    r"/(\.direnv|\.eggs|\.git|\.hg|\.mypy_cache|\.nox|\.tox|\.venv|venv|\.svn"
+    r"|_build|buck-out|build|dist)/"
+)
+DEFAULT_INCLUDES = r"\.pyi?$"
+
+CONFIG_KEYS = ('include', 'exclude', 'extend_exclude', 'force_exclude')
+
+
+class SourceFilter(typ.NamedTuple):
+    include       : typ.Pattern[str]
+    exclude       : typ.Optional[typ.Pattern[str]]  # None: DEFAULT_EXCLUDES and .gitignore
+    extend_exclude: typ.Optional[typ.Pattern[str]]
+    force_exclude : typ.Optional[typ.Pattern[str]]
+
+
+def _compile_pattern(pattern: str) -> typ.Pattern[str]:
+    # as black.re_compile_maybe_verbose
+    if "\n" in pattern:
+        pattern = "(?x)" + pattern
+    return re.compile(pattern)
+
+
+def find_project_root(srcs: typ.Sequence[str]) -> pl.Path:
+    """Directory containing .git, .hg or pyproject.toml (as black)."""
+    if not srcs:
+        srcs = [str(pl.Path.cwd().resolve())]
+
+    src_paths   = [pl.Path(pl.Path.cwd(), src).resolve() for src in srcs]
+    src_parents = [set(path.parents) | ({path} if path.is_dir() else set()) for path in src_paths]
+    common_base = max(set.intersection(*src_parents), key=lambda path: path.parts)
+
+    for directory in (common_base, *common_base.parents):
+        if (directory / ".git").exists():
+            return directory
+        if (directory / ".hg").is_dir():
+            return directory
+        if (directory / "pyproject.toml").is_file():
+            return directory
+    return directory
+
+
+def _read_config(config_path: pl.Path) -> typ.Dict[str, str]:
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib  # type: ignore
+
+    with config_path.open(mode="rb") as fobj:
+        pyproject = tomllib.load(fobj)
+    config = pyproject.get('tool', {}).get('black', {})
+    return {key.replace("-", "_"): val for key, val in config.items()}
+
+
+def source_filter(
+    srcs          : typ.Sequence[str],
+    include       : typ.Optional[str] = None,
+    exclude       : typ.Optional[str] = None,
+    extend_exclude: typ.Optional[str] = None,
+    force_exclude : typ.Optional[str] = None,
+    config        : typ.Optional[str] = None,
+) -> SourceFilter:
+    """Patterns from the arguments, else from pyproject.toml of the project.
+
+    Raises ValueError if a pattern is not a valid regular expression.
+    """
+    if config is None:
+        config_path = find_project_root(srcs) / "pyproject.toml"
+    else:
+        config_path = pl.Path(config)
+
+    if config_path.is_file():
+        file_config = _read_config(config_path)
+    else:
+        file_config = {}
+
+    def _pattern(key: str, pattern: typ.Optional[str]) -> typ.Optional[typ.Pattern[str]]:
+        if pattern is None:
+            pattern = file_config.get(key)
+        try:
+            return None if pattern is None else _compile_pattern(pattern)
+        except re.error as ex:
+            raise ValueError(f"Invalid regular expression for {key}: {pattern!r}: {ex}")
+
+    return SourceFilter(
+        include=_pattern('include', include) or _compile_pattern(DEFAULT_INCLUDES),
+        exclude=_pattern('exclude', exclude),
+        extend_exclude=_pattern('extend_exclude', extend_exclude),
+        force_exclude=_pattern('force_exclude', force_exclude),
+    )
+
+
+def add_arguments(parser: typ.Any) -> None:
+    """Add the options of black for file discovery to an argparse parser."""
+    parser.add_argument(
+        '--include',
+        help=f"Regular expression of files to include. [default: {DEFAULT_INCLUDES}]",
+    )
+    parser.add_argument(
+        '--exclude',
+        help=(
+            "Regular expression of files and directories to exclude."
+            f" [default: {DEFAULT_EXCLUDES} and the patterns of .gitignore files]"
+        ),
+    )
+    parser.add_argument(
+        '--extend-exclude',
+        help="Like --exclude, but in addition to the default excludes.",
+    )
+    parser.add_argument(
+        '--force-exclude',
+        help="Like --exclude, but also for files which are given explicitly.",
+    )
+    parser.add_argument(
+        '--config',
+        help="Read --include and the --exclude options from the [tool.black] section of this file.",
+    )
+
+
+def _gitignore(directory: pl.Path) -> typ.Any:
+    import pathspec
+
+    gitignore_path = directory / ".gitignore"
+    lines: typ.List[str] = []
+    if gitignore_path.is_file():
+        with gitignore_path.open(encoding="utf-8") as fobj:
+            lines = fobj.readlines()
+    return pathspec.PathSpec.from_lines("gitwildmatch", lines)
+
+
+def _normalized_path(path: pl.Path, root: pl.Path) -> typ.Optional[str]:
+    abspath = path if path.is_absolute() else pl.Path.cwd() / path
+    try:
+        return abspath.resolve().relative_to(root).as_posix()
+    except OSError:
+        return None
+    except ValueError:
+        if path.is_symlink():
+            # symlink to outside of the project
+            return None
+        raise
+
+
+def _is_excluded(normalized_path: str, pattern: typ.Optional[typ.Pattern[str]]) -> bool:
+    match = pattern.search(normalized_path) if pattern else None
+    return bool(match and match.group(0))
+
+
+def _iter_dir_paths(
+    dir_path: pl.Path, root: pl.Path, src_filter: SourceFilter, gitignore: typ.Any
+) -> typ.Iterator[pl.Path]:
+    if src_filter.exclude is None:
+        exclude = _compile_pattern(DEFAULT_EXCLUDES)
+    else:
+        exclude = src_filter.exclude
+
+    for child in sorted(dir_path.iterdir()):
+        normalized_path = _normalized_path(child, root)
+        if normalized_path is None:
+            continue
+        if gitignore is not None and gitignore.match_file(normalized_path):
+            continue
+
+        normalized_path = "/" + normalized_path
+        if child.is_dir():
+            normalized_path += "/"
+
+        if _is_excluded(normalized_path, exclude):
+            continue
+        if _is_excluded(normalized_path, src_filter.extend_exclude):
+            continue
+        if _is_excluded(normalized_path, src_filter.force_exclude):
+            continue
+
+        if child.is_dir():
+            child_gitignore = None if gitignore is None else gitignore + _gitignore(child)
+            yield from _iter_dir_paths(child, root, src_filter, child_gitignore)
+        elif child.is_file() and src_filter.include.search(normalized_path):
+            yield child
+
+
+def iter_paths(
+    srcs: typ.Sequence[str], src_filter: typ.Optional[SourceFilter] = None
+) -> typ.Iterator[pl.Path]:
+    """Files to format, as black would find them for srcs.
+
+    Files which are given explicitly are always included, unless they
+    match the force_exclude pattern.
+    """
+    if src_filter is None:
+        src_filter = source_filter(srcs)
+
+    root = find_project_root(srcs)
+    if src_filter.exclude is None:
+        gitignore = _gitignore(root)
+    else:
+        gitignore = None
+
+    for src in srcs:
+        path = pl.Path(src)
+        if path.is_dir():
+            yield from _iter_dir_paths(path, root, src_filter, gitignore)
+            continue
+
+        normalized_path = _normalized_path(path, root) if path.exists() else None
+        if normalized_path is not None and _is_excluded(
+            "/" + normalized_path, src_filter.force_exclude
+        ):
+            continue
+        yield path
+
+
+def read_source(path: pl.Path) -> typ.Tuple[str, str, str]:
+    """Contents of a source file (with "\\n" newlines), its encoding and newline.
+
+    The encoding is detected as by python (PEP 263 coding cookie or
+    BOM, else utf-8), the same as black.decode_bytes.
+    """
+    with path.open(mode="rb") as fobj:
+        src_bytes = fobj.read()
+
+    srcbuf          = io.BytesIO(src_bytes)
+    encoding, lines = tokenize.detect_encoding(srcbuf.readline)
+    if not lines:
+        return ("", encoding, "\n")
+
+    newline = "\r\n" if lines[0].endswith(b"\r\n") else "\n"
+    srcbuf.seek(0)
+    with io.TextIOWrapper(srcbuf, encoding) as tiow:
+        return (tiow.read(), encoding, newline)
+
+
+def write_source(path: pl.Path, dst_contents: str, encoding: str, newline: str) -> None:
+    with path.open(mode="w", encoding=encoding, newline=newline) as fobj:
+        fobj.write(dst_contents)
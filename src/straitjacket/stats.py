@@ -0,0 +1,177 @@
+# This file is part of the straitjacket project
+# https://github.com/mbarkhau/straitjacket
+#
+# Copyright (c) 2018-2021 Manuel Barkhau (mbarkhau@gmail.com) - MIT License
+# SPDX-License-Identifier: MIT
+"""Instrumentation of the formatting of files.
+
+A Recorder collects the timings of each stage, counts and cache hits
+while an input is formatted. The resulting FormatStats are passed to
+a stats_hook (see sjfmt.Engine) and can be aggregated and serialized
+as json (see sjfmt --stats).
+"""
+
+import sys
+import time
+import contextlib
+import typing as typ
+
+# Stages, in the order in which they are done. The stages of
+# align.align_formatted_str are replaced by 'align' for the incremental
+# alignment of a sjfmt.Document.
+STAGES = (
+    'black',
+    'tokenize',
+    'normalize',
+    'contexts',
+    'cell_groups',
+    'realign',
+    'align',
+    'check',
+)
+
+
+class FormatStats(typ.NamedTuple):
+
+    path        : typ.Optional[str]
+    timings     : typ.Dict[str, float]  # stage -> seconds
+    counts      : typ.Dict[str, int]  # rows, tokens, cell_groups, aligned_cells
+    cache_hits  : typ.Dict[str, int]  # cache tier -> hits
+    cache_misses: typ.Dict[str, int]  # cache tier -> misses
+    max_rss     : typ.Optional[int]  # peak memory of the process in bytes
+
+    @property
+    def total_time(self) -> float:
+        return sum(self.timings.values())
+
+
+StatsHook = typ.Callable[[FormatStats], None]
+
+
+def _max_rss() -> typ.Optional[int]:
+    try:
+        import resource
+    except ImportError:
+        # not available on windows
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    else:
+        # kilobytes on linux
+        return max_rss * 1024
+
+
+class Recorder:
+    """Collects the stats of formatting one input."""
+
+    is_enabled = True
+
+    timings     : typ.Dict[str, float]
+    counts      : typ.Dict[str, int]
+    cache_hits  : typ.Dict[str, int]
+    cache_misses: typ.Dict[str, int]
+
+    def __init__(self) -> None:
+        self.timings      = {}
+        self.counts       = {}
+        self.cache_hits   = {}
+        self.cache_misses = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> typ.Iterator[None]:
+        tzero = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - tzero
+            self.timings[stage] = self.timings.get(stage, 0.0) + duration
+
+    def count(self, name: str, num: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + num
+
+    def cache_access(self, tier: str, is_hit: bool) -> None:
+        if is_hit:
+            self.cache_hits[tier] = self.cache_hits.get(tier, 0) + 1
+        else:
+            self.cache_misses[tier] = self.cache_misses.get(tier, 0) + 1
+
+    def result(self, path: typ.Optional[str] = None) -> FormatStats:
+        return FormatStats(
+            path=path,
+            timings=dict(self.timings),
+            counts=dict(self.counts),
+            cache_hits=dict(self.cache_hits),
+            cache_misses=dict(self.cache_misses),
+            max_rss=_max_rss(),
+        )
+
+
+class NullRecorder(Recorder):
+    """Recorder which does nothing, used when no stats are collected."""
+
+    is_enabled = False
+
+    @contextlib.contextmanager
+    def timer(self, stage: str) -> typ.Iterator[None]:
+        yield
+
+    def count(self, name: str, num: int) -> None:
+        pass
+
+    def cache_access(self, tier: str, is_hit: bool) -> None:
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+
+
+def _sum_dicts(dicts: typ.Iterable[typ.Dict[str, typ.Any]]) -> typ.Dict[str, typ.Any]:
+    total: typ.Dict[str, typ.Any] = {}
+    for item in dicts:
+        for key, val in item.items():
+            total[key] = total.get(key, 0) + val
+    return total
+
+
+def aggregate(all_stats: typ.Sequence[FormatStats]) -> FormatStats:
+    """Sum of the timings, counts and cache accesses (max of max_rss).
+
+    >>> stats_a = FormatStats("a.py", {'black': 1.0}, {'rows': 3}, {}, {'black': 1}, 100)
+    >>> stats_b = FormatStats("b.py", {'black': 2.0, 'realign': 0.5}, {'rows': 4}, {}, {}, 200)
+    >>> total = aggregate([stats_a, stats_b])
+    >>> (total.timings, total.counts, total.cache_misses, total.max_rss)
+    ({'black': 3.0, 'realign': 0.5}, {'rows': 7}, {'black': 1}, 200)
+    """
+    max_rss_vals = [
+        file_stats.max_rss for file_stats in all_stats if file_stats.max_rss is not None
+    ]
+    return FormatStats(
+        path=None,
+        timings=_sum_dicts(file_stats.timings for file_stats in all_stats),
+        counts=_sum_dicts(file_stats.counts for file_stats in all_stats),
+        cache_hits=_sum_dicts(file_stats.cache_hits for file_stats in all_stats),
+        cache_misses=_sum_dicts(file_stats.cache_misses for file_stats in all_stats),
+        max_rss=max(max_rss_vals) if max_rss_vals else None,
+    )
+
+
+StatsData = typ.Dict[str, typ.Any]
+
+
+def _stats_data(file_stats: FormatStats) -> StatsData:
+    timings = file_stats.timings
+    data    = file_stats._asdict()
+    data['timings'   ] = {stage: round(timings[stage], 6) for stage in STAGES if stage in timings}
+    data['total_time'] = round(file_stats.total_time, 6)
+    return data
+
+
+def to_json_data(all_stats: typ.Sequence[FormatStats]) -> StatsData:
+    """Per file (slowest first) and aggregated stats, for json.dumps."""
+    files = sorted(all_stats, key=lambda file_stats: file_stats.total_time, reverse=True)
+    total = _stats_data(aggregate(all_stats))
+    del total['path']
+    total['files'] = len(all_stats)
+    return {'total': total, 'files': [_stats_data(file_stats) for file_stats in files]}
@@ -0,0 +1,28 @@
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--perf",
+        action="store_true",
+        help="Run the tests marked with perf, which measure wall clock time.",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--perf"):
+        return
+
+    skip_perf = pytest.mark.skip(reason="wall clock timing, run with --perf")
+    for item in items:
+        if "perf" in item.keywords:
+            item.add_marker(skip_perf)
+
+
+@pytest.fixture(autouse=True)
+def sjfmt_cache_dir(tmp_path_factory, monkeypatch):
+    # The tests (and the processes they start) never use the cache
+    # in the home directory of the user.
+    cache_dir = tmp_path_factory.mktemp("sjfmt_cache")
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(cache_dir))
+    return cache_dir
@@ -0,0 +1,149 @@
+import time
+import asyncio
+import concurrent.futures as cf
+
+import black
+import pytest
+
+from straitjacket import aio
+from straitjacket import sjfmt
+
+SRC = "x=1\nfoo=2\n"
+DST = "x   = 1\nfoo = 2\n"
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setenv('SJFMT_CACHE_MAX_SIZE', "0")
+
+
+@pytest.fixture
+def slow_black(monkeypatch):
+    original_format_str = sjfmt.original_format_str
+
+    def _slow_format_str(src_contents, *, mode):
+        time.sleep(0.5)
+        return original_format_str(src_contents, mode=mode)
+
+    monkeypatch.setattr(sjfmt, 'original_format_str', _slow_format_str)
+
+
+def test_format_str_async():
+    async def _run():
+        with cf.ThreadPoolExecutor(max_workers=2) as executor:
+            results = await asyncio.gather(
+                aio.format_str_async(SRC),
+                aio.format_str_async(SRC, executor=executor),
+                aio.format_str_async(SRC, mode=black.Mode(line_length=10), executor=executor),
+            )
+        return results
+
+    assert asyncio.run(_run()) == [DST, DST, DST]
+
+
+def test_format_str_async_timeout(slow_black):
+    async def _run():
+        ticks = 0
+
+        async def _tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(_tick())
+        with pytest.raises(asyncio.TimeoutError):
+            await aio.format_str_async(SRC, timeout=0.2)
+        ticker.cancel()
+        # the event loop was not blocked
+        assert ticks > 5
+
+    asyncio.run(_run())
+
+
+def test_format_str_async_cancel(slow_black):
+    async def _run():
+        task = asyncio.ensure_future(aio.format_str_async(SRC))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(_run())
+
+
+def test_format_files_async(tmp_path):
+    paths = []
+    for i in range(6):
+        path = tmp_path / f"mod{i}.py"
+        path.write_text(SRC * (i + 1))
+        paths.append(path)
+
+    bad_path = tmp_path / "bad.py"
+    bad_path.write_text("x = (\n")
+    paths.append(bad_path)
+
+    async def _run():
+        with cf.ProcessPoolExecutor(max_workers=2) as executor:
+            return [result async for result in aio.format_files_async(paths, executor=executor)]
+
+    results = {result.path: result for result in asyncio.run(_run())}
+    assert len(results) == 7
+    assert results[str(paths[0])].is_changed
+    assert results[str(paths[0])].error is None
+    assert results[str(bad_path)].error
+    assert paths[0].read_text() == DST
+    assert paths[5].read_text() == DST * 6
+
+
+def test_format_files_async_stop_early(tmp_path, slow_black):
+    paths = []
+    for i in range(8):
+        path = tmp_path / f"mod{i}.py"
+        path.write_text(SRC)
+        paths.append(path)
+
+    async def _run():
+        with cf.ThreadPoolExecutor(max_workers=1) as executor:
+            results = aio.format_files_async(paths, executor=executor)
+            result  = await results.__anext__()
+            await results.aclose()
+            return result
+
+    result = asyncio.run(_run())
+    assert result.is_changed
+    # files which were not started are not formatted
+    assert sum(path.read_text() == DST for path in paths) < len(paths)
+
+
+def test_format_files_async_timeout_queued(tmp_path, monkeypatch):
+    original_format_str = sjfmt.original_format_str
+
+    def _slow_format_str(src_contents, *, mode):
+        time.sleep(0.1)
+        return original_format_str(src_contents, mode=mode)
+
+    monkeypatch.setattr(sjfmt, 'original_format_str', _slow_format_str)
+
+    paths = []
+    for i in range(12):
+        path = tmp_path / f"mod{i}.py"
+        path.write_text(SRC)
+        paths.append(path)
+
+    async def _run(paths, timeout):
+        with cf.ThreadPoolExecutor(max_workers=2) as executor:
+            results = aio.format_files_async(paths, executor=executor, timeout=timeout)
+            return [result async for result in results]
+
+    # the time waiting for a worker doesn't count against the timeout of a file
+    results = asyncio.run(_run(paths, timeout=1.0))
+    assert [result.error for result in results] == [None] * 12
+    assert all(path.read_text() == DST for path in paths)
+
+    paths[0].write_text(SRC)
+    results = asyncio.run(_run(paths[:1], timeout=0.05))
+    assert results[0].error == "timeout after 0.05 seconds"
+    # the worker has finished (the executor was shut down), but the
+    # file is not modified after the timeout
+    assert paths[0].read_text() == SRC
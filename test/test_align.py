@@ -0,0 +1,407 @@
+# pylint:disable=protected-access
+
+import re
+import time
+import subprocess as sp
+import pathlib as pl
+
+import pytest
+
+from straitjacket import align
+
+# sjfmt formatted source, to test with a larger input
+ALIGN_SRC = pl.Path(align.__file__).read_text(encoding="utf-8")
+
+
+def test_tokenize_roundtrip():
+    tokens = list(align._tokenize_for_alignment(ALIGN_SRC))
+    assert "".join(tok.val for tok in tokens) == ALIGN_SRC
+
+    tokens = list(align._tokenize_for_alignment("x = {'a': 1}  # note\n    y\n"))
+    assert tokens == [
+        align.Token(align.TokenType.CODE      , "x "),
+        align.Token(align.TokenType.SEPARATOR , "="),
+        align.Token(align.TokenType.WHITESPACE, " "),
+        align.Token(align.TokenType.SEPARATOR , "{"),
+        align.Token(align.TokenType.BLOCK     , "'a'"),
+        align.Token(align.TokenType.SEPARATOR , ":"),
+        align.Token(align.TokenType.CODE      , " 1"),
+        align.Token(align.TokenType.SEPARATOR , "}"),
+        align.Token(align.TokenType.WHITESPACE, "  "),
+        align.Token(align.TokenType.COMMENT   , "# note"),
+        align.Token(align.TokenType.NEWLINE   , "\n"),
+        align.Token(align.TokenType.INDENT    , "    "),
+        align.Token(align.TokenType.CODE      , "y"),
+        align.Token(align.TokenType.NEWLINE   , "\n"),
+    ]
+
+
+def test_token_table():
+    src   = "a = 1\nbb = 2\n"
+    table = align.TokenTable(src)
+    assert len(table) == 3
+    assert table.contents() == src
+    assert table.row(1) == list(align._tokenize_for_alignment("bb = 2\n"))
+    assert table.row(2) == []
+
+    table.set_token(0, 0, align.Token(align.TokenType.CODE, "a  "))
+    assert table.row(0)[0] == align.Token(align.TokenType.CODE, "a  ")
+    assert table.contents() == "a  = 1\nbb = 2\n"
+
+    assert table.col_offset(0, 1) == 3
+    assert table.col_offset(1, 1) == 3
+    assert table.last_content_cols.tolist() == [2, 2, -1]
+
+
+def _dict_literal(num_entries: int) -> str:
+    entries = "".join(f"    'key_{i}': {i},\n" for i in range(num_entries))
+    return "x = {\n" + entries + "}\n"
+
+
+def _module(num_funcs: int) -> str:
+    # without cell groups with prefixes of different length
+    funcs = [
+        f"def func_{i}(arg):\n"
+        f"    value = arg + {i}\n"
+        f"    other_value = {{'a': value, 'bc': {i}}}\n"
+        f"    return (value, other_value)\n\n\n"
+        for i in range(num_funcs)
+    ]
+    return "".join(funcs)
+
+
+def _min_duration(fn, *args) -> float:
+    durations = []
+    for _ in range(3):
+        tzero = time.perf_counter()
+        fn(*args)
+        durations.append(time.perf_counter() - tzero)
+    return min(durations)
+
+
+@pytest.mark.perf
+def test_find_cell_groups_scaling():
+    small_contexts = list(align._iter_alignment_contexts(align.TokenTable(_dict_literal(1000))))
+    large_contexts = list(align._iter_alignment_contexts(align.TokenTable(_dict_literal(8000))))
+
+    small_groups = align._find_cell_groups(small_contexts)
+    large_groups = align._find_cell_groups(large_contexts)
+    assert max(len(cells) for cells in small_groups.values()) == 1000
+    assert max(len(cells) for cells in large_groups.values()) == 8000
+
+    small_duration = _min_duration(align._find_cell_groups, small_contexts)
+    large_duration = _min_duration(align._find_cell_groups, large_contexts)
+    # 8x the input, linear is ~8x the duration, quadratic would be ~64x
+    assert large_duration < small_duration * 24
+
+
+def test_interned_layouts():
+    table    = align.TokenTable("a = f(1)\nbb = f(2)\nc = g, 3\n")
+    contexts = list(align._iter_alignment_contexts(table))
+    layouts  = [{ctx_key.col_idx: ctx_key.layout for ctx_key in ctx} for ctx in contexts]
+    assert layouts[0] == layouts[1]
+    assert layouts[0][1] == layouts[2][1]
+    assert layouts[2][3] not in layouts[0].values()
+
+
+def test_token_table_extend():
+    table = align.TokenTable()
+    chunk = 'a = 1\nx = """\nmultiline'
+    assert table.extend(chunk, is_final=False) == len("a = 1\n")
+    assert len(table) == 2
+
+    chunk = chunk[len("a = 1\n") :] + ' string\n"""\nbb = 2\n'
+    assert table.extend(chunk, is_final=False) == len(chunk)
+    assert len(table) == 4
+    assert table.row(1)[-2].val == '"""\nmultiline string\n"""'
+
+    table.extend("", is_final=True)
+    assert table.contents() == 'a = 1\nx = """\nmultiline string\n"""\nbb = 2\n'
+    # the source of previous calls is not copied
+    assert table.chunks == ["a = 1\n", 'x = """\nmultiline string\n"""\nbb = 2\n']
+
+    table.set_token(0, 0, align.Token(align.TokenType.CODE, "a  "))
+    assert table.contents() == 'a  = 1\nx = """\nmultiline string\n"""\nbb = 2\n'
+
+    table.drop_rows(2)
+    assert table.contents() == "bb = 2\n"
+    assert table.row(2) == list(align._tokenize_for_alignment("bb = 2\n"))
+    assert table.chunks == ['x = """\nmultiline string\n"""\nbb = 2\n']
+
+
+def _align_independent(src: str) -> str:
+    # each cell group aligned independently (as by align_formatted_iter)
+    return align.align_formatted_ranges(src, [(1, src.count("\n") + 1)])
+
+
+def test_align_formatted_iter(monkeypatch):
+    monkeypatch.setattr(align, 'STREAM_CHUNK_SIZE', 1)
+
+    lines = ALIGN_SRC.splitlines(True)
+    assert "".join(align.align_formatted_iter(lines)) == _align_independent(ALIGN_SRC)
+
+    lines = _module(20).splitlines(True)
+    assert "".join(align.align_formatted_iter(lines)) == align.align_formatted_str(_module(20))
+
+    consumed_lines = []
+
+    def _iter_lines():
+        for line in _dict_literal(100).splitlines(True) + ["\n"] * 100:
+            consumed_lines.append(line)
+            yield line
+
+    output = ""
+    for chunk in align.align_formatted_iter(_iter_lines()):
+        output += chunk
+        if output.endswith("}\n"):
+            break
+
+    # the dict is written before all of the input is consumed
+    assert output == align.align_formatted_str(_dict_literal(100))
+    assert len(consumed_lines) < 200
+
+
+MIXED_PREFIX_SRC = """
+def _format(indent, level):
+    prefix = "\\n" + indent * level
+    sep = ",\\n" + indent * level
+    return prefix, sep
+"""
+
+CONST_TYPES_SRC = """
+_const_types = {
+    NameConstant: (type(None), bool),
+    Ellipsis: (type(...),),
+}
+"""
+
+
+def test_align_mixed_prefix_lengths():
+    # The "+" cell group has prefixes of different length, so it is not
+    # aligned, but the assignments are.
+    assert align.align_formatted_str(MIXED_PREFIX_SRC) == MIXED_PREFIX_SRC.replace(
+        "sep =", "sep    ="
+    )
+
+    aligned_const_types = """
+_const_types = {
+    NameConstant: (type(None), bool),
+    Ellipsis    : (type(... ),),
+}
+"""
+    assert align.align_formatted_str(CONST_TYPES_SRC) == aligned_const_types
+
+    # The "+" cell group also stops the alignment of all cell groups
+    # which sort after it, such as the one of "...)" further down.
+    src = MIXED_PREFIX_SRC + "\n" + CONST_TYPES_SRC
+    assert align.align_formatted_str(src) == (
+        align.align_formatted_str(MIXED_PREFIX_SRC)
+        + "\n"
+        + aligned_const_types.replace("(type(... ),)", "(type(...),)")
+    )
+    assert align.DocumentAligner().align(src) == align.align_formatted_str(src)
+
+    # align_formatted_iter and align_formatted_ranges align each cell
+    # group independently
+    independent_dst = align.align_formatted_str(MIXED_PREFIX_SRC) + "\n" + aligned_const_types
+    assert "".join(align.align_formatted_iter(src.splitlines(True))) == independent_dst
+    assert _align_independent(src) == independent_dst
+
+
+def test_align_only(tmpdir):
+    src      = "a = 1\nbbb = {\"x\": 2}\n"
+    expected = "a   = 1\nbbb = {'x': 2}\n"
+    assert align.align_only(src) == expected
+
+    path = pl.Path(str(tmpdir)) / "module.py"
+    path.write_text(src, encoding="utf-8")
+    assert align.align_only(path) == expected
+
+
+def test_align_only_encoding(tmp_path):
+    path = tmp_path / "module.py"
+    src  = "# -*- coding: latin-1 -*-\na = 1  # Zoë\nbbb = 2\n"
+    path.write_bytes(src.encode("latin-1"))
+    assert align._align_only_file(path, is_check=False)
+    assert path.read_bytes() == src.replace("a =", "a   =").encode("latin-1")
+
+
+def test_align_only_cli(tmpdir):
+    path = pl.Path(str(tmpdir)) / "module.py"
+    path.write_text("a = 1\nbbb = 2\n", encoding="utf-8")
+
+    with pytest.raises(SystemExit) as exc_info:
+        align.main(["--align-only", "--check", "-l", "100", str(tmpdir)])
+    assert exc_info.value.code == 1
+    assert path.read_text(encoding="utf-8") == "a = 1\nbbb = 2\n"
+
+    with pytest.raises(SystemExit) as exc_info:
+        align.main(["--align-only", str(path)])
+    assert exc_info.value.code == 0
+    assert path.read_text(encoding="utf-8") == "a   = 1\nbbb = 2\n"
+
+
+RANGES_SRC = """
+a = 1
+bb = 2
+
+def f():
+    \"\"\"Docstring.
+
+    x = 1
+    yy = 2
+    \"\"\"
+    c = 3
+    dd = {"k": 4}
+
+# fmt: off
+e = 5
+ff = 6
+# fmt: on
+g = 7
+hh = 8
+"""
+
+
+def test_align_formatted_ranges():
+    full_dst = align.align_formatted_str(RANGES_SRC)
+    num_rows = len(RANGES_SRC.splitlines())
+    assert align.align_formatted_ranges(RANGES_SRC, [(1, num_rows)]) == full_dst
+    assert align.align_formatted_ranges(RANGES_SRC, []) == RANGES_SRC
+
+    # only the group of row 3 is aligned
+    dst = align.align_formatted_ranges(RANGES_SRC, [(3, 3)])
+    assert dst.splitlines()[1:3] == ["a  = 1", "bb = 2"]
+    assert dst.splitlines()[3:] == RANGES_SRC.splitlines()[3:]
+
+    # empty rows in the docstring don't split the region of row 11,
+    # only its row is normalized
+    dst = align.align_formatted_ranges(RANGES_SRC, [(11, 11)])
+    assert "    c  = 3\n    dd = {\"k\": 4}\n" in dst
+    assert "    x = 1\n    yy = 2\n" in dst
+
+    # fmt: off/on is respected and multiple ranges are combined
+    dst = align.align_formatted_ranges(RANGES_SRC, [(15, 16), (19, 19), (1, 2)])
+    assert "e = 5\nff = 6\n" in dst
+    assert "g  = 7\nhh = 8\n" in dst
+    assert "a  = 1\nbb = 2\n" in dst
+
+    with pytest.raises(ValueError):
+        align.align_formatted_ranges(RANGES_SRC, [(3, 2)])
+
+
+def test_align_formatted_ranges_equivalence():
+    # the rows of any range are the same as if the whole file was aligned
+    src = re.sub(r"(\S) {2,}([=:])", r"\1 \2", ALIGN_SRC)
+    assert src != ALIGN_SRC
+    full_dst = "".join(align.align_formatted_iter(src.splitlines(True))).splitlines()
+    num_rows = len(full_dst)
+    for first in range(1, num_rows, 37):
+        dst = align.align_formatted_ranges(src, [(first, first + 3)]).splitlines()
+        assert dst[first - 1 : first + 3] == full_dst[first - 1 : first + 3]
+
+
+@pytest.mark.parametrize(
+    "src",
+    [_module(100), re.sub(r"(\S) {2,}([=:])", r"\1 \2", ALIGN_SRC)],
+    ids=["incremental", "fallback"],
+)
+def test_document_aligner(src, monkeypatch):
+    full_align_count = 0
+    align_formatted  = align._align_formatted_str
+
+    def _counting_align_formatted(*args):
+        nonlocal full_align_count
+        full_align_count += 1
+        return align_formatted(*args)
+
+    monkeypatch.setattr(align, '_align_formatted_str', _counting_align_formatted)
+
+    src_rows = align._split_rows(src)
+    row_idxs = [idx for idx, row in enumerate(src_rows) if row.startswith("    ") and " = " in row]
+    aligner  = align.DocumentAligner()
+    assert aligner.align("".join(src_rows)) == align.align_formatted_str("".join(src_rows))
+
+    edits = [
+        # rename a variable
+        lambda rows: rows.__setitem__(
+            row_idxs[10], rows[row_idxs[10]].replace(" = ", "_xyz = ", 1)
+        ),
+        # split and join regions
+        lambda rows: rows.insert(row_idxs[20], "\n"),
+        lambda rows: rows.__delitem__(row_idxs[20]),
+        lambda rows: rows.__delitem__(row_idxs[30] - 1),
+        # non local changes
+        lambda rows: rows.insert(row_idxs[40], '    """doc"""\n'),
+        lambda rows: rows.__delitem__(row_idxs[40]),
+        lambda rows: rows.insert(row_idxs[50], "    # fmt: off\n"),
+    ]
+    # without cell groups with prefixes of different length, the
+    # changed regions are aligned separately
+    is_incremental   = not aligner.has_mixed_prefixes
+    full_align_count = 0
+    for edit in edits:
+        edit(src_rows)
+        src = "".join(src_rows)
+        assert aligner.align(src) == align.align_formatted_str(src)
+
+    if is_incremental:
+        # only the non local changes are aligned completely
+        assert full_align_count == len(edits) + 3
+    else:
+        assert full_align_count == len(edits) * 2
+
+
+def test_document_aligner_many_changes(monkeypatch):
+    src = re.sub(r"(\S) {2,}([=:])", r"\1 \2", ALIGN_SRC)
+    aligner = align.DocumentAligner()
+    aligner.align(src)
+
+    # changes which are far apart are not diffed, the document is aligned completely
+    monkeypatch.setattr(align, 'MAX_DIFF_ROWS', 5)
+    src_rows = align._split_rows(src)
+    row_idxs = [idx for idx, row in enumerate(src_rows) if row.startswith("    ") and " = " in row]
+    for row_idx in (row_idxs[0], row_idxs[-1]):
+        src_rows[row_idx] = src_rows[row_idx].replace(" = ", "_xyz = ", 1)
+    src = "".join(src_rows)
+    with pytest.raises(ValueError, match="Too many changes"):
+        aligner._changed_ranges(src_rows)
+    assert aligner.align(src) == align.align_formatted_str(src)
+
+
+def test_align_only_git_changed(tmp_path, monkeypatch):
+    def _git(*args):
+        sp.run(["git", *args], check=True, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('GIT_AUTHOR_NAME', "test")
+    monkeypatch.setenv('GIT_AUTHOR_EMAIL', "test@example.com")
+    monkeypatch.setenv('GIT_COMMITTER_NAME', "test")
+    monkeypatch.setenv('GIT_COMMITTER_EMAIL', "test@example.com")
+
+    src = "a = 1\nbb = 2\n\nc = 3\ndd = 4\n"
+    pl.Path("module.py").write_text(src, encoding="utf-8")
+    _git("init", "-q")
+    _git("add", "module.py")
+    _git("commit", "-q", "-m", "initial")
+
+    pl.Path("module.py").write_text(src.replace("c = 3", "c = 33"), encoding="utf-8")
+    pl.Path("new.py").write_text(src, encoding="utf-8")
+
+    with pytest.raises(SystemExit) as exc_info:
+        align.main(["--align-only", "--git-changed"])
+    assert exc_info.value.code == 0
+
+    expected_module = "a = 1\nbb = 2\n\nc  = 33\ndd = 4\n"
+    assert pl.Path("module.py").read_text(encoding="utf-8") == expected_module
+    # untracked files are aligned completely
+    assert pl.Path("new.py").read_text(encoding="utf-8") == "a  = 1\nbb = 2\n\nc  = 3\ndd = 4\n"
+
+    with pytest.raises(SystemExit) as exc_info:
+        align.main(["--align-only", "--line-ranges", "1-2", "module.py"])
+    assert exc_info.value.code == 0
+    assert pl.Path("module.py").read_text(encoding="utf-8") == "a  = 1\nbb = 2\n\nc  = 33\ndd = 4\n"
+
+    with pytest.raises(SystemExit) as exc_info:
+        align.main(["--align-only", "--line-ranges", "2-1", "module.py"])
+    assert exc_info.value.code == 2
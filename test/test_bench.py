@@ -0,0 +1,43 @@
+import ast
+import json
+import runpy
+import pathlib as pl
+
+from straitjacket import align
+
+BENCH_PATH = pl.Path(__file__).parent.parent / "scripts" / "bench_align.py"
+
+
+def test_bench_corpus():
+    bench = runpy.run_path(str(BENCH_PATH))
+    for make_src in bench['CORPUS'].values():
+        src = make_src(100)
+        ast.parse(src)
+        align._assert_equivalent(src, align.align_formatted_str(src))
+
+
+def test_bench_main(tmp_path, capsys):
+    bench         = runpy.run_path(str(BENCH_PATH))
+    baseline_path = tmp_path / "baseline.json"
+    assert bench['main'](["--scale", "50", "--repeat", "1", "--save", str(baseline_path)]) == 0
+
+    baseline = json.loads(baseline_path.read_text())
+    stages   = baseline['corpus']['dict_literal']['stages']
+    assert baseline['scale'] == 50
+    assert set(stages) >= {'tokenize', 'contexts', 'cell_groups', 'realign', 'end_to_end'}
+    assert stages['end_to_end']['rows_per_sec'] > 0
+
+    ratios = bench['compare'](baseline, baseline)
+    assert set(ratios.values()) == {1.0}
+
+    # every stage is "slower" than a baseline which took no time at all
+    for corpus_result in baseline['corpus'].values():
+        for stage_result in corpus_result['stages'].values():
+            stage_result['seconds'] = 1e-9
+    baseline_path.write_text(json.dumps(baseline))
+    args = ["--scale", "50", "--repeat", "1", "--compare", str(baseline_path), "--max-ratio", "2"]
+    assert bench['main'](args) == 1
+
+    out, err = capsys.readouterr()
+    assert "tokens/s" in out
+    assert "slower than baseline: dict_literal tokenize" in err
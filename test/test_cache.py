@@ -0,0 +1,114 @@
+# pylint:disable=protected-access
+
+import os
+
+import black
+
+from straitjacket import cache
+from straitjacket import sjfmt
+
+
+def test_cache_key():
+    key = cache.cache_key("x = 1\n", "v1", "mode")
+    assert key == cache.cache_key("x = 1\n", "v1", "mode")
+    assert key != cache.cache_key("x = 1\n", "v2", "mode")
+    assert key != cache.cache_key("x = 1\n", "v1", "other")
+    assert key != cache.cache_key("x = 2\n", "v1", "mode")
+    # key parts are delimited
+    assert cache.cache_key("", "ab", "c") != cache.cache_key("", "a", "bc")
+
+
+def test_result_cache(tmp_path):
+    result_cache = cache.ResultCache(tmp_path, max_size=1000)
+    key          = cache.cache_key("x=1", "v1")
+    assert result_cache.get(key) is None
+
+    result_cache.put(key, "x = 1\n")
+    assert result_cache.get(key) == "x = 1\n"
+
+    # a fresh instance (ie. another process) sees the same entries
+    assert cache.ResultCache(tmp_path).get(key) == "x = 1\n"
+
+
+def test_result_cache_lru_eviction(tmp_path):
+    result_cache = cache.ResultCache(tmp_path, max_size=1000)
+    keys         = [cache.cache_key(str(i)) for i in range(10)]
+    for i, key in enumerate(keys[:9]):
+        result_cache.put(key, "x" * 100)
+        path = result_cache._entry_path(key)
+        os.utime(path, (i, i))
+
+    # access makes the oldest entry the most recently used
+    assert result_cache.get(keys[0]) is not None
+
+    result_cache.put(keys[9], "x" * 200)
+    assert result_cache._total_size <= 800
+
+    assert result_cache.get(keys[0]) is not None
+    assert result_cache.get(keys[9]) is not None
+    assert result_cache.get(keys[1]) is None
+    assert result_cache.get(keys[2]) is None
+    assert result_cache.get(keys[3]) is None
+
+
+def test_result_cache_overwrite(tmp_path):
+    result_cache = cache.ResultCache(tmp_path, max_size=1000)
+    key          = cache.cache_key("x=1", "v1")
+    other_key    = cache.cache_key("x=2", "v1")
+    result_cache.put(other_key, "x" * 100)
+    result_cache.put(key      , "x" * 100)
+    assert result_cache._total_size == 200
+
+    # replacing an entry only counts the difference in size
+    for _ in range(20):
+        result_cache.put(key, "x" * 150)
+    assert result_cache._total_size == 250
+    assert result_cache.get(other_key) is not None
+
+
+def test_format_str_cached(tmp_path, monkeypatch):
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path))
+
+    calls = []
+
+    def _counting_format_str(src_contents, *, mode):
+        calls.append(src_contents)
+        return black.format_str(src_contents, mode=mode)
+
+    monkeypatch.setattr(sjfmt, 'original_format_str', _counting_format_str)
+
+    mode = black.mode.Mode()
+    src  = "x = {'a':1, 'bcd':2}\n"
+    dst  = sjfmt._cached_format_str(src, mode=mode)
+    assert sjfmt._cached_format_str(src, mode=mode) == dst
+    assert len(calls) == 1
+
+    # the effective mode is part of the key
+    sjfmt._cached_format_str(src, mode=black.mode.Mode(line_length=20))
+    assert len(calls) == 2
+
+    # an upgrade of sjfmt reuses the output of black
+    monkeypatch.setattr(sjfmt, '__version__', "v999999.9999")
+    monkeypatch.setattr(
+        sjfmt, 'align_formatted_str', lambda src, recorder=None: src + "# aligned\n"
+    )
+    assert sjfmt._cached_format_str(src, mode=mode) == "x = {'a': 1, 'bcd': 2}\n# aligned\n"
+    assert len(calls) == 2
+
+    # a different version of black invalidates both tiers
+    monkeypatch.setattr(black, '__version__', "99.0")
+    sjfmt._cached_format_str(src, mode=mode)
+    assert len(calls) == 3
+
+    monkeypatch.setenv('SJFMT_CACHE_MAX_SIZE', "0")
+    sjfmt._cached_format_str(src, mode=mode)
+    assert len(calls) == 4
+
+
+def test_format_str_not_cached(tmp_path, monkeypatch):
+    # library calls don't use the persistent cache
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path))
+    mode = black.mode.Mode()
+    assert sjfmt.format_str("x=1\n", mode=mode) == "x = 1\n"
+    assert sjfmt.Engine(mode).format_file_contents("x=1\n") == "x = 1\n"
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,210 @@
+# pylint:disable=protected-access
+"""Scaling of the stages of the alignment with the size of the input.
+
+Each stage is run with inputs of size N, 2N, 4N and 8N. The test fails
+if the runtime or the peak of allocated memory grows faster than the
+declared bound of the stage. The runtime is only checked with --perf,
+since timings depend on the load of the machine.
+
+The inputs and the helpers to prepare them are those of the benchmark
+(scripts/bench_align.py).
+"""
+
+import gc
+import math
+import runpy
+import tracemalloc
+import typing as typ
+import pathlib as pl
+
+import pytest
+
+from straitjacket import align
+from straitjacket import edits
+
+BENCH_PATH = pl.Path(__file__).parent.parent / "scripts" / "bench_align.py"
+
+bench = runpy.run_path(str(BENCH_PATH))
+
+CORPUS            = bench['CORPUS']
+_tokenize         = bench['_tokenize']
+_normalized_table = bench['_normalized_table']
+_contexts         = bench['_contexts']
+_contexts_list    = bench['_contexts_list']
+_realign_args     = bench['_realign_args']
+_realign          = bench['_realign']
+
+# The growth of a stage is the slope of a line fitted to log(size) ->
+# log(runtime or memory), so 1.0 for a linear stage and 2.0 for a
+# quadratic one. Timings are noisy, the tolerance is generous but still
+# well below that of a quadratic stage.
+TIME_TOLERANCE   = 0.45
+MEMORY_TOLERANCE = 0.25
+
+REPEAT = 2
+
+
+def _align_iter(lines: typ.List[str]) -> None:
+    for _ in align.align_formatted_iter(lines):
+        pass
+
+
+def _align_ranges(src: str) -> None:
+    middle_row = src.count("\n") // 2
+    align.align_formatted_ranges(src, [(middle_row, middle_row + 5)])
+
+
+def _edited_document(src: str) -> typ.Tuple[align.DocumentAligner, str]:
+    aligner = align.DocumentAligner()
+    aligner.align(src)
+    # rename a variable in the middle of the document
+    middle = src.index("    value = ", len(src) // 2)
+    return (aligner, src[:middle] + "    value_xyz = " + src[middle + len("    value = ") :])
+
+
+def _align_document(args: typ.Tuple[align.DocumentAligner, str]) -> None:
+    aligner, src = args
+    aligner.align(src)
+
+
+def _aligned_pair(src: str) -> typ.Tuple[str, str]:
+    return (src, align.align_formatted_str(src))
+
+
+def _compute_edits(args: typ.Tuple[str, str]) -> None:
+    edits.compute_edits(*args)
+
+
+class Stage(typ.NamedTuple):
+    fn       : typ.Callable[..., typ.Any]
+    setup    : typ.Callable[..., typ.Any]  # prepares the argument for fn (not measured)
+    corpus   : str  # name of the input in bench_align.CORPUS
+    base_size: int  # scale of the smallest input
+    exponent : float = 1.0  # declared bound: runtime/memory are O(n ** exponent)
+
+
+def _identity(src: str) -> str:
+    return src
+
+
+def _lines(src: str) -> typ.List[str]:
+    return src.splitlines(keepends=True)
+
+
+# A quadratic term only shows once it is larger than the linear work of
+# a stage, which requires large inputs. The tokenizer is run with short
+# tokens in long rows (so copying the rest of the source after each
+# token would show) and the cell groups with a single long cell group
+# (so copying a cell group for each of its cells would show).
+STAGES = {
+    'tokenize'            : Stage(_tokenize                , _identity        , 'enum_class'  , 2000),
+    'token_table'         : Stage(align.TokenTable         , _identity        , 'mixed_module',  400),
+    'contexts'            : Stage(_contexts                , _normalized_table, 'mixed_module',  400),
+    'cell_groups'         : Stage(align._find_cell_groups  , _contexts_list   , 'dict_literal', 2000),
+    'realigned_contents'  : Stage(_realign                 , _realign_args    , 'mixed_module',  400),
+    'align_formatted_str' : Stage(align.align_formatted_str, _identity        , 'enum_class'  , 2000),
+    'align_formatted_iter': Stage(_align_iter              , _lines           , 'mixed_module',  400),
+    'align_ranges'        : Stage(_align_ranges            , _identity        , 'mixed_module',  400),
+    'document_aligner'    : Stage(_align_document          , _edited_document , 'mixed_module',  400),
+    'compute_edits'       : Stage(_compute_edits           , _aligned_pair    , 'mixed_module',  400),
+}
+
+
+def _sizes(base_size: int) -> typ.List[int]:
+    return [base_size, base_size * 2, base_size * 4, base_size * 8]
+
+
+def _min_duration(stage: Stage, src: str) -> float:
+    return bench['_min_duration'](stage.fn, lambda: stage.setup(src), REPEAT)
+
+
+def _peak_memory(stage: Stage, src: str) -> int:
+    arg = stage.setup(src)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        stage.fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def _growth(sizes: typ.List[int], values: typ.List[float]) -> float:
+    """Slope of the least squares fit of log(sizes) -> log(values).
+
+    >>> round(_growth([1, 2, 4, 8], [3, 6, 12, 24]), 3)
+    1.0
+    >>> round(_growth([1, 2, 4, 8], [3, 12, 48, 192]), 3)
+    2.0
+    """
+    xs     = [math.log(size) for size in sizes]
+    ys     = [math.log(max(value, 1e-9)) for value in values]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    cov    = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    var    = sum((x - x_mean) ** 2 for x in xs)
+    return cov / var
+
+
+def _time_growth(stage: Stage) -> float:
+    make_src  = CORPUS[stage.corpus]
+    sizes     = _sizes(stage.base_size)
+    durations = [_min_duration(stage, make_src(size)) for size in sizes]
+    return _growth(sizes, durations)
+
+
+def _memory_growth(stage: Stage) -> float:
+    # Memory is not noisy (but tracing allocations is slow), so it is
+    # measured with smaller inputs.
+    make_src = CORPUS[stage.corpus]
+    sizes    = _sizes(stage.base_size // 4)
+    memory   = [_peak_memory(stage, make_src(size)) for size in sizes]
+    return _growth(sizes, memory)
+
+
+@pytest.mark.parametrize("stage_name", sorted(STAGES))
+def test_memory_scaling(stage_name):
+    stage = STAGES[stage_name]
+    assert _memory_growth(stage) < stage.exponent + MEMORY_TOLERANCE
+
+
+@pytest.mark.perf
+@pytest.mark.parametrize("stage_name", sorted(STAGES))
+def test_time_scaling(stage_name):
+    stage = STAGES[stage_name]
+    assert _time_growth(stage) < stage.exponent + TIME_TOLERANCE
+
+
+def _reslicing_tokenize(src: str) -> None:
+    # copies the rest of the source after each token
+    rest = src
+    for _, _, end in align._iter_token_spans(src):
+        rest = src[end:]
+    assert not rest
+
+
+def _concatenating_cell_groups(contexts: typ.List[align.AlignmentContext]) -> None:
+    # copies the cell group for each cell which is added
+    cells: typ.List[align.AlignmentContext] = []
+    for ctx in contexts:
+        cells = cells + [ctx]
+
+
+def _quadratic_memory(src: str) -> None:
+    rows = src.splitlines(keepends=True)
+    _    = [rows[:idx] for idx in range(len(rows))]
+
+
+@pytest.mark.perf
+def test_scaling_detects_quadratic():
+    # the regressions of the tokenizer and of the cell groups which the
+    # corpus and the sizes of STAGES are chosen for (with the old code,
+    # the growth of these stages was 1.7-2.0)
+    stage = STAGES['tokenize']._replace(fn=_reslicing_tokenize)
+    assert _time_growth(stage) > stage.exponent + TIME_TOLERANCE
+    stage = STAGES['cell_groups']._replace(fn=_concatenating_cell_groups)
+    assert _time_growth(stage) > stage.exponent + TIME_TOLERANCE
+
+    stage = Stage(_quadratic_memory, _identity, 'mixed_module', 400)
+    assert _memory_growth(stage) > stage.exponent + MEMORY_TOLERANCE
@@ -0,0 +1,77 @@
+import os
+import time
+import signal
+import multiprocessing as mp
+
+import pytest
+
+from straitjacket import prefork
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason="requires os.fork")
+
+
+def _wait_for(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(0.05)
+    raise AssertionError("timeout")
+
+
+def _run_supervisor(pids_dir, socket_path):
+    def _serve(socks):
+        pid_path = os.path.join(pids_dir, str(os.getpid()))
+
+        def _on_term(signum, frame):
+            os.unlink(pid_path)
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, _on_term)
+        open(pid_path, mode="w").close()
+        while True:
+            conn, _ = socks[0].accept()
+            conn.sendall(str(os.getpid()).encode("ascii"))
+            conn.close()
+
+    socks = prefork.listen_sockets(socket_path=socket_path)
+    prefork.Supervisor(_serve, socks, num_processes=2).run()
+
+
+def test_supervisor(tmp_path):
+    pids_dir    = tmp_path / "pids"
+    socket_path = str(tmp_path / "prefork.sock")
+    pids_dir.mkdir()
+
+    def _pids():
+        return {int(name) for name in os.listdir(pids_dir)}
+
+    ctx        = mp.get_context('fork')
+    supervisor = ctx.Process(target=_run_supervisor, args=(str(pids_dir), socket_path))
+    supervisor.start()
+    try:
+        pids = _wait_for(lambda: len(_pids()) == 2 and _pids())
+
+        # crashed processes are restarted
+        crashed_pid = min(pids)
+        os.kill(crashed_pid, signal.SIGKILL)
+        os.unlink(pids_dir / str(crashed_pid))
+        restarted_pids = _wait_for(lambda: len(_pids()) == 2 and _pids())
+        assert crashed_pid not in restarted_pids
+        assert max(pids) in restarted_pids
+
+        # the processes are replaced on reload
+        os.kill(supervisor.pid, signal.SIGHUP)
+        reloaded_pids = _wait_for(
+            lambda: len(_pids()) == 2 and not (_pids() & restarted_pids) and _pids()
+        )
+        assert len(reloaded_pids) == 2
+
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join(timeout=10)
+        assert supervisor.exitcode == 0
+        assert _pids() == set()
+    finally:
+        if supervisor.is_alive():
+            supervisor.kill()
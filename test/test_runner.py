@@ -0,0 +1,108 @@
+# pylint:disable=protected-access
+
+import black
+import black.cache
+import pytest
+
+from straitjacket import runner
+
+UNFORMATTED = "x=1\nfoo=2\n"
+FORMATTED   = "x   = 1\nfoo = 2\n"
+
+
+@pytest.fixture()
+def black_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path / "cache"))
+    monkeypatch.setattr(black.cache, 'CACHE_DIR', tmp_path / "mtimes")
+    return tmp_path / "mtimes"
+
+
+def _write_sources(tmp_path):
+    sources = set()
+    for i in range(10):
+        path = tmp_path / f"mod{i}.py"
+        path.write_text(UNFORMATTED * (i + 1))
+        sources.add(path)
+
+    path = tmp_path / "ok.py"
+    path.write_text(FORMATTED)
+    sources.add(path)
+    return sources
+
+
+def test_chunk_sources():
+    sizes  = {f"mod{i}.py": i * 100 for i in range(1, 11)}
+    chunks = runner.chunk_sources(sizes, workers=2)
+    paths  = [path for chunk in chunks for path in chunk]
+    assert sorted(paths) == sorted(sizes)
+    # largest first
+    assert paths == sorted(sizes, key=sizes.get, reverse=True)
+    assert chunks[0] == ["mod10.py"]
+    assert len(chunks) > 2
+
+    chunks = runner.chunk_sources(sizes, workers=1, max_files=2)
+    assert all(len(chunk) <= 2 for chunk in chunks)
+
+    assert runner.chunk_sources({}, workers=4) == []
+
+
+def test_reformat_many(tmp_path, black_cache_dir):
+    sources = _write_sources(tmp_path)
+    mode    = black.Mode(line_length=100)
+
+    report = black.Report(check=True)
+    runner.reformat_many(sources, False, black.WriteBack.CHECK, mode, report, workers=2)
+    assert (report.change_count, report.same_count, report.failure_count) == (10, 1, 0)
+    assert (tmp_path / "mod0.py").read_text() == UNFORMATTED
+
+    report = black.Report()
+    runner.reformat_many(sources, False, black.WriteBack.YES, mode, report, workers=2)
+    assert (report.change_count, report.same_count, report.failure_count) == (10, 1, 0)
+    assert (tmp_path / "mod0.py").read_text() == FORMATTED
+    assert (tmp_path / "mod2.py").read_text() == FORMATTED * 3
+
+    # unchanged files are skipped using the cache of black
+    report = black.Report()
+    runner.reformat_many(sources, False, black.WriteBack.YES, mode, report, workers=2)
+    assert (report.change_count, report.same_count, report.failure_count) == (0, 11, 0)
+
+
+def test_reformat_many_diff(tmp_path, black_cache_dir, capfd):
+    sources = _write_sources(tmp_path)
+    bad_src = tmp_path / "bad.py"
+    bad_src.write_text("x = (\n")
+    sources.add(bad_src)
+
+    report = black.Report()
+    mode   = black.Mode(line_length=100)
+    runner.reformat_many(sources, True, black.WriteBack.DIFF, mode, report, workers=2)
+    assert (report.change_count, report.same_count, report.failure_count) == (10, 1, 1)
+
+    out, err = capfd.readouterr()
+    assert out.count("+++ ") == 10
+    assert "+x   = 1" in out
+    assert "bad.py" in err
+    # nothing is written for --diff
+    assert (tmp_path / "mod0.py").read_text() == UNFORMATTED
+
+
+def test_reformat_many_stats(tmp_path, black_cache_dir):
+    sources   = _write_sources(tmp_path)
+    mode      = black.Mode(line_length=100)
+    all_stats = []
+
+    report = black.Report(check=True)
+    runner.reformat_many(
+        sources, False, black.WriteBack.CHECK, mode, report, workers=2, stats_hook=all_stats.append
+    )
+    assert sorted(file_stats.path for file_stats in all_stats) == sorted(map(str, sources))
+    assert all(file_stats.timings['black'] > 0 for file_stats in all_stats)
+
+    # a single file is formatted in this process
+    all_stats.clear()
+    src    = tmp_path / "mod0.py"
+    report = black.Report()
+    runner.reformat_one(src, False, black.WriteBack.YES, mode, report, stats_hook=all_stats.append)
+    assert (report.change_count, report.failure_count) == (1, 0)
+    assert src.read_text() == FORMATTED
+    assert [file_stats.path for file_stats in all_stats] == [str(src)]
@@ -6,11 +6,16 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import io
 import os
+import json
+import concurrent.futures as cf
 
 import black
+import pytest
 
 from straitjacket import sjfmt
+from straitjacket import stats
 
 STR_CONTENTS = """
 #!/usr/bin/env python3
@@ -138,11 +143,7 @@ def _fmt(code: str) -> str:
     blackend_code = sjfmt.original_format_str(code, mode=mode)
     assert blackend_code == code
 
-    sjfmt.DEBUG_LVL = 0
-    try:
-        sjfmt_out_code = sjfmt.align_formatted_str(code)
-    finally:
-        sjfmt.DEBUG_LVL = 0
+    sjfmt_out_code = sjfmt.align_formatted_str(code)
 
     black.assert_equivalent(code, sjfmt_out_code)
     return sjfmt_out_code
@@ -400,3 +401,113 @@ def test_debug():
     '''
 
     assert _fmt(unfmt) == _(expected)
+
+
+def test_engine():
+    engine = sjfmt.Engine(black.FileMode(line_length=100), use_cache=False)
+    assert engine.format_str("x=1\nfoo=2\n") == "x   = 1\nfoo = 2\n"
+    assert engine.format_file_contents("x=1\nfoo=2\n") == "x   = 1\nfoo = 2\n"
+
+    with pytest.raises(black.NothingChanged):
+        engine.format_file_contents("x   = 1\nfoo = 2\n")
+    with pytest.raises(black.NothingChanged):
+        engine.format_file_contents("\n")
+
+
+def test_engine_threads():
+    engine   = sjfmt.Engine(use_cache=False)
+    mode     = black.FileMode()
+    sources  = [f"x{'y' * i}={i}\nfoo={{'a':{i}}}\n" for i in range(40)]
+    expected = [engine.format_str(src) for src in sources]
+
+    def _black_format_str(src):
+        return black.format_str(src, mode=mode)
+
+    with cf.ThreadPoolExecutor(max_workers=8) as executor:
+        sjfmt_results = executor.map(engine.format_str, sources)
+        black_results = executor.map(_black_format_str, sources)
+        assert list(sjfmt_results) == expected
+        # black itself is not affected by the formatting of sjfmt
+        assert list(black_results) == [sjfmt.original_format_str(src, mode=mode) for src in sources]
+
+    assert black.format_str is sjfmt.original_format_str
+
+
+def test_document():
+    engine   = sjfmt.Engine(use_cache=False)
+    document = sjfmt.Document(use_cache=False)
+    sources  = ["x=1\nfoo=2\n\nbar=3\n", "x=1\nfoobar=2\n\nbar=3\n", "x=1\n\nbar=3\nbaz=4\n"]
+    for src in sources:
+        assert document.format_str(src) == engine.format_str(src)
+        assert document.format_file_contents(src) == engine.format_file_contents(src)
+
+
+def test_engine_stats_hook(tmp_path, monkeypatch):
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path))
+    all_stats = []
+    engine    = sjfmt.Engine(
+        black.FileMode(line_length=100), use_cache=True, stats_hook=all_stats.append
+    )
+
+    assert engine.format_file_contents("x=1\nfoo=2\n") == "x   = 1\nfoo = 2\n"
+    with pytest.raises(black.NothingChanged):
+        engine.format_file_contents("x   = 1\nfoo = 2\n")
+
+    stats_1, stats_2 = all_stats
+    assert set(stats_1.timings) == set(stats.STAGES) - {'align'}
+    assert stats_1.cache_misses == {'results': 1, 'black': 1}
+
+    assert stats_1.counts == {'rows': 3, 'tokens': 8, 'cell_groups': 1, 'aligned_cells': 2}
+
+    # the result was cached by the second pass of the check
+    assert stats_2.cache_hits == {'results': 1}
+    assert stats_2.timings    == {}
+
+    # the second pass of the check is not recorded separately
+    assert engine.format_str("y=1\n") == "y = 1\n"
+    assert len(all_stats) == 3
+    assert all_stats[2].cache_misses == {'results': 1, 'black': 1}
+    assert 'check' not in all_stats[2].timings
+
+
+def test_main_stats(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path / "cache"))
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    (src_dir / "a.py").write_text("x=1\nfoo=2\n")
+    (src_dir / "b.py").write_text("y = 1\n")
+
+    with pytest.raises(SystemExit):
+        sjfmt.main(["--stats", "--check", "-q", "-W", "1", str(src_dir)])
+
+    out, err = capsys.readouterr()
+    assert out == ""
+    data = json.loads(err)
+    assert data['total']['files' ] == 2
+    assert data['total']['counts']['rows'] == 5
+    assert {file_data['path'] for file_data in data['files']} == {
+        str(src_dir / "a.py"),
+        str(src_dir / "b.py"),
+    }
+    assert sjfmt._cli_stats   is None
+    assert black.reformat_one is sjfmt.original_reformat_one
+
+
+def test_main_stats_stdin(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('SJFMT_CACHE_DIR', str(tmp_path / "cache"))
+    monkeypatch.setattr("sys.stdin", io.TextIOWrapper(io.BytesIO(b"x=1\nfoo=2\n")))
+    stats_path = tmp_path / "stats.json"
+
+    with pytest.raises(SystemExit) as exc_info:
+        sjfmt.main(["--stats-file", str(stats_path), "-q", "-"])
+    assert exc_info.value.code == 0
+
+    # the stats are not mixed into the formatted code
+    out, _ = capsys.readouterr()
+    assert out == "x   = 1\nfoo = 2\n"
+    data = json.loads(stats_path.read_text())
+    assert data['total']['files'] == 1
+    assert data['files'][0]['path'  ] == "-"
+    assert data['files'][0]['counts']['rows'] == 3
+    assert sjfmt._cli_stats_path      is None
+    assert black.format_file_contents is not sjfmt._format_stdin_contents
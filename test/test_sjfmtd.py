@@ -0,0 +1,337 @@
+# pylint:disable=protected-access
+
+import json
+import asyncio
+import threading
+import concurrent.futures as cf
+
+import black
+import pytest
+from aiohttp import web
+from aiohttp import test_utils
+
+from straitjacket import sjfmt
+from straitjacket import edits
+from straitjacket import client
+from straitjacket import sjfmtd
+
+SRC = "x = {'a':1, 'bcd':2}\n"
+DST = "x = {'a': 1, 'bcd': 2}\n"
+
+
+@pytest.fixture
+def formatter(monkeypatch):
+    calls               = []
+    original_format_str = sjfmt.original_format_str
+
+    def _counting_format_str(src_contents, *, mode):
+        calls.append(src_contents)
+        return original_format_str(src_contents, mode=mode)
+
+    monkeypatch.setenv('SJFMT_CACHE_MAX_SIZE', "0")
+    monkeypatch.setattr(sjfmt, 'original_format_str', _counting_format_str)
+    return calls
+
+
+def _request_all(app, requests):
+    async def _run():
+        responses = []
+        async with test_utils.TestClient(test_utils.TestServer(app)) as client:
+            for method, path, data, headers in requests:
+                resp = await client.request(method, path, data=data, headers=headers)
+                body = await resp.text()
+                responses.append((resp.status, body))
+        return responses
+
+    return asyncio.run(_run())
+
+
+def test_response_cache():
+    response_cache = sjfmtd.ResponseCache(max_size=2000)
+    result         = sjfmtd.FormatResult(200, "x" * 500)
+
+    assert response_cache.get(("a",)) is None
+    response_cache.put(("a",), result)
+    response_cache.put(("b",), result)
+    response_cache.put(("c",), result)
+    assert response_cache.get(("a",)) == result
+    assert response_cache.stats()['hits'] == 1
+    assert response_cache.stats()['misses'] == 1
+
+    # "b" is the least recently used entry
+    response_cache.put(("d",), result)
+    assert len(response_cache) == 3
+    assert response_cache.get(("b",)) is None
+    assert response_cache.get(("a",)) == result
+    assert response_cache.size <= response_cache.max_size
+
+
+def test_sjfmtd_cached(formatter):
+    with cf.ThreadPoolExecutor() as executor:
+        app       = sjfmtd.make_app(executor=executor)
+        responses = _request_all(
+            app,
+            [
+                ('POST', "/", SRC, {}),
+                ('POST', "/", SRC, {}),
+                ('POST', "/", DST, {}),
+                ('POST', "/", SRC, {'X-Line-Length': "10"}),
+                ('POST', "/", SRC, {'X-Diff': "1"}),
+                ('POST', "/", SRC, {'X-Line-Length': "abc"}),
+                ('GET' , "/stats", None, {}),
+            ],
+        )
+
+    assert responses[0] == (200, DST)
+    assert responses[1] == (200, DST)
+    assert responses[2] == (204, "")
+    assert responses[3][0] == 200
+    assert responses[4][0] == 200
+    assert "+x = {'a': 1, 'bcd': 2}" in responses[4][1]
+    assert responses[5][0] == 400
+
+    # the format_file_contents of black formats twice (to check stability)
+    assert formatter == [SRC, DST, DST, SRC, responses[3][1]]
+    assert '"hits": 2' in responses[6][1]
+    assert '"misses": 3' in responses[6][1]
+
+
+def test_sjfmtd_document(formatter):
+    src_v1 = "x=1\nfoo=2\n\n\ndef f():\n    a=1\n    bb=2\n"
+    src_v2 = src_v1.replace("bb=2", "bbb=2")
+    doc_id = {'X-Document-Id': "doc1"}
+    with cf.ThreadPoolExecutor() as executor:
+        app       = sjfmtd.make_app(executor=executor)
+        responses = _request_all(
+            app,
+            [
+                ('POST', "/", src_v1, doc_id),
+                ('POST', "/", src_v2, doc_id),
+                ('POST', "/", src_v2, {}),
+                ('POST', "/", "x = (\n", doc_id),
+                ('POST', "/", "x = 1\n", {**doc_id, 'X-Fast-Or-Safe': "fast"}),
+            ],
+        )
+
+    engine = sjfmt.Engine(use_cache=False)
+    assert responses[0] == (200, engine.format_str(src_v1))
+    assert responses[1] == (200, engine.format_str(src_v2))
+    # same result from the response cache
+    assert responses[2] == responses[1]
+    assert responses[3][0] == 400
+    assert responses[4] == (204, "")
+
+
+def test_document_cache():
+    documents = sjfmtd.DocumentCache(max_documents=2)
+    mode      = black.FileMode()
+    doc_a     = documents.get({'X-Document-Id': "a"}, mode, False)
+    assert documents.get({'X-Document-Id': "a"}, mode, False) is doc_a
+    assert documents.get({'X-Document-Id': "a", 'X-Line-Length': "10"}, mode, False) is not doc_a
+    documents.get({'X-Document-Id': "b"}, mode, False)
+    assert len(documents) == 2
+    # "a" with the default mode was evicted
+    assert documents.get({'X-Document-Id': "a"}, mode, False) is not doc_a
+
+
+def test_init_worker():
+    sjfmtd._init_worker()
+    # workers don't monkey patch black
+    assert black.format_str is sjfmt.original_format_str
+
+
+def test_make_executor(monkeypatch):
+    monkeypatch.setenv('SJFMT_CACHE_MAX_SIZE', "0")
+    with sjfmtd.make_executor(workers=2) as executor:
+        pids   = {executor.submit(sjfmtd._worker_pid).result() for _ in range(20)}
+        result = executor.submit(sjfmtd._format_file_contents, SRC, False, black.mode.Mode())
+        assert result.result() == sjfmtd.FormatResult(200, DST)
+    assert 1 <= len(pids) <= 2
+
+
+def test_sjfmtd_batch(formatter):
+    batch = {
+        'files': [
+            {'path': "a.py", 'source': SRC},
+            {'path': "b.py", 'source': DST},
+            {'path': "c.py", 'source': SRC, 'headers': {'x-line-length': "abc"}},
+            {'path': "d.py", 'source': "x = = 1\n"},
+            {'path': "e.py"},
+            {'path': "f.py", 'source': SRC, 'headers': {'X-Line-Length': "10"}},
+        ]
+    }
+    with cf.ThreadPoolExecutor() as executor:
+        app       = sjfmtd.make_app(executor=executor)
+        responses = _request_all(
+            app,
+            [
+                ('POST', "/batch", json.dumps(batch), {}),
+                ('POST', "/batch", "[]", {}),
+                ('POST', "/", SRC, {}),
+            ],
+        )
+
+    status, body = responses[0]
+    assert status == 200
+    file_results = sorted(
+        (json.loads(line) for line in body.splitlines()), key=lambda r: r['index']
+    )
+    assert [r['path'] for r in file_results] == ["a.py", "b.py", "c.py", "d.py", None, "f.py"]
+    assert [r['status'] for r in file_results] == [200, 204, 400, 400, 400, 200]
+    assert file_results[0]['text'] == DST
+    assert file_results[5]['text'].startswith("x = {\n")
+
+    assert responses[1][0] == 400
+    # results of a batch are cached
+    assert responses[2] == (200, DST)
+    assert formatter.count(SRC) == 2
+
+
+def test_sjfmtd_batch_large(formatter):
+    # a long comment is cheap to format, but the batch is over 1 MiB
+    large_src = "# " + "x" * 200_000 + "\n" + DST
+    batch     = {'files': [{'path': f"{i}.py", 'source': large_src} for i in range(6)]}
+    body      = json.dumps(batch)
+    assert len(body) > 1024 * 1024
+
+    with cf.ThreadPoolExecutor() as executor:
+        app             = sjfmtd.make_app(executor=executor)
+        responses       = _request_all(app, [('POST', "/batch", body, {})])
+        small_app       = sjfmtd.make_app(executor=executor, max_body_size=1024)
+        small_responses = _request_all(small_app, [('POST', "/batch", body, {})])
+
+    status, body = responses[0]
+    assert status == 200
+    assert sorted(json.loads(line)['status'] for line in body.splitlines()) == [204] * 6
+    assert small_responses[0][0] == 413
+
+
+@pytest.fixture
+def unix_server(formatter, tmp_path):
+    socket_path = str(tmp_path / "sjfmtd.sock")
+    loop        = asyncio.new_event_loop()
+    executor    = cf.ThreadPoolExecutor()
+    runner      = web.AppRunner(sjfmtd.make_app(executor=executor))
+
+    async def _start():
+        await runner.setup()
+        await web.UnixSite(runner, socket_path).start()
+
+    loop.run_until_complete(_start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield socket_path
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        executor.shutdown()
+
+
+def test_unix_socket_client(unix_server, formatter):
+    with client.Client(socket_path=unix_server) as sjfmtd_client:
+        assert sjfmtd_client.format_str(SRC) == DST
+        assert sjfmtd_client.format_str(DST) == DST
+        assert sjfmtd_client.format_str(SRC, line_length=10).startswith("x = {\n")
+        with pytest.raises(client.ClientError) as exc_info:
+            sjfmtd_client.format_str("x = = 1\n")
+        assert exc_info.value.status == 400
+
+        # the connection is reused
+        conn = sjfmtd_client._conn
+        assert sjfmtd_client.format_str(SRC) == DST
+        assert sjfmtd_client._conn is conn
+
+        batch_results = list(sjfmtd_client.format_batch([("a.py", SRC), ("b.py", DST)]))
+        assert sorted((r['path'], r['status']) for r in batch_results) == [
+            ("a.py", 200),
+            ("b.py", 204),
+        ]
+
+    assert formatter.count(SRC) == 2
+
+
+def test_sjfmtd_edits(unix_server, formatter):
+    src = "".join(f"def f{i}():\n    return {i}\n\n\n" for i in range(20)) + "x=1\nfoo=2\n"
+    dst = src.replace("x=1\nfoo=2\n", "x   = 1\nfoo = 2\n")
+
+    with client.Client(socket_path=unix_server) as sjfmtd_client:
+        src_edits = sjfmtd_client.format_edits(src)
+        assert src_edits == [edits.Edit(80, 82, "x   = 1\nfoo = 2\n")]
+        assert edits.apply_edits(src, src_edits) == dst
+        assert sjfmtd_client.format_edits(dst) == []
+        assert sjfmtd_client.format_edits(src, document_id="a.py") == src_edits
+        assert sjfmtd_client.format_str(src, document_id="a.py") == dst
+
+        batch_results = list(sjfmtd_client.format_batch([("a.py", src)], line_length=88))
+
+    with cf.ThreadPoolExecutor() as executor:
+        app       = sjfmtd.make_app(executor=executor)
+        batch     = {'files': [{'path': "a.py", 'source': src, 'headers': {'X-Edits': "1"}}]}
+        responses = _request_all(app, [('POST', "/batch", json.dumps(batch), {})])
+
+    assert batch_results[0]['text'] == dst
+    file_result = json.loads(responses[0][1])
+    assert file_result['edits'] == [{'start': 80, 'end': 82, 'text': "x   = 1\nfoo = 2\n"}]
+    assert 'text' not in file_result
+
+
+def test_client_batch_split(unix_server, formatter):
+    files = [(f"{i}.py", SRC if i % 2 else DST) for i in range(5)]
+    with client.Client(socket_path=unix_server, max_batch_size=100) as sjfmtd_client:
+        batch_results = list(sjfmtd_client.format_batch(files))
+
+    assert formatter.count(SRC) == 1
+    # indexes are those of the files, not of each request
+    assert sorted((r['index'], r['path'], r['status']) for r in batch_results) == [
+        (0, "0.py", 204),
+        (1, "1.py", 200),
+        (2, "2.py", 204),
+        (3, "3.py", 200),
+        (4, "4.py", 204),
+    ]
+
+
+def test_client_unavailable(tmp_path):
+    sjfmtd_client = client.Client(socket_path=str(tmp_path / "missing.sock"))
+    with pytest.raises(OSError):
+        sjfmtd_client.format_str(SRC)
+
+
+def test_client_main(unix_server, formatter, tmp_path, capsys):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    (src_dir / "a.py").write_text(SRC)
+    (src_dir / "b.py").write_text(DST)
+    (src_dir / "c.py").write_bytes(SRC.replace("\n", "\r\n").encode("utf-8"))
+
+    with pytest.raises(SystemExit) as exc_info:
+        client.main(["--server", "--socket", unix_server, "--check", str(src_dir)])
+    assert exc_info.value.code == 1
+    assert (src_dir / "a.py").read_text() == SRC
+
+    with pytest.raises(SystemExit) as exc_info:
+        client.main(["--server", "--socket", unix_server, str(src_dir)])
+    assert exc_info.value.code == 0
+    assert (src_dir / "a.py").read_text() == DST
+    assert (src_dir / "b.py").read_text() == DST
+    assert (src_dir / "c.py").read_bytes() == DST.replace("\n", "\r\n").encode("utf-8")
+
+    stderr = capsys.readouterr().err
+    assert "would reformat" in stderr
+    assert "reformatted" in stderr
+    assert "b.py" not in stderr
+
+
+def test_client_main_fallback(monkeypatch, tmp_path):
+    fallback_args = []
+    monkeypatch.setattr(sjfmt, 'main', lambda args: fallback_args.extend(args))
+
+    missing_socket = str(tmp_path / "missing.sock")
+    client.main(["--server", "--socket", missing_socket, "-l", "100", "--check", "a.py"])
+    assert fallback_args == ["--check", "--line-length", "100", "a.py"]
+
+    del fallback_args[:]
+    client.main(["--server", "--socket", missing_socket, "--extend-exclude", "/gen/", "src"])
+    assert fallback_args == ["--extend-exclude", "/gen/", "src"]
@@ -0,0 +1,139 @@
+import pathlib as pl
+
+import black
+import click
+import pytest
+
+from straitjacket import sources
+
+
+def _make_project(root: pl.Path) -> None:
+    (root / ".git").mkdir()
+
+    (root / ".gitignore").write_text("generated/\n*_pb2.py\n")
+    for rel_path in [
+        "a.py",
+        "b.pyi",
+        "notes.txt",
+        "api_pb2.py",
+        "generated/c.py",
+        "build/d.py",
+        ".venv/lib/e.py",
+        "pkg/f.py",
+        "pkg/vendor/g.py",
+    ]:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("x = 1\n")
+    (root / "pkg" / ".gitignore").write_text("vendor/\n")
+
+
+def _rel_paths(root: pl.Path, paths) -> list:
+    return [path.relative_to(root).as_posix() for path in paths]
+
+
+def test_iter_paths(tmp_path):
+    _make_project(tmp_path)
+    src = str(tmp_path)
+
+    paths = sources.iter_paths([src])
+    assert _rel_paths(tmp_path, paths) == ["a.py", "b.pyi", "pkg/f.py"]
+
+    # --exclude replaces the default excludes and the .gitignore files
+    src_filter = sources.source_filter([src], exclude=r"/pkg/")
+    paths      = sources.iter_paths([src], src_filter)
+    assert _rel_paths(tmp_path, paths) == [
+        ".venv/lib/e.py",
+        "a.py",
+        "api_pb2.py",
+        "b.pyi",
+        "build/d.py",
+        "generated/c.py",
+    ]
+
+    src_filter = sources.source_filter([src], extend_exclude=r"/b\.pyi$", include=r"\.pyi?$")
+    paths      = sources.iter_paths([src], src_filter)
+    assert _rel_paths(tmp_path, paths) == ["a.py", "pkg/f.py"]
+
+
+def test_iter_paths_explicit(tmp_path):
+    _make_project(tmp_path)
+    api_path = str(tmp_path / "api_pb2.py")
+    # files which are given explicitly are only excluded by force_exclude
+    assert list(sources.iter_paths([api_path])) == [pl.Path(api_path)]
+
+    src_filter = sources.source_filter([api_path], force_exclude=r"_pb2\.py$")
+    assert list(sources.iter_paths([api_path], src_filter)) == []
+
+
+def test_source_filter_config(tmp_path):
+    _make_project(tmp_path)
+    (tmp_path / "pyproject.toml").write_text('[tool.black]\nextend-exclude = "/pkg/"\n')
+
+    paths = sources.iter_paths([str(tmp_path)])
+    assert _rel_paths(tmp_path, paths) == ["a.py", "b.pyi"]
+
+    config_path = tmp_path / "other.toml"
+    config_path.write_text('[tool.black]\nforce-exclude = "/a\\\\.py$"\n')
+    src_filter = sources.source_filter([str(tmp_path)], config=str(config_path))
+    paths      = sources.iter_paths([str(tmp_path)], src_filter)
+    assert _rel_paths(tmp_path, paths) == ["b.pyi", "pkg/f.py"]
+
+    with pytest.raises(ValueError):
+        sources.source_filter([str(tmp_path)], exclude="(")
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {},
+        {'exclude': r"/pkg/"},
+        {'extend_exclude': r"/b\.pyi$", 'include': r"\.pyi?$"},
+        {'force_exclude': r"/f\.py$"},
+    ],
+)
+def test_iter_paths_same_as_black(tmp_path, kwargs):
+    _make_project(tmp_path)
+    (tmp_path / "pkg" / "notebook.ipynb").write_text("{}")
+    srcs       = [str(tmp_path), str(tmp_path / "api_pb2.py")]
+    src_filter = sources.source_filter(srcs, **kwargs)
+
+    black_sources = black.get_sources(
+        ctx=click.Context(black.main),
+        src=tuple(srcs),
+        quiet=True,
+        verbose=False,
+        report=black.Report(quiet=True),
+        stdin_filename=None,
+        **src_filter._asdict(),
+    )
+    assert set(sources.iter_paths(srcs, src_filter)) == black_sources
+
+
+def test_read_write_source(tmp_path):
+    path = tmp_path / "crlf.py"
+    path.write_bytes(b"a = 1\r\nb = 2\r\n")
+
+    src_contents, encoding, newline = sources.read_source(path)
+    assert src_contents == "a = 1\nb = 2\n"
+    assert (encoding, newline) == ("utf-8", "\r\n")
+
+    sources.write_source(path, "a  = 1\nb = 2\n", encoding, newline)
+    assert path.read_bytes() == b"a  = 1\r\nb = 2\r\n"
+
+
+def test_read_write_source_encoding(tmp_path):
+    path      = tmp_path / "latin1.py"
+    src_bytes = "# -*- coding: latin-1 -*-\nname = 'Zoë'\n".encode("latin-1")
+    path.write_bytes(src_bytes)
+
+    src_contents, encoding, newline = sources.read_source(path)
+    assert src_contents == "# -*- coding: latin-1 -*-\nname = 'Zoë'\n"
+    assert (encoding, newline) == ("iso-8859-1", "\n")
+
+    sources.write_source(path, src_contents.replace("name", "name "), encoding, newline)
+    assert path.read_bytes() == src_bytes.replace(b"name", b"name ")
+
+    path.write_bytes(b"\xef\xbb\xbfx = 1\n")
+    src_contents, encoding, _ = sources.read_source(path)
+    assert (src_contents, encoding) == ("x = 1\n", "utf-8-sig")
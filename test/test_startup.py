@@ -0,0 +1,88 @@
+import os
+import sys
+import subprocess as sp
+import pathlib as pl
+
+import pytest
+
+import straitjacket
+
+SRC_DIR = str(pl.Path(straitjacket.__file__).parent.parent)
+
+# Budgets for the cumulative import time (in milliseconds, including the
+# standard library modules which are imported), recorded as roughly 3x
+# of the time on a developer machine (with compiled bytecode). Paths
+# which don't need black must not import any of HEAVY_MODULES.
+IMPORT_BUDGETS_MS = {
+    'straitjacket'         :  50,
+    "straitjacket.align"   :  80,
+    "straitjacket.client"  : 200,
+    "straitjacket.__main__":  50,
+}
+
+HEAVY_MODULES = {'black', 'blackd', 'click', 'aiohttp', 'multiprocessing', 'platformdirs'}
+
+
+def _importtime(code: str) -> str:
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    cmd    = [sys.executable, "-X", "importtime", "-c", code]
+    result = sp.run(cmd, env=env, stdout=sp.PIPE, stderr=sp.PIPE, check=True)
+    return result.stderr.decode("utf-8")
+
+
+def _import_times(code: str) -> dict:
+    """Cumulative import time in microseconds by module name."""
+    import_times = {}
+    for line in _importtime(code).splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative, module_name = line[len("import time:") :].split("|")
+            import_times[module_name.strip()] = int(cumulative)
+    return import_times
+
+
+@pytest.mark.parametrize("module_name", sorted(IMPORT_BUDGETS_MS))
+def test_import_heavy_modules(module_name):
+    import_times = _import_times(f"import {module_name}")
+    assert module_name in import_times
+    assert not (HEAVY_MODULES & set(import_times))
+
+
+@pytest.mark.perf
+@pytest.mark.parametrize("module_name", sorted(IMPORT_BUDGETS_MS))
+def test_import_budget(module_name):
+    code = f"import {module_name}"
+    # first run to compile bytecode
+    _import_times(code)
+
+    durations_us = []
+    for _ in range(3):
+        import_times = _import_times(code)
+        durations_us.append(import_times[module_name])
+
+    duration_ms = min(durations_us) / 1000
+    assert duration_ms < IMPORT_BUDGETS_MS[module_name]
+
+
+def test_version_is_lightweight():
+    code = (
+        "import sys; sys.argv = ['sjfmt', '--version']; import straitjacket.__main__ as m; m.main()"
+    )
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    cmd = [sys.executable, "-X", "importtime", "-c", code]
+
+    result = sp.run(cmd, env=env, stdout=sp.PIPE, stderr=sp.PIPE, check=True)
+    assert result.stdout.decode("utf-8").strip() == f"sjfmt, version {straitjacket.__version__}"
+    imported = {line.split("|")[-1].strip() for line in result.stderr.decode("utf-8").splitlines()}
+    assert not (HEAVY_MODULES & imported)
+
+
+def test_lazy_submodules():
+    code = (
+        "import sys, straitjacket; "
+        "assert 'straitjacket.stats' not in sys.modules; "
+        "assert straitjacket.stats.__name__ == 'straitjacket.stats'; "
+        "assert not hasattr(straitjacket, 'missing')"
+    )
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    sp.run([sys.executable, "-c", code], env=env, check=True)